@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# benchmarks/bench_broadcast.py - Room broadcast fan-out throughput
+
+import sys
+import os
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import server
+from protocol.codec import JSON
+
+CLIENTS = 10_000
+ROOMS = 1_000
+BROADCASTS = 20_000
+
+
+class NullConnection:
+    """Stands in for a client connection; counts frames instead of sending"""
+
+    def __init__(self):
+        self.frames = 0
+        self.codec = JSON
+
+    def send(self, data):
+        self.frames += 1
+        return True
+
+    def send_bytes(self, payload, coalesce_key=None):
+        self.frames += 1
+        return True
+
+
+def populate():
+    """Register CLIENTS fake clients spread evenly across ROOMS rooms"""
+    server.clients.clear()
+    server.room_members.clear()
+
+    for i in range(CLIENTS):
+        key = object()
+        room = f"room-{i % ROOMS}"
+        server.clients[key] = {
+            "username": f"user{i}",
+            "session": None,
+            "room": room,
+            "addr": None,
+            "conn": NullConnection()
+        }
+        server.room_members[room].add(key)
+
+
+def full_scan_broadcast(room, data):
+    """The pre-index implementation: walk every connected client"""
+    with server.clients_lock:
+        for sock, info in list(server.clients.items()):
+            if info.get("room") == room:
+                info["conn"].send(data)
+
+
+def run(label, broadcast):
+    rooms = [f"room-{random.randrange(ROOMS)}" for _ in range(BROADCASTS)]
+    frame = {"type": "chat", "sender": "bench", "message": "hello"}
+
+    start = time.perf_counter()
+    for room in rooms:
+        broadcast(room, frame)
+    elapsed = time.perf_counter() - start
+
+    print(f"{label:<12} {BROADCASTS / elapsed:>12,.0f} broadcasts/s")
+
+
+if __name__ == "__main__":
+    print(f"{CLIENTS} clients across {ROOMS} rooms, {BROADCASTS} broadcasts\n")
+    populate()
+    run("full scan", full_scan_broadcast)
+    run("room index", server.broadcast_to_room)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# benchmarks/bench_codec.py - Wire codec encode/decode micro-benchmarks
+
+import sys
+import os
+import json
+import time
+import base64
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol.codec import CODECS, FrameDecoder
+
+CHUNK = 4096  # bytes per socket read in the old receive loop
+
+
+def chat_frame():
+    return {
+        "type": "chat",
+        "sender": "alice",
+        "message": "Hey, are we still on for lunch? 🍕",
+        "message_id": str(uuid.uuid4()),
+        "timestamp": "12:30",
+        "reply_to": None,
+        "edited": False
+    }
+
+
+def history_frame():
+    return {
+        "type": "history",
+        "room": "general",
+        "before": None,
+        "messages": [dict(chat_frame(), message=f"message {i} " * 8) for i in range(50)],
+        "cursor": str(uuid.uuid4()),
+        "has_more": True
+    }
+
+
+def upload_frame(codec_name, size=1024 * 1024):
+    data = os.urandom(size)
+    # JSON can only carry bytes as base64 text; MessagePack carries them raw
+    payload = base64.b64encode(data).decode() if codec_name == "json" else data
+    return {"type": "upload", "message_id": str(uuid.uuid4()), "file_data": payload}
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def string_concat_decode(wire):
+    """The old receive loop: decode each chunk and grow a str"""
+    buffer = ""
+    for i in range(0, len(wire), CHUNK):
+        buffer += wire[i:i + CHUNK].decode(errors="replace")
+        if "\n" in buffer:
+            break
+    line, buffer = buffer.split("\n", 1)
+    return json.loads(line)
+
+
+def frame_decoder_decode(codec, wire):
+    decoder = FrameDecoder(codec)
+    for i in range(0, len(wire), CHUNK):
+        decoder.feed(wire[i:i + CHUNK])
+        frame = decoder.next_frame()
+        if frame is not None:
+            return frame
+
+
+if __name__ == "__main__":
+    print(f"{'frame':<14} {'codec':<8} {'bytes':>10} {'encode µs':>11} {'decode µs':>11}")
+
+    for label, make, repeat in (
+        ("chat", lambda name: chat_frame(), 20_000),
+        ("history x50", lambda name: history_frame(), 1_000),
+        ("upload 1 MiB", upload_frame, 20),
+    ):
+        for name, codec in CODECS.items():
+            frame = make(name)
+            wire = codec.encode(frame)
+            enc = timed(lambda: codec.encode(frame), repeat)
+            dec = timed(lambda: frame_decoder_decode(codec, wire), repeat)
+            print(f"{label:<14} {name:<8} {len(wire):>10,} {enc:>11,.1f} {dec:>11,.1f}")
+
+    print("\nReceiving one large JSON frame in 4 KiB reads:")
+    for size in (256 * 1024, 1024 * 1024, 4 * 1024 * 1024):
+        wire = CODECS["json"].encode(upload_frame("json", size))
+        old = timed(lambda: string_concat_decode(wire), 3)
+        new = timed(lambda: frame_decoder_decode(CODECS["json"], wire), 3)
+        print(f"  {size // 1024:>5} KiB   str concat {old / 1000:>9,.1f} ms   "
+              f"FrameDecoder {new / 1000:>7,.1f} ms")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# benchmarks/bench_crypto.py - History decryption on a 10k-message room
+
+import sys
+import os
+import time
+import uuid
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.fernet import Fernet
+from server import crypto, database
+
+ROOM = "general"
+MESSAGES = 10_000
+WORKER_COUNTS = (2, 4, 8)
+
+
+def uncached_decrypt(room, token):
+    """decrypt_message as it was: a new Fernet object per call"""
+    return Fernet(crypto.generate_room_key(room)).decrypt(token.encode()).decode()
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def report(label, seconds):
+    print(f"  {label:<34} {seconds * 1000:>8.1f} ms  {MESSAGES / seconds:>10,.0f} msg/s")
+
+
+if __name__ == "__main__":
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    database.init_db()
+
+    texts = [f"message {i}: " + "lorem ipsum dolor sit amet " * 3 for i in range(MESSAGES)]
+    tokens = crypto.encrypt_many(ROOM, texts)
+    for token in tokens:
+        database.save_message(ROOM, "alice", token, str(uuid.uuid4()))
+
+    print(f"Decrypting {MESSAGES:,} messages from one room:")
+
+    seconds, plain = timed(lambda: [uncached_decrypt(ROOM, t) for t in tokens])
+    report("new cipher per message", seconds)
+    assert plain == texts
+
+    seconds, plain = timed(lambda: [crypto.decrypt_message(ROOM, t) for t in tokens])
+    report("cached cipher per message", seconds)
+
+    seconds, plain = timed(lambda: crypto.decrypt_many(ROOM, tokens))
+    report("decrypt_many", seconds)
+    assert plain == texts
+
+    for workers in WORKER_COUNTS:
+        crypto.CRYPTO_WORKERS = workers
+        crypto._crypto_pool = None
+        crypto.decrypt_many(ROOM, tokens)  # Start the pool threads
+        seconds, plain = timed(lambda: crypto.decrypt_many(ROOM, tokens))
+        report(f"decrypt_many, {workers} threads", seconds)
+        assert plain == texts
+    crypto.CRYPTO_WORKERS = 0
+
+    print(f"\nLoading the whole room from SQLite and decrypting it:")
+
+    def load(decrypt_rows):
+        rows, _ = database.fetch_room_history(ROOM, limit=MESSAGES)
+        return decrypt_rows(rows)
+
+    seconds, _ = timed(lambda: load(
+        lambda rows: [uncached_decrypt(ROOM, row["message"]) for row in rows]
+    ))
+    report("row by row, new cipher", seconds)
+
+    seconds, _ = timed(lambda: load(
+        lambda rows: crypto.decrypt_many(ROOM, [row["message"] for row in rows])
+    ))
+    report("decrypt_many", seconds)
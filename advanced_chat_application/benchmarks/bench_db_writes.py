@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# benchmarks/bench_db_writes.py - save_message throughput vs. concurrent writers
+
+import sys
+import os
+import time
+import uuid
+import sqlite3
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import database
+
+WRITER_COUNTS = (1, 8, 64)
+MESSAGES = 4_000
+
+
+def unpooled_save_message(room, sender, message, message_id, reply_to=None):
+    """save_message as it was before pooling: new connection per call"""
+    conn = sqlite3.connect(database.DB_PATH, check_same_thread=False, timeout=30)
+    try:
+        conn.execute("""
+            INSERT INTO messages (message_id, room, sender, message, reply_to)
+            VALUES (?, ?, ?, ?, ?)
+        """, (message_id, room, sender, message, reply_to))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def fresh_database(wal):
+    """Point the database module at an empty database file"""
+    database.close_db()
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    database.init_db()
+    if not wal:
+        # The unpooled baseline also ran with the default rollback journal
+        database.close_db()
+        conn = sqlite3.connect(database.DB_PATH)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+
+
+def run(save, writers):
+    per_writer = MESSAGES // writers
+
+    def worker(n):
+        for i in range(per_writer):
+            save(f"room-{n % 8}", "bench", "x" * 120, str(uuid.uuid4()))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(writers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return per_writer * writers / elapsed
+
+
+if __name__ == "__main__":
+    print(f"{MESSAGES} messages per run\n")
+    print(f"{'writers':>8} {'unpooled msg/s':>16} {'pooled WAL msg/s':>18}")
+
+    for writers in WRITER_COUNTS:
+        fresh_database(wal=False)
+        before = run(unpooled_save_message, writers)
+        fresh_database(wal=True)
+        after = run(database.save_message, writers)
+        print(f"{writers:>8} {before:>16,.0f} {after:>18,.0f}")
+
+    database.close_db()
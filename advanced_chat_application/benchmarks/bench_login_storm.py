@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# benchmarks/bench_login_storm.py - Chat latency while 500 clients log in at once
+# Usage: python benchmarks/bench_login_storm.py [threads|asyncio]
+
+import sys
+import os
+import time
+import uuid
+import tempfile
+import threading
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import auth, database
+from server import server as chat_server
+from server.async_server import start_async_server
+from client.socket_client import ChatClient
+
+MODE = sys.argv[1] if len(sys.argv) > 1 else "threads"
+HOST, PORT = "127.0.0.1", 5599
+LOGINS = 500
+CHAT_MESSAGES = 100
+CHAT_INTERVAL = 0.05
+BCRYPT_ROUNDS = 10
+
+
+def start_server():
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    chat_server.HOST, chat_server.PORT = HOST, PORT
+    auth.BCRYPT_ROUNDS = BCRYPT_ROUNDS
+    # Every simulated user connects from 127.0.0.1
+    auth.ip_limiter.rate = auth.ip_limiter.capacity = LOGINS * 2
+    if MODE == "asyncio":
+        target = lambda: start_async_server(HOST, PORT)
+    else:
+        target = chat_server.start_server
+    threading.Thread(target=target, daemon=True).start()
+    time.sleep(0.5)
+
+
+def create_users():
+    hashed = auth.hash_password("password")
+    for i in range(LOGINS):
+        database.create_user(f"storm{i}", hashed)
+
+
+def chat_latency(sender, receiver):
+    """Send messages one at a time and time their arrival at the receiver"""
+    latencies = []
+    for _ in range(CHAT_MESSAGES):
+        message_id = str(uuid.uuid4())
+        start = time.perf_counter()
+        sender.send_message("ping", message_id)
+        while True:
+            frame = receiver.recv()
+            if frame and frame.get("message_id") == message_id:
+                break
+        latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(CHAT_INTERVAL)
+    return latencies
+
+
+def login_storm(results):
+    def login(i):
+        client = ChatClient(HOST, PORT)
+        ok, msg = client.authenticate(f"storm{i}", "password")
+        results.append(ok or msg)
+        client.close()
+
+    threads = [threading.Thread(target=login, args=(i,)) for i in range(LOGINS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def report(label, latencies):
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{label:<14} p50 {statistics.median(latencies):7.2f} ms   p99 {p99:7.2f} ms")
+
+
+if __name__ == "__main__":
+    start_server()
+    create_users()
+
+    sender, receiver = ChatClient(HOST, PORT), ChatClient(HOST, PORT)
+    sender.authenticate("alice", "password", "register")
+    receiver.authenticate("bobby", "password", "register")
+    sender.join_room("bench")
+    receiver.join_room("bench")
+    time.sleep(0.2)
+
+    print(f"{LOGINS} concurrent logins, {MODE} server, bcrypt rounds={BCRYPT_ROUNDS}, "
+          f"{auth.HASH_WORKERS} hash workers\n")
+    report("idle", chat_latency(sender, receiver))
+
+    results = []
+    storm = threading.Thread(target=login_storm, args=(results,))
+    start = time.perf_counter()
+    storm.start()
+    report("login storm", chat_latency(sender, receiver))
+    storm.join()
+    elapsed = time.perf_counter() - start
+
+    ok = sum(1 for r in results if r is True)
+    print(f"\n{ok}/{LOGINS} logins succeeded in {elapsed:.1f}s; "
+          f"{LOGINS - ok} turned away (busy/throttled)")
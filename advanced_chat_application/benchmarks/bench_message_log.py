@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# benchmarks/bench_message_log.py - Ingest throughput and replay time of the message log
+
+import sys
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import database, message_log
+from server.message_log import MessageLog
+
+WRITERS = 16
+ROOMS = 64
+SECONDS = 5.0
+
+# Unindexed records left behind by a crash, replayed on the next start
+BACKLOGS = (10_000, 100_000, 300_000)
+
+# (label, write-behind mode, message log mode)
+ENGINES = (
+    ("direct", None, None),
+    ("write-behind async", "async", None),
+    ("write-behind flush_on_ack", "flush_on_ack", None),
+    ("message log async", None, "async"),
+    ("message log flush_on_ack", None, "flush_on_ack"),
+)
+
+
+def message_args(n):
+    return (f"room-{n % ROOMS}", "bench", "x" * 120, str(uuid.uuid4()), None, (), None)
+
+
+def write_for(writer, seconds, latencies):
+    deadline = time.perf_counter() + seconds
+    i = writer
+    while True:
+        start = time.perf_counter()
+        if start >= deadline:
+            return
+        database.save_message(*message_args(i)[:4])
+        latencies.append(time.perf_counter() - start)
+        i += WRITERS
+
+
+def ingest_run(write_behind, log_mode):
+    """save_message from WRITERS threads; returns (msg/s, p99 ms, seconds to drain)"""
+    fresh_database()
+    if write_behind:
+        database.enable_write_behind(write_behind)
+    database.MESSAGE_LOG_MODE = log_mode
+    database.open_message_log()
+
+    latencies = [[] for _ in range(WRITERS)]
+    threads = [
+        threading.Thread(target=write_for, args=(n, SECONDS, latencies[n]))
+        for n in range(WRITERS)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Until everything acknowledged is in the tables
+    start = time.perf_counter()
+    database.disable_write_behind()
+    database.close_message_log()
+    drain = time.perf_counter() - start
+    database.MESSAGE_LOG_MODE = None
+
+    flat = sorted(x for writer in latencies for x in writer)
+    p99 = flat[int(len(flat) * 0.99)] if flat else 0
+    return len(flat) / SECONDS, p99 * 1000, drain
+
+
+def fill_log(directory, records):
+    """
+    Append `records` messages while the indexer never gets to apply any,
+    then die without stopping: what a crash under load leaves behind.
+    """
+    log = MessageLog(directory, lambda batch: threading.Event().wait(),
+                     lambda: 0, max_unindexed=1 << 40)
+    log.start()
+    for n in range(records):
+        log.append("_insert_message", message_args(n))
+    os._exit(0)
+
+
+def replay_run(records):
+    """Returns (log bytes, records applied, seconds)"""
+    fresh_database()
+    directory = database.message_log_dir()
+    context = multiprocessing.get_context("spawn")
+    child = context.Process(target=fill_log, args=(directory, records))
+    child.start()
+    child.join()
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    applied, seconds = database.open_message_log()
+    return size, applied, seconds
+
+
+def fresh_database():
+    database.close_db()
+    if database.DB_PATH.startswith(tempfile.gettempdir()):
+        shutil.rmtree(os.path.dirname(database.DB_PATH), ignore_errors=True)
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    database.init_db()
+
+
+if __name__ == "__main__":
+    print(f"{WRITERS} writers, {ROOMS} rooms, {SECONDS:.0f}s per run, {os.cpu_count()} CPU(s)\n")
+    print(f"{'engine':<28} {'msg/s':>10} {'p99 ms':>8} {'drain s':>8}")
+    for label, write_behind, log_mode in ENGINES:
+        rate, p99, drain = ingest_run(write_behind, log_mode)
+        print(f"{label:<28} {rate:>10,.0f} {p99:>8.1f} {drain:>8.2f}")
+
+    print(f"\n{'replay backlog':<28} {'MB':>10} {'seconds':>8} {'rec/s':>10}")
+    rate = 0
+    for records in BACKLOGS:
+        size, applied, seconds = replay_run(records)
+        rate = size / seconds
+        print(f"{applied:>14,} records {size / 1e6:>15.1f} {seconds:>8.2f} {applied / seconds:>10,.0f}")
+
+    # Writers block once this much is unindexed, so no crash leaves more
+    bound = message_log.MAX_UNINDEXED_BYTES
+    print(f"\nMAX_UNINDEXED_BYTES = {bound / 1e6:.0f} MB -> worst-case replay "
+          f"~{bound / rate:.1f}s at {rate / 1e6:.1f} MB/s")
+    database.close_db()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# benchmarks/bench_search.py - Message search on a room with a million messages
+
+import sys
+import os
+import time
+import uuid
+import random
+import itertools
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import crypto, database
+from server.search import message_tokens, search_room
+
+ROOM = "general"
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+VOCABULARY = 20_000
+WORDS_PER_MESSAGE = 10
+SCAN_SAMPLE = 50_000  # messages decrypted by the no-index baseline
+REPEAT = 20
+
+
+def word(rank):
+    return f"w{rank}"
+
+
+def populate(rng):
+    """MESSAGES messages of Zipf-distributed words, written in bulk"""
+    ranks = range(1, VOCABULARY + 1)
+    cum_weights = list(itertools.accumulate(1 / r for r in ranks))
+    batch = 10_000
+    with database.room_db(ROOM) as conn:
+        cur = conn.cursor()
+        for start in range(0, MESSAGES, batch):
+            chunk = [
+                " ".join(word(r) for r in rng.choices(ranks, cum_weights=cum_weights, k=WORDS_PER_MESSAGE))
+                for _ in range(min(batch, MESSAGES - start))
+            ]
+            for text, token in zip(chunk, crypto.encrypt_many(ROOM, chunk)):
+                database._insert_message(
+                    cur, ROOM, "alice", token, str(uuid.uuid4()), None,
+                    message_tokens(ROOM, text)
+                )
+            conn.commit()
+            print(f"\r  {start + len(chunk):,} messages", end="", flush=True)
+    print()
+
+
+def timed(func, repeat=REPEAT):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def scan_search(query):
+    """No index: decrypt SCAN_SAMPLE rows and match words"""
+    rows = database.fetch_rekey_messages(ROOM, 0, 0, database.NEWEST, SCAN_SAMPLE)
+    words = query.split()
+    return [
+        text for text in crypto.decrypt_many(ROOM, [row["message"] for row in rows])
+        if all(w in text.split() for w in words)
+    ]
+
+
+if __name__ == "__main__":
+    workdir = tempfile.mkdtemp()
+    database.DB_PATH = os.path.join(workdir, "bench.db")
+    crypto.SECRET_KEY_PATH = os.path.join(workdir, "secret.key")
+    database.init_db()
+
+    print(f"Building a room of {MESSAGES:,} messages ({WORDS_PER_MESSAGE} words each):")
+    start = time.perf_counter()
+    populate(random.Random(1))
+    print(f"  {time.perf_counter() - start:.0f}s, "
+          f"{os.path.getsize(database.DB_PATH) / 2**20:,.0f} MB with the index\n")
+
+    queries = [
+        ("common word", word(1)),
+        ("mid-frequency word", word(200)),
+        ("rare word", word(VOCABULARY - 7)),
+        ("two common words", f"{word(1)} {word(2)}"),
+        ("common + rare word", f"{word(1)} {word(5000)}"),
+        ("no match", "nonexistent"),
+    ]
+
+    print(f"{'query':<22}{'first page':>12}{'next page':>12}{'hits':>6}")
+    for label, query in queries:
+        seconds, page = timed(lambda: search_room(ROOM, query))
+        more = ""
+        if page["has_more"]:
+            next_seconds, _ = timed(lambda: search_room(ROOM, query, before=page["cursor"]))
+            more = f"{next_seconds * 1000:.2f} ms"
+        print(f"{label:<22}{seconds * 1000:>9.2f} ms{more:>12}{len(page['results']):>6}")
+
+    seconds, hits = timed(lambda: scan_search(word(5000)), repeat=1)
+    estimate = seconds * MESSAGES / min(SCAN_SAMPLE, MESSAGES)
+    print(f"\nWithout an index: {seconds * 1000:,.0f} ms to decrypt and scan "
+          f"{min(SCAN_SAMPLE, MESSAGES):,} messages (~{estimate:,.1f} s for the room)")
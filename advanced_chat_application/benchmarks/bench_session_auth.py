@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# benchmarks/bench_session_auth.py - DB round trips spent on session checks
+
+import sys
+import os
+import time
+import uuid
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import auth, database
+
+USERS = 50
+MESSAGES = 20_000
+
+
+class CountingCall:
+    """Wraps a database function and counts the round trips it makes"""
+
+    def __init__(self, func):
+        self.func = func
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.func(*args, **kwargs)
+
+
+def uncached_authenticate(session_id):
+    """authenticate_session as it was before the cache"""
+    session = auth.validate_session(session_id)
+    if not session:
+        return None
+    auth.update_last_seen(session[0])
+    return session[0]
+
+
+def run(label, authenticate, sessions):
+    auth.validate_session = CountingCall(database.validate_session)
+    auth.update_last_seen = CountingCall(database.update_last_seen)
+    auth.update_last_seen_many = CountingCall(database.update_last_seen_many)
+    auth.session_cache.clear()
+
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        assert authenticate(sessions[i % len(sessions)])
+    auth.flush_last_seen()
+    elapsed = time.perf_counter() - start
+
+    db_ops = (
+        auth.validate_session.calls
+        + auth.update_last_seen.calls
+        + auth.update_last_seen_many.calls
+    )
+    print(f"{label:<10} {db_ops / MESSAGES:>10.4f} DB ops/msg {MESSAGES / elapsed:>12,.0f} msg/s")
+
+
+if __name__ == "__main__":
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    database.init_db()
+
+    sessions = []
+    for i in range(USERS):
+        username = f"user{i}"
+        database.create_user(username, b"x")
+        session_id = str(uuid.uuid4())
+        database.create_session(session_id, username)
+        sessions.append(session_id)
+
+    print(f"{MESSAGES} authenticated messages from {USERS} sessions\n")
+    run("uncached", uncached_authenticate, sessions)
+    run("cached", auth.authenticate_session, sessions)
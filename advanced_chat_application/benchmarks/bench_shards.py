@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# benchmarks/bench_shards.py - Aggregate write throughput vs. shard count
+
+import sys
+import os
+import time
+import uuid
+import tempfile
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import database
+from server.reshard import reshard
+
+SHARD_COUNTS = (1, 2, 4, 8)
+WRITERS = 16
+ROOMS = 64
+SECONDS = 5.0
+
+# A room importing history (or a large write-behind batch) holds its
+# file's write lock for a whole transaction of this many rows
+HOT_ROOM = "hot-room"
+HOT_BATCH_ROWS = 5000
+
+
+def room_names():
+    return [f"room-{n}" for n in range(ROOMS)]
+
+
+def write_for(rooms, seconds, latencies):
+    """save_message round-robin over `rooms` until time is up"""
+    deadline = time.perf_counter() + seconds
+    i = 0
+    while True:
+        start = time.perf_counter()
+        if start >= deadline:
+            return
+        database.save_message(rooms[i % len(rooms)], "bench", "x" * 120, str(uuid.uuid4()))
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+def thread_run(seconds):
+    """WRITERS threads of one process, each on its own slice of the rooms"""
+    rooms = room_names()
+    latencies = [[] for _ in range(WRITERS)]
+    threads = [
+        threading.Thread(target=write_for, args=(rooms[n::WRITERS], seconds, latencies[n]))
+        for n in range(WRITERS)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return [x for writer in latencies for x in writer]
+
+
+def process_writer(db_path, n, seconds, results):
+    # Like a --workers server process: its own pools, the shard map from disk
+    database.DB_PATH = db_path
+    database.init_db()
+    latencies = []
+    write_for(room_names()[n::WRITERS], seconds, latencies)
+    results.put(latencies)
+
+
+def process_run(seconds):
+    """WRITERS processes, as with run_server.py --workers"""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [
+        context.Process(target=process_writer, args=(database.DB_PATH, n, seconds, results))
+        for n in range(WRITERS)
+    ]
+    for p in processes:
+        p.start()
+    latencies = [x for _ in processes for x in results.get()]
+    for p in processes:
+        p.join()
+    return latencies
+
+
+def hot_room_writer(stop):
+    """Big transactions on one room, back to back"""
+    while not stop.is_set():
+        database._run_write_batch([
+            (database._insert_message, (HOT_ROOM, "bulk", "x" * 120, str(uuid.uuid4()), None))
+            for _ in range(HOT_BATCH_ROWS)
+        ])
+
+
+def hot_room_run(seconds):
+    """thread_run() while another thread keeps the hot room's shard locked"""
+    stop = threading.Event()
+    hot = threading.Thread(target=hot_room_writer, args=(stop,))
+    hot.start()
+    try:
+        return thread_run(seconds)
+    finally:
+        stop.set()
+        hot.join()
+
+
+def summary(latencies, seconds):
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    return len(latencies) / seconds, p99 * 1000
+
+
+def fresh_database(shards):
+    database.close_db()
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    database.init_db()
+    reshard(shards)
+
+
+if __name__ == "__main__":
+    print(f"{WRITERS} writers, {ROOMS} rooms, {SECONDS:.0f}s per run, {os.cpu_count()} CPU(s)\n")
+    print(f"{'':>7} {'threads':>23} {'processes':>25} {'with a hot room':>25}")
+    print(f"{'shards':>7} {'msg/s':>14} {'p99 ms':>8} {'msg/s':>16} {'p99 ms':>8} "
+          f"{'msg/s':>16} {'p99 ms':>8}")
+
+    for shards in SHARD_COUNTS:
+        fresh_database(shards)
+        threaded = summary(thread_run(SECONDS), SECONDS)
+        fresh_database(shards)
+        # Processes take a moment to start; time only their writing
+        multi = summary(process_run(SECONDS), SECONDS)
+        fresh_database(shards)
+        hot = summary(hot_room_run(SECONDS), SECONDS)
+        print(f"{shards:>7} {threaded[0]:>14,.0f} {threaded[1]:>8.1f} "
+              f"{multi[0]:>16,.0f} {multi[1]:>8.1f} {hot[0]:>16,.0f} {hot[1]:>8.1f}")
+
+    database.close_db()
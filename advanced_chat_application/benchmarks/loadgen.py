@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+# benchmarks/loadgen.py - Simulated users driving a chat server end to end
+
+import sys
+import os
+import argparse
+import asyncio
+import json
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol.codec import FrameDecoder, FrameError, JSON, available_codecs, get_codec
+from protocol.chunks import chunk_hash, tree_hash
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RECV_SIZE = 65536
+PASSWORD = "loadgen-secret"
+
+# Exponent of the Zipf room distribution: room k gets weight 1 / k**s
+ZIPF_S = 1.1
+
+# Seconds to keep reading after the last action, for in-flight deliveries
+DRAIN_SECONDS = 1.0
+
+# Seconds to wait for any one reply (auth, join, upload)
+REPLY_TIMEOUT = 30.0
+
+# Attempts at a login the server turned away as busy
+LOGIN_RETRIES = 5
+
+# Settings replacing the option defaults; flags given on the command
+# line still win. --suite runs them all in this order.
+SCENARIOS = {
+    "chat": dict(users=200, rooms=20, mix="chat=100"),
+    "mixed": dict(users=500, rooms=50, mix="chat=60,typing=30,read=10"),
+    "hot-rooms": dict(users=500, rooms=50, room_dist="zipf", mix="chat=60,typing=30,read=10"),
+    "uploads": dict(users=50, rooms=5, rate=0.2, mix="chat=50,upload=50"),
+    "idle-crowd": dict(users=2000, rooms=200, rate=0.05, mix="chat=80,typing=20"),
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Stats:
+    """Latencies in milliseconds and event counts for one run"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.sent = Counter()
+        self.received = Counter()
+        self.errors = Counter()
+
+    def observe(self, name, start):
+        self.latencies[name].append((time.perf_counter() - start) * 1000)
+
+    def summary(self, name):
+        values = self.latencies.get(name, [])
+        return {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": max(values, default=0.0)
+        }
+
+
+class ProcessSampler:
+    """CPU time, memory and threads of a server process, from /proc (Linux)"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.tick = os.sysconf("SC_CLK_TCK")
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                # Fields after the command name, which may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+            status = {}
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    status[key] = value.split()
+        except OSError:
+            return None
+        return {
+            "cpu": (int(fields[11]) + int(fields[12])) / self.tick,
+            "rss_mb": int(status["VmRSS"][0]) / 1024,
+            "peak_rss_mb": int(status["VmHWM"][0]) / 1024,
+            "threads": int(status["Threads"][0])
+        }
+
+
+class SimUser:
+    """One simulated client speaking the ChatClient protocol over asyncio"""
+
+    def __init__(self, run, index, room):
+        self.run = run
+        self.username = f"{run.prefix}{index}"
+        self.room = room
+        self.rng = random.Random(run.seed * 1_000_003 + index)
+        self.codec = JSON
+        self.decoder = FrameDecoder(JSON)
+        self.session = None
+        self.writer = None
+        self.reader_task = None
+        self.waiters = {}  # (frame type, message_id) -> future
+        self.last_message_id = None
+        self.typing = False
+
+    # ----- Wire -----
+
+    async def send(self, data):
+        if self.session:
+            data["session"] = self.session
+        self.writer.write(self.codec.encode(data))
+        await self.writer.drain()
+
+    async def recv(self):
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            chunk = await self.reader.read(RECV_SIZE)
+            if not chunk:
+                return None
+            self.decoder.feed(chunk)
+
+    async def reply(self, predicate):
+        """Frames until one matches; the rest are counted and dropped"""
+        while True:
+            frame = await asyncio.wait_for(self.recv(), REPLY_TIMEOUT)
+            if frame is None:
+                raise ConnectionError("server closed the connection")
+            if predicate(frame):
+                return frame
+            self.run.stats.received[frame.get("type", "reply")] += 1
+
+    # ----- Setup -----
+
+    async def login(self):
+        stats = self.run.stats
+        for attempt in range(LOGIN_RETRIES):
+            start = time.perf_counter()
+            self.reader, self.writer = await asyncio.open_connection(self.run.host, self.run.port)
+            await self.send({
+                "action": "register",
+                "username": self.username,
+                "password": PASSWORD,
+                "codecs": self.run.codecs
+            })
+            response = await self.reply(lambda f: "ok" in f)
+            if response.get("ok"):
+                stats.observe("login", start)
+                self.codec = get_codec(response.get("codec"))
+                self.decoder.codec = self.codec
+                self.session = response.get("session")
+                return
+            self.writer.close()
+            if "busy" not in response.get("msg", "").lower():
+                raise ConnectionError(response.get("msg"))
+            stats.errors["login busy"] += 1
+            await asyncio.sleep(0.2 * 2 ** attempt)
+        raise ConnectionError("server stayed busy")
+
+    async def join(self):
+        start = time.perf_counter()
+        await self.send({"type": "join", "room": self.room})
+        response = await self.reply(lambda f: "ok" in f)
+        if not response.get("ok"):
+            raise ConnectionError(response.get("msg"))
+        # The history page follows the confirmation
+        history = await self.reply(lambda f: f.get("type") == "history")
+        self.run.stats.observe("join", start)
+        if history.get("messages"):
+            self.last_message_id = history["messages"][-1]["message_id"]
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+
+    # ----- Traffic -----
+
+    async def read_loop(self):
+        stats = self.run.stats
+        try:
+            while True:
+                frame = await self.recv()
+                if frame is None:
+                    stats.errors["disconnected"] += 1
+                    return
+                frame_type = frame.get("type", "reply")
+                stats.received[frame_type] += 1
+
+                message_id = frame.get("message_id")
+                waiter = self.waiters.pop((frame_type, message_id), None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(frame)
+                elif frame_type == "upload_error":
+                    for key in [k for k in self.waiters if k[1] == message_id]:
+                        self.waiters.pop(key).set_exception(ConnectionError(frame.get("msg")))
+
+                if frame_type == "chat":
+                    self.last_message_id = message_id
+                    start = self.run.sent_at.get(message_id)
+                    if start is not None:
+                        name = "chat echo" if frame.get("sender") == self.username else "chat delivery"
+                        stats.observe(name, start)
+        except (ConnectionError, FrameError):
+            stats.errors["disconnected"] += 1
+        except asyncio.CancelledError:
+            pass
+
+    def expect(self, frame_type, message_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[(frame_type, message_id)] = future
+        return future
+
+    async def send_chat(self, text=None, message_id=None):
+        message_id = message_id or str(uuid.uuid4())
+        self.run.sent_at[message_id] = time.perf_counter()
+        await self.send({
+            "type": "chat",
+            "message": text or f"load test message from {self.username}",
+            "message_id": message_id,
+            "reply_to": None
+        })
+
+    async def send_typing(self):
+        self.typing = not self.typing
+        await self.send({"type": "typing", "typing": self.typing})
+
+    async def send_read(self):
+        if self.last_message_id:
+            await self.send({"type": "read", "up_to": self.last_message_id})
+
+    async def send_upload(self):
+        """Chunked upload as client/transfers.py does it, then its chat message"""
+        data = self.run.upload_data
+        message_id = str(uuid.uuid4())
+        start = time.perf_counter()
+
+        ready = self.expect("upload_ready", message_id)
+        await self.send({
+            "type": "upload_init",
+            "upload_id": None,
+            "message_id": message_id,
+            "filename": "loadgen.bin",
+            "file_type": ".bin",
+            "size": len(data)
+        })
+        ready = await asyncio.wait_for(ready, REPLY_TIMEOUT)
+
+        chunk_size = ready["chunk_size"]
+        hashes = []
+        for index, offset in enumerate(range(0, max(len(data), 1), chunk_size)):
+            chunk = data[offset:offset + chunk_size]
+            hashes.append(chunk_hash(chunk))
+            await self.send({
+                "type": "upload_chunk",
+                "upload_id": ready["upload_id"],
+                "index": index,
+                "data": self.codec.pack_bytes(chunk),
+                "sha256": hashes[-1]
+            })
+
+        complete = self.expect("upload_complete", message_id)
+        await self.send({
+            "type": "upload_commit",
+            "upload_id": ready["upload_id"],
+            "sha256": tree_hash(hashes)
+        })
+        await asyncio.wait_for(complete, REPLY_TIMEOUT)
+        self.run.stats.observe("upload", start)
+        await self.send_chat("📎 loadgen.bin", message_id)
+
+    async def traffic(self, deadline):
+        """Poisson arrivals of actions drawn from the mix until the deadline"""
+        actions = {
+            "chat": self.send_chat,
+            "typing": self.send_typing,
+            "read": self.send_read,
+            "upload": self.send_upload
+        }
+        names, weights = zip(*self.run.mix.items())
+        while True:
+            delay = self.rng.expovariate(self.run.rate)
+            if time.monotonic() + delay >= deadline:
+                return
+            await asyncio.sleep(delay)
+            action = self.rng.choices(names, weights)[0]
+            try:
+                await actions[action]()
+                self.run.stats.sent[action] += 1
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                self.run.stats.errors[f"{action}: {e or type(e).__name__}"] += 1
+                if self.writer.is_closing():
+                    return
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class LoadRun:
+    """One benchmark run: set up every user, drive traffic, report"""
+
+    def __init__(self, args, host, port, sampler=None):
+        self.args = args
+        self.host, self.port = host, port
+        self.sampler = sampler
+        self.seed = args.seed
+        self.prefix = f"lg{uuid.uuid4().hex[:6]}_"
+        self.rate = args.rate
+        self.mix = parse_mix(args.mix)
+        self.codecs = [args.codec] if args.codec else available_codecs()
+        self.upload_data = random.Random(args.seed).randbytes(args.upload_size)
+        self.sent_at = {}
+        self.stats = Stats()
+
+    def rooms(self):
+        names = [f"load-{i}" for i in range(self.args.rooms)]
+        rng = random.Random(self.seed)
+        if self.args.room_dist == "uniform":
+            return [names[i % len(names)] for i in range(self.args.users)]
+        weights = [1 / (k + 1) ** ZIPF_S for k in range(len(names))]
+        return rng.choices(names, weights, k=self.args.users)
+
+    async def setup(self, user, slots):
+        async with slots:
+            try:
+                await user.login()
+                await user.join()
+                return True
+            except (OSError, ConnectionError, FrameError, asyncio.TimeoutError) as e:
+                self.stats.errors[f"setup: {e or type(e).__name__}"] += 1
+                await user.close()
+                return False
+
+    async def run(self):
+        users = [SimUser(self, i, room) for i, room in enumerate(self.rooms())]
+        slots = asyncio.Semaphore(self.args.login_concurrency)
+
+        start = time.perf_counter()
+        ready = await asyncio.gather(*(self.setup(user, slots) for user in users))
+        users = [user for user, ok in zip(users, ready) if ok]
+        setup_seconds = time.perf_counter() - start
+
+        before = self.sampler.sample() if self.sampler else None
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.args.duration
+        await asyncio.gather(*(user.traffic(deadline) for user in users))
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(DRAIN_SECONDS)
+        after = self.sampler.sample() if self.sampler else None
+
+        for user in users:
+            await user.close()
+        return self.result(len(users), setup_seconds, elapsed, before, after)
+
+    def result(self, connected, setup_seconds, elapsed, before, after):
+        stats = self.stats
+        result = {
+            "users": self.args.users,
+            "connected": connected,
+            "rooms": self.args.rooms,
+            "room_dist": self.args.room_dist,
+            "rate": self.rate,
+            "mix": self.mix,
+            "codec": self.args.codec or "negotiated",
+            "setup_seconds": setup_seconds,
+            "duration": elapsed,
+            "sent": dict(stats.sent),
+            "received": dict(stats.received),
+            "errors": dict(stats.errors),
+            "sent_per_second": sum(stats.sent.values()) / elapsed,
+            "received_per_second": sum(stats.received.values()) / elapsed,
+            "latency_ms": {name: stats.summary(name) for name in sorted(stats.latencies)}
+        }
+        if before and after:
+            result["server"] = {
+                "cpu_percent": (after["cpu"] - before["cpu"]) / (elapsed + DRAIN_SECONDS) * 100,
+                "rss_mb": after["rss_mb"],
+                "peak_rss_mb": after["peak_rss_mb"],
+                "threads": after["threads"]
+            }
+        return result
+
+
+def parse_mix(text):
+    """'chat=60,typing=30' -> {'chat': 60.0, 'typing': 30.0}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ("chat", "typing", "read", "upload"):
+            raise ValueError(f"unknown action in mix: {name!r}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(args, workdir):
+    """run_server.py on a free port with a scratch database and media dir"""
+    port = free_port()
+    command = [
+        sys.executable, os.path.join(APP_DIR, "run_server.py"),
+        "--mode", args.mode,
+        "--port", str(port),
+        "--db", os.path.join(workdir, "chat.db"),
+        "--media-dir", os.path.join(workdir, "media"),
+        "--bcrypt-rounds", str(args.bcrypt_rounds),
+        # Every simulated user connects from 127.0.0.1
+        "--ip-attempt-rate", str(max(args.users * 2, 100)),
+        # Abrupt disconnects at the end of a run are logged as warnings
+        "--log-level", "ERROR",
+        *shlex.split(args.server_args)
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + REPLY_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+
+def raise_open_file_limit():
+    """Thousands of users need as many sockets, here and in a spawned server"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_scenario(args):
+    if args.port:
+        sampler = ProcessSampler(args.server_pid) if args.server_pid else None
+        return asyncio.run(LoadRun(args, args.host, args.port, sampler).run())
+
+    workdir = tempfile.mkdtemp(prefix="loadgen-")
+    process = None
+    try:
+        process, port = spawn_server(args, workdir)
+        run = LoadRun(args, "127.0.0.1", port, ProcessSampler(process.pid))
+        return asyncio.run(run.run())
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def report(name, args, result):
+    print(f"\n{name}: {result['connected']}/{result['users']} users in {result['rooms']} "
+          f"rooms ({result['room_dist']}), {result['rate']} actions/user/s, "
+          f"{args.mode} server, codec {result['codec']}")
+    print(f"  setup {result['setup_seconds']:.1f}s, traffic {result['duration']:.1f}s")
+
+    sent = ", ".join(f"{k} {v}" for k, v in sorted(result["sent"].items()))
+    print(f"  sent      {result['sent_per_second']:9.1f}/s  ({sent})")
+    print(f"  received  {result['received_per_second']:9.1f}/s  "
+          f"({sum(result['received'].values())} frames)")
+
+    print(f"  {'latency (ms)':<16}{'count':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for label, s in result["latency_ms"].items():
+        print(f"  {label:<16}{s['count']:>8}{s['p50']:>9.2f}{s['p90']:>9.2f}"
+              f"{s['p99']:>9.2f}{s['max']:>9.2f}")
+
+    server = result.get("server")
+    if server:
+        print(f"  server    CPU {server['cpu_percent']:.0f}% of a core, "
+              f"RSS {server['rss_mb']:.0f} MB (peak {server['peak_rss_mb']:.0f} MB), "
+              f"{server['threads']} threads")
+    for error, count in sorted(result["errors"].items()):
+        print(f"  ! {error} x{count}")
+
+
+def build_parser(scenario=None):
+    parser = argparse.ArgumentParser(description="Chat server load generator")
+    parser.add_argument("--scenario", choices=SCENARIOS, help="preset workload")
+    parser.add_argument("--suite", action="store_true", help="run every scenario in turn")
+    parser.add_argument("--users", type=int, default=100, help="simulated users")
+    parser.add_argument("--rooms", type=int, default=10, help="rooms the users join")
+    parser.add_argument("--room-dist", choices=("uniform", "zipf"), default="uniform",
+                        help="zipf: a few crowded rooms and a long tail")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="actions per user per second (Poisson arrivals)")
+    parser.add_argument("--mix", default="chat=70,typing=20,read=10",
+                        help="weights of chat, typing, read and upload actions")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of traffic")
+    parser.add_argument("--upload-size", type=int, default=256 * 1024, help="bytes per upload")
+    parser.add_argument("--codec", choices=available_codecs(),
+                        help="offer only this codec (default: all available)")
+    parser.add_argument("--login-concurrency", type=int, default=64,
+                        help="users logging in at the same time during setup")
+    parser.add_argument("--seed", type=int, default=1, help="seed for rooms and traffic")
+    parser.add_argument("--json", help="also write the results to this file")
+    target = parser.add_argument_group(
+        "server", "By default a fresh server with a scratch database is started "
+                  "for each run; --port targets one already running"
+    )
+    target.add_argument("--host", default="127.0.0.1")
+    target.add_argument("--port", type=int, help="existing server to load")
+    target.add_argument("--server-pid", type=int,
+                        help="existing server's pid, to report its CPU and memory")
+    target.add_argument("--mode", choices=("threads", "asyncio"), default="threads",
+                        help="mode of the spawned server")
+    target.add_argument("--bcrypt-rounds", type=int, default=4,
+                        help="work factor of the spawned server (setup speed)")
+    target.add_argument("--server-args", default="",
+                        help="extra run_server.py flags for the spawned server")
+    if scenario:
+        parser.set_defaults(**SCENARIOS[scenario])
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    names = list(SCENARIOS) if args.suite else [args.scenario]
+
+    raise_open_file_limit()
+    results = {}
+    for name in names:
+        # Scenario settings are defaults: explicit flags still apply
+        args = build_parser(name).parse_args()
+        results[name or "custom"] = result = run_scenario(args)
+        report(name or "custom", args, result)
+
+    if len(results) > 1:
+        print(f"\n{'scenario':<12}{'users':>7}{'sent/s':>10}{'recv/s':>10}"
+              f"{'chat p50':>10}{'chat p99':>10}{'cpu %':>8}")
+        for name, result in results.items():
+            chat = result["latency_ms"].get("chat delivery", {})
+            cpu = result.get("server", {}).get("cpu_percent", 0)
+            print(f"{name:<12}{result['connected']:>7}{result['sent_per_second']:>10.1f}"
+                  f"{result['received_per_second']:>10.1f}{chat.get('p50', 0):>10.2f}"
+                  f"{chat.get('p99', 0):>10.2f}{cpu:>8.0f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
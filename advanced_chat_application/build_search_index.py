@@ -0,0 +1,25 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import database
+from server.search import index_room
+
+parser = argparse.ArgumentParser(
+    description="Add messages saved before search existed to the search index"
+)
+parser.add_argument("rooms", nargs="*", help="rooms to index (default: every room)")
+parser.add_argument("--db", help="database path (default: the server's)")
+args = parser.parse_args()
+
+if args.db:
+    database.DB_PATH = args.db
+
+database.init_db()
+
+for room in args.rooms or database.list_rooms():
+    start = time.perf_counter()
+    count = index_room(room)
+    print(f"✓ {room}: {count} message(s) indexed in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,112 @@
+import sys
+import os
+import base64
+import socket
+import tempfile
+import threading
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import database
+from server import server as chat_server
+from server.crypto import encrypt_file, encrypt_message
+from client.socket_client import ChatClient
+
+# Attachment access check: a download is only served to clients in the
+# attachment's room, including attachments saved before they recorded
+# their room (those take the room of their message).
+
+TIMEOUT = 10.0
+
+failures = []
+
+
+def check(name, ok):
+    print(f"{'✓' if ok else '✗'} {name}")
+    if not ok:
+        failures.append(name)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def connect(port, username, room):
+    client = ChatClient("127.0.0.1", port)
+    ok, msg = client.authenticate(username, "secret123", "register")
+    if not ok:
+        raise RuntimeError(f"{username}: {msg}")
+    client.join_room(room)
+    client.sock.settimeout(TIMEOUT)
+    return client
+
+
+def download(client, message_id):
+    """Type of the server's answer to a download: download_range or download_error"""
+    client.download_range(message_id)
+    while True:
+        frame = client.recv()
+        if frame is None:
+            return None
+        if frame.get("type") in ("download_range", "download_error"):
+            return frame["type"]
+
+
+def save_legacy_attachment(room, message_id, data):
+    """An inline attachment row from before attachments had a room column"""
+    database.save_message(room, "alice", encrypt_message(room, "file"), message_id)
+    with database.room_db(room) as conn:
+        conn.execute("""
+            INSERT INTO attachments (message_id, filename, file_type, file_data, file_size)
+            VALUES (?, 'old.txt', 'text/plain', ?, ?)
+        """, (message_id, encrypt_file(room, data), len(data)))
+        conn.commit()
+
+
+def main():
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "attachments_check.db")
+    port = free_port()
+    chat_server.HOST = "127.0.0.1"
+    threading.Thread(target=chat_server.start_server, kwargs={"port": port}, daemon=True).start()
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    alice = connect(port, "alice", "room-a")
+    bob = connect(port, "bob", "room-b")
+
+    alice.send({
+        "type": "upload", "message_id": "new-file", "filename": "new.txt",
+        "file_type": "text/plain", "file_data": base64.b64encode(b"new contents").decode()
+    })
+    save_legacy_attachment("room-a", "old-file", b"old contents")
+    time.sleep(0.5)  # let the upload land
+
+    print("\nDownloads")
+    check("an attachment downloads in its own room",
+          download(alice, "new-file") == "download_range")
+    check("an attachment without a room downloads in its message's room",
+          download(alice, "old-file") == "download_range")
+    check("an attachment is refused from another room",
+          download(bob, "new-file") == "download_error")
+    check("an attachment without a room is refused from another room",
+          download(bob, "old-file") == "download_error")
+
+    print("\n" + "="*50)
+    if failures:
+        print(f"{len(failures)} check(s) failed:")
+        for name in failures:
+            print(f"  - {name}")
+        sys.exit(1)
+    else:
+        print("All attachment checks passed.")
+
+
+if __name__ == "__main__":
+    main()
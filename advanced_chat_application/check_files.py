@@ -11,8 +11,30 @@ required_files = [
     "server/database.py",
     "server/auth.py",
     "server/crypto.py",
+    "server/async_server.py",
+    "server/outbound.py",
+    "server/write_behind.py",
+    "server/message_log.py",
+    "server/room_cache.py",
+    "server/ratelimit.py",
+    "server/transfers.py",
+    "server/blob_store.py",
+    "server/rekey.py",
+    "server/typing_tracker.py",
+    "server/read_receipts.py",
+    "server/bus.py",
+    "server/presence.py",
+    "server/metrics.py",
+    "server/search.py",
+    "server/maintenance.py",
+    "server/reshard.py",
+    "protocol/__init__.py",
+    "protocol/codec.py",
+    "protocol/chunks.py",
     "client/__init__.py",
     "client/socket_client.py",
+    "client/transfers.py",
+    "client/presence.py",
     "client/login_ui.py",
     "client/room_ui.py",
     "client/chat_ui.py"
@@ -0,0 +1,176 @@
+import sys
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from client.socket_client import ChatClient
+
+# Multi-process integration check: several server processes sharing
+# rooms over the message bus, on one machine.
+#   1. two servers on their own ports, so clients land on a known one
+#   2. run_server.py --workers 3, all on one port via SO_REUSEPORT
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+TIMEOUT = 10.0
+
+failures = []
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start(*args):
+    """A run_server.py process; returns once it accepts connections"""
+    port = int(args[args.index("--port") + 1])
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(APP_DIR, "run_server.py"), *args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            time.sleep(0.5)  # let every worker reach the bus
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+class Member:
+    """A connected client that records every frame it receives"""
+
+    def __init__(self, port, username, room):
+        self.client = ChatClient("127.0.0.1", port)
+        ok, msg = self.client.authenticate(username, "secret123", "register")
+        if not ok:
+            raise RuntimeError(f"{username}: {msg}")
+        self.username = username
+        self.frames = []
+        self.client.join_room(room)
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def _receive(self):
+        while True:
+            frame = self.client.recv()
+            if frame is None:
+                return
+            if frame.get("type") == "presence" and self.client.presence.apply(frame) is None:
+                self.client.request_presence()
+            self.frames.append(frame)
+
+    def members(self):
+        return sorted(self.client.presence.members)
+
+    def of_type(self, frame_type):
+        return [f for f in self.frames if f.get("type") == frame_type]
+
+    def close(self):
+        self.client.sock.shutdown(socket.SHUT_RDWR)
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def check(name, ok):
+    print(f"{'✓' if ok else '✗'} {name}")
+    if not ok:
+        failures.append(name)
+
+
+def run_scenario(label, ports, prefix):
+    """Clients spread over `ports` share one room"""
+    print(f"\n{label}")
+    room = f"{prefix}-room"
+    members = [Member(ports[i % len(ports)], f"{prefix}{i}", room) for i in range(6)]
+    names = sorted(m.username for m in members)
+
+    last = members[-1]
+    check("joins are seen on every process", wait_for(
+        lambda: all(m.members() == names for m in members)
+    ))
+
+    for member in members:
+        member.client.send_message(f"hello from {member.username}", f"{member.username}-m")
+    check("every client receives every message", wait_for(
+        lambda: all(len(m.of_type("chat")) == len(members) for m in members)
+    ))
+
+    members[0].client.edit_message(f"{members[0].username}-m", "edited")
+    check("edits reach every client", wait_for(
+        lambda: all(m.of_type("message_edited") for m in members)
+    ))
+
+    # Served from the joiner's room cache, which followed the bus
+    latecomer = Member(ports[-1], f"{prefix}late", room)
+    history = wait_for(lambda: latecomer.of_type("history")) and latecomer.of_type("history")[0]
+    texts = sorted(m["message"] for m in history["messages"]) if history else []
+    check("history on another process includes every message and the edit",
+          len(texts) == len(members) and "edited" in texts)
+
+    members[0].close()
+    check("leaving is seen on every process", wait_for(
+        lambda: members[0].username not in last.members()
+    ))
+    return members + [latecomer]
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+    db = os.path.join(workdir, "chat.db")
+    bus = os.path.join(workdir, "bus.sock")
+    processes = []
+
+    try:
+        port_a, port_b = free_port(), free_port()
+        processes.append(start("--port", str(port_a), "--db", db, "--bus", bus, "--run-bus"))
+        server_b = start("--port", str(port_b), "--db", db, "--bus", bus)
+        processes.append(server_b)
+
+        members = run_scenario(f"Two servers, ports {port_a} and {port_b}", [port_a, port_b], "two")
+
+        server_b.kill()
+        on_a = members[2]  # members alternate between the two servers
+        check("users of a crashed process leave the room", wait_for(
+            lambda: members[1].username not in on_a.members()
+        ))
+
+        port_c = free_port()
+        processes.append(start("--port", str(port_c), "--db", db, "--workers", "3",
+                               "--bus", os.path.join(workdir, "workers.sock")))
+        run_scenario(f"run_server.py --workers 3, port {port_c}", [port_c], "many")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    print("\n" + "="*50)
+    if failures:
+        print(f"{len(failures)} check(s) failed:")
+        for name in failures:
+            print(f"  - {name}")
+        sys.exit(1)
+    else:
+        print("All multi-process checks passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import database
+
+# Check a fresh schema unless a database path is given
+if len(sys.argv) > 1:
+    database.DB_PATH = sys.argv[1]
+else:
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "plan_check.db")
+
+print("Checking query plans...\n")
+
+database.init_db()
+slow = database.find_slow_query_plans()
+
+for name, (sql, params) in database.HOT_QUERIES.items():
+    plan = " | ".join(database.explain_query_plan(sql, params))
+    mark = "✗" if name in slow else "✓"
+    print(f"{mark} {name}: {plan}")
+
+print("\n" + "="*50)
+if slow:
+    print(f"{len(slow)} quer{'y' if len(slow) == 1 else 'ies'} without index support:")
+    for name in slow:
+        print(f"  - {name}")
+    sys.exit(1)
+else:
+    print("All hot queries use indexes.")
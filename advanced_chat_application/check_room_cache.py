@@ -0,0 +1,92 @@
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import database, message_log
+from server.crypto import encrypt_message
+from server.room_cache import room_cache
+from server.server import build_history_page, hold_room_cache, update_room_cache
+
+# Room cache consistency check: a join that reads a room while one of its
+# messages is still queued in front of the database (write-behind or the
+# message log) must not leave a cached page without that message.
+
+failures = []
+
+
+def check(name, ok):
+    print(f"{'✓' if ok else '✗'} {name}")
+    if not ok:
+        failures.append(name)
+
+
+def send(room, text):
+    """What handle_chat_message does: save, then update the cache"""
+    message_id = f"{room}-{text}"
+    database.save_message(room, "alice", encrypt_message(room, text), message_id)
+    update_room_cache("append", room, message={
+        "sender": "alice", "message": text, "message_id": message_id,
+        "timestamp": "00:00", "reply_to": None, "edited": False
+    })
+
+
+def texts(room):
+    return [m["message"] for m in build_history_page(room, 50)["messages"]]
+
+
+def run_scenario(label, room, drain):
+    print(f"\n{label}")
+    send(room, "first")
+    drain()
+    check("a committed message is in history", texts(room) == ["first"])
+    room_cache.invalidate(room)
+
+    send(room, "second")
+    texts(room)  # a join while "second" is queued
+    check("the room is not cached while a message is queued",
+          room_cache.get_page(room, 50) is None)
+
+    drain()
+    check("history includes the message once it is committed",
+          texts(room) == ["first", "second"])
+    hits = room_cache.hits
+    check("the page read after the commit is cached and complete",
+          texts(room) == ["first", "second"] and room_cache.hits == hits + 1)
+
+    send(room, "third")
+    check("a cached room follows queued messages", texts(room) == ["first", "second", "third"])
+    drain()
+
+
+def main():
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "cache_check.db")
+    database.init_db()
+    database.watch_queued_writes(hold_room_cache)
+
+    # Long batch intervals keep each write queued for the joins above
+    queue = database.enable_write_behind(interval_ms=500)
+    run_scenario("Write-behind", "wb-room", queue.flush)
+    database.disable_write_behind()
+
+    if message_log.msgpack is not None:
+        message_log.INDEX_INTERVAL_MS = 500
+        database.MESSAGE_LOG_MODE = "async"
+        database.open_message_log()
+        run_scenario("Message log", "log-room", database._message_log.flush)
+        database.close_message_log()
+    else:
+        print("\nMessage log: skipped (msgpack is not installed)")
+
+    print("\n" + "="*50)
+    if failures:
+        print(f"{len(failures)} check(s) failed:")
+        for name in failures:
+            print(f"  - {name}")
+        sys.exit(1)
+    else:
+        print("All room cache checks passed.")
+
+
+if __name__ == "__main__":
+    main()
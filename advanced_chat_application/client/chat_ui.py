@@ -1,11 +1,20 @@
 # client/chat_ui.py
 import tkinter as tk
-from tkinter import messagebox, filedialog, scrolledtext
+from tkinter import messagebox, filedialog, scrolledtext, simpledialog
 import threading
 import uuid
-import base64
 import os
 from datetime import datetime
+from client.transfers import TransferManager, MAX_ATTACHMENT_SIZE
+
+# Read receipts wait this long so a burst of messages is acknowledged once
+READ_RECEIPT_DELAY_MS = 500
+
+# Joins or leaves in one presence update beyond this are summarised
+PRESENCE_NAMES_SHOWN = 3
+
+# Readers of the newest message named before they are only counted
+SEEN_NAMES_SHOWN = 2
 
 
 class ChatWindow:
@@ -15,9 +24,24 @@ class ChatWindow:
         self.client = client
         self.room = room
         self.messages = {}  # message_id -> message info
-        self.typing_users = []
+        self.attachments = {}  # message_id -> filename
+        self.transfers = TransferManager(client)
+        self.typing_users = set()
         self.selected_message = None  # For reply/edit/delete
         self.last_typing_time = 0
+        self.read_up_to = {}  # username -> last message they have read
+        self.newest_message_id = None  # newest message shown, for "Seen by"
+        self.unacked_read = None  # newest message shown but not yet acknowledged
+
+        # Scroll-back state: cursor of the oldest loaded history page
+        self.history_cursor = None
+        self.has_more_history = False
+        self.loading_history = False
+
+        # Open search results: query and cursor of the oldest hit shown
+        self.search_window = None
+        self.search_query = None
+        self.search_cursor = None
 
         self.root = tk.Tk()
         self.root.title(f"Chat Room – {room}")
@@ -75,20 +99,32 @@ class ChatWindow:
             bd=0
         ).pack(side="left", padx=5)
 
+        tk.Button(
+            btn_frame,
+            text="🔍",
+            font=("Segoe UI", 16),
+            bg="#075e54",
+            fg="white",
+            relief="flat",
+            cursor="hand2",
+            command=self.search_messages,
+            bd=0
+        ).pack(side="left", padx=5)
+
         # ===== CHAT AREA =====
         chat_container = tk.Frame(self.root, bg="#ece5dd")
         chat_container.pack(fill="both", expand=True)
 
         # Scrollbar
-        scrollbar = tk.Scrollbar(chat_container)
-        scrollbar.pack(side="right", fill="y")
+        self.scrollbar = tk.Scrollbar(chat_container)
+        self.scrollbar.pack(side="right", fill="y")
 
         # Chat text widget
         self.chat = tk.Text(
             chat_container,
             state="disabled",
             wrap="word",
-            yscrollcommand=scrollbar.set,
+            yscrollcommand=self.on_chat_scroll,
             bg="#ece5dd",
             font=("Segoe UI", 10),
             cursor="arrow",
@@ -96,7 +132,7 @@ class ChatWindow:
             pady=10
         )
         self.chat.pack(side="left", fill="both", expand=True)
-        scrollbar.config(command=self.chat.yview)
+        self.scrollbar.config(command=self.chat.yview)
 
         # Configure text tags for message bubbles
         self.chat.tag_config(
@@ -172,6 +208,19 @@ class ChatWindow:
         )
         self.typing_label.pack(fill="x")
 
+        # Who has read up to the newest message
+        self.seen_label = tk.Label(
+            self.root,
+            text="",
+            bg="#ece5dd",
+            fg="gray",
+            font=("Segoe UI", 9),
+            anchor="e",
+            padx=15,
+            height=1
+        )
+        self.seen_label.pack(fill="x", before=self.typing_label)
+
         # ===== REPLY BAR (hidden by default) =====
         self.reply_frame = tk.Frame(self.root, bg="#d1f4cc", height=40)
         self.reply_label = tk.Label(
@@ -234,6 +283,7 @@ class ChatWindow:
         self.context_menu.add_command(label="Edit", command=self.edit_message)
         self.context_menu.add_command(label="Delete", command=self.delete_message)
         self.context_menu.add_command(label="Copy", command=self.copy_message)
+        self.context_menu.add_command(label="Save Attachment", command=self.save_attachment)
 
         self.chat.bind("<Button-3>", self.show_context_menu)
 
@@ -241,8 +291,13 @@ class ChatWindow:
         """Show right-click context menu"""
         # Get clicked position
         index = self.chat.index(f"@{event.x},{event.y}")
-        
-        # Find message at this position (simplified)
+
+        # Find message at this position from its msg: tag
+        for tag in self.chat.tag_names(index):
+            if tag.startswith("msg:"):
+                self.selected_message = tag[len("msg:"):]
+                break
+
         self.context_menu.post(event.x_root, event.y_root)
 
     def reply_to_message(self):
@@ -286,6 +341,47 @@ class ChatWindow:
                 self.root.clipboard_clear()
                 self.root.clipboard_append(msg_info['text'])
 
+    def search_messages(self):
+        """Ask for words to search the room's history for"""
+        query = simpledialog.askstring("Search", "Find messages containing:", parent=self.root)
+        if query and query.strip():
+            self.client.search(query.strip())
+
+    def show_search_results(self, data):
+        """Show a page of search hits; older pages are appended"""
+        window = self.search_window
+        if data.get("before") is None or window is None or not window.winfo_exists():
+            if window is not None and window.winfo_exists():
+                window.destroy()
+            window = self.search_window = tk.Toplevel(self.root)
+            window.title(f"Search – {data.get('query')}")
+            window.geometry("500x400")
+            self.search_text = scrolledtext.ScrolledText(
+                window, state="disabled", wrap="word", font=("Segoe UI", 10)
+            )
+            self.search_text.pack(fill="both", expand=True)
+            self.search_more = tk.Button(
+                window, text="Older results", command=self.load_more_results
+            )
+            self.search_more.pack(pady=5)
+
+        results = data.get("results", [])
+        self.search_text.config(state="normal")
+        if not results and data.get("before") is None:
+            self.search_text.insert("end", "No messages found\n")
+        for hit in results:
+            self.search_text.insert(
+                "end", f"[{hit['timestamp']}] {hit['sender']}: {hit['message']}\n\n"
+            )
+        self.search_text.config(state="disabled")
+
+        self.search_query = data.get("query")
+        self.search_cursor = data.get("cursor")
+        self.search_more.config(state="normal" if data.get("has_more") else "disabled")
+
+    def load_more_results(self):
+        self.client.search(self.search_query, before=self.search_cursor)
+
     def on_typing(self, event=None):
         """Handle typing events"""
         import time
@@ -294,9 +390,17 @@ class ChatWindow:
         text = self.entry.get("1.0", "end-1c").strip()
         self.send_btn.config(state="normal" if text else "disabled")
 
-        # Send typing indicator (throttled)
+        # Send typing indicator (throttled); the server only tells the
+        # room when we start or stop, so refreshes cost nobody a frame
         current_time = time.time()
-        if current_time - self.last_typing_time > 2:
+        if not text:
+            if self.last_typing_time:
+                self.last_typing_time = 0
+                try:
+                    self.client.send_typing_indicator(False)
+                except:
+                    pass
+        elif current_time - self.last_typing_time > 2:
             self.last_typing_time = current_time
             try:
                 self.client.send_typing_indicator(True)
@@ -316,6 +420,7 @@ class ChatWindow:
             self.client.send_message(text, message_id, reply_to)
             self.entry.delete("1.0", "end")
             self.send_btn.config(state="disabled")
+            self.last_typing_time = 0  # the server ends our typing on send
             self.cancel_reply()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send message:\n{e}")
@@ -334,31 +439,65 @@ class ChatWindow:
         if not file_path:
             return
 
-        # Check file size (limit to 5MB)
         file_size = os.path.getsize(file_path)
-        if file_size > 5 * 1024 * 1024:
-            messagebox.showerror("Error", "File too large (max 5MB)")
+        if file_size > MAX_ATTACHMENT_SIZE:
+            messagebox.showerror(
+                "Error", f"File too large (max {MAX_ATTACHMENT_SIZE // (1024 * 1024)}MB)"
+            )
             return
 
-        try:
-            with open(file_path, "rb") as f:
-                file_data = f.read()
+        filename = os.path.basename(file_path)
+        message_id = str(uuid.uuid4())
+
+        def on_done(ok, msg):
+            self.root.after(0, lambda: self.on_upload_done(ok, msg, filename, message_id))
 
-            filename = os.path.basename(file_path)
-            file_type = os.path.splitext(filename)[1]
-            file_data_b64 = base64.b64encode(file_data).decode()
+        try:
+            # Streamed in chunks; the chat message follows once it is stored
+            self.transfers.upload(file_path, message_id, on_done)
+            self.show_system_message(f"Uploading {filename}...")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to send file:\n{e}")
 
-            message_id = str(uuid.uuid4())
-            self.client.upload_file(message_id, filename, file_type, file_data_b64)
+    def on_upload_done(self, ok, msg, filename, message_id):
+        """Announce a finished upload with a chat message"""
+        if not ok:
+            messagebox.showerror("Error", f"Failed to send file:\n{msg}")
+            return
 
-            # Send a message about the file
+        try:
             self.client.send_message(f"📎 {filename}", message_id)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to send message:\n{e}")
 
+    def save_attachment(self):
+        """Download the selected message's attachment"""
+        filename = self.attachments.get(self.selected_message)
+        if not filename:
+            # Attachments from history are only known by their chat message
+            text = self.messages.get(self.selected_message, {}).get("text", "")
+            if not text.startswith("📎 "):
+                return
+            filename = text[len("📎 "):]
+
+        dest = filedialog.asksaveasfilename(title="Save attachment", initialfile=filename)
+        if not dest:
+            return
+
+        def on_done(ok, msg):
+            self.root.after(0, lambda: self.show_system_message(msg))
+
+        try:
+            self.transfers.download(self.selected_message, dest, on_done)
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to send file:\n{e}")
+            messagebox.showerror("Error", f"Failed to download file:\n{e}")
+
+    def display_message(self, sender, text, message_id, timestamp, is_me, reply_to=None, edited=False, index="end"):
+        """Display a message in the chat (at `index`, the end by default)"""
+        # History pages can overlap messages already received live
+        if message_id in self.messages:
+            return
 
-    def display_message(self, sender, text, message_id, timestamp, is_me, reply_to=None, edited=False):
-        """Display a message in the chat"""
         self.chat.config(state="normal")
 
         # Store message info
@@ -369,32 +508,103 @@ class ChatWindow:
             "is_me": is_me
         }
 
-        # Display sender name
         tag = "sender_me" if is_me else "sender_other"
-        self.chat.insert("end", f"{sender}\n", (tag,))
-
-        # Display message text
         bubble_tag = "bubble_me" if is_me else "bubble_other"
-        self.chat.insert("end", f"{text}\n", (bubble_tag,))
 
-        # Display timestamp and edited indicator
+        # Timestamp and edited indicator
         timestamp_text = timestamp
         if edited:
             timestamp_text += " (edited)"
-        self.chat.insert("end", f"{timestamp_text}\n\n", ("timestamp",))
+
+        # Sender name, message text and timestamp in one insert
+        msg_tag = f"msg:{message_id}"
+        self.chat.insert(
+            index,
+            f"{sender}\n", (tag, msg_tag),
+            f"{text}\n", (bubble_tag, msg_tag),
+            f"{timestamp_text}\n\n", ("timestamp", msg_tag)
+        )
 
         self.chat.config(state="disabled")
-        self.chat.see("end")
+        if index == "end":
+            self.chat.see("end")
+
+        # Older history pages are behind the read watermark already
+        if index == "end":
+            self.newest_message_id = message_id
+            self.update_seen_label()
+            self.mark_read(message_id)
+
+    def mark_read(self, message_id):
+        """Acknowledge messages up to `message_id`, debounced"""
+        if self.unacked_read is None:
+            self.root.after(READ_RECEIPT_DELAY_MS, self.send_read_receipt)
+        self.unacked_read = message_id
+
+    def send_read_receipt(self):
+        message_id, self.unacked_read = self.unacked_read, None
+        try:
+            self.client.mark_read_up_to(message_id)
+        except:
+            pass
+
+    def display_history(self, data):
+        """Prepend a page of older messages from a `history` frame"""
+        initial = data.get("before") is None
+        self.history_cursor = data.get("cursor")
+        self.has_more_history = data.get("has_more", False)
+        self.loading_history = False
+
+        # Remember the current top line so the view does not jump
+        self.chat.mark_set("history_anchor", "1.0")
+        self.chat.mark_gravity("history_anchor", "right")
+
+        # Inserting at the top in reverse keeps the page in order
+        for msg in reversed(data.get("messages", [])):
+            self.display_message(
+                msg["sender"],
+                msg["message"],
+                msg["message_id"],
+                msg["timestamp"],
+                msg["sender"] == self.client.username,
+                reply_to=msg.get("reply_to"),
+                edited=msg.get("edited", False),
+                index="1.0"
+            )
+
+        if initial:
+            self.chat.see("end")
+            messages = data.get("messages")
+            if messages:
+                self.newest_message_id = messages[-1]["message_id"]
+                self.update_seen_label()
+                self.mark_read(messages[-1]["message_id"])
+        else:
+            self.chat.yview("history_anchor")
 
-        # Mark as read
-        if not is_me:
-            try:
-                self.client.mark_as_read(message_id)
-            except:
-                pass
+    def on_chat_scroll(self, first, last):
+        """Scrollbar callback; loads the previous page at the top"""
+        self.scrollbar.set(first, last)
+
+        if float(first) <= 0.0 and self.has_more_history and not self.loading_history:
+            self.load_older_messages()
+
+    def load_older_messages(self):
+        """Ask the server for the page before the oldest loaded message"""
+        self.loading_history = True
+        try:
+            self.client.request_history(self.history_cursor)
+        except Exception:
+            self.loading_history = False
+
+    def update_typing_indicator(self, username, is_typing):
+        """Apply one user's typing change and update the indicator"""
+        if is_typing:
+            self.typing_users.add(username)
+        else:
+            self.typing_users.discard(username)
 
-    def update_typing_indicator(self, users):
-        """Update typing indicator"""
+        users = sorted(self.typing_users)
         if not users:
             self.typing_label.config(text="")
         elif len(users) == 1:
@@ -404,6 +614,24 @@ class ChatWindow:
         else:
             self.typing_label.config(text=f"{len(users)} people are typing...")
 
+    def update_read_receipts(self, read_up_to):
+        """Apply a room's read watermarks and refresh the seen label"""
+        self.read_up_to.update(read_up_to)
+        self.update_seen_label()
+
+    def update_seen_label(self):
+        """Name who has read up to the newest message"""
+        readers = sorted(
+            username for username, message_id in self.read_up_to.items()
+            if message_id == self.newest_message_id and username != self.client.username
+        )
+        if not readers:
+            self.seen_label.config(text="")
+        elif len(readers) <= SEEN_NAMES_SHOWN:
+            self.seen_label.config(text=f"✓✓ Seen by {' and '.join(readers)}")
+        else:
+            self.seen_label.config(text=f"✓✓ Seen by {len(readers)} people")
+
     def start_receive_thread(self):
         """Start background thread to receive messages"""
         threading.Thread(target=self.receive_loop, daemon=True).start()
@@ -417,6 +645,9 @@ class ChatWindow:
                     self.root.after(0, self.on_disconnected)
                     break
 
+                if self.transfers.handle(data):
+                    continue
+
                 msg_type = data.get("type")
 
                 if msg_type == "chat":
@@ -434,34 +665,37 @@ class ChatWindow:
                         )
                     )
 
-                elif msg_type == "typing":
-                    users = data.get("users", [])
-                    self.root.after(0, lambda: self.update_typing_indicator(users))
+                elif msg_type == "history":
+                    self.root.after(0, lambda d=data: self.display_history(d))
+
+                elif msg_type == "search_results":
+                    self.root.after(0, lambda d=data: self.show_search_results(d))
 
-                elif msg_type == "user_joined":
-                    username = data["username"]
-                    users = data["users"]
+                elif msg_type == "read_receipts":
                     self.root.after(
-                        0,
-                        lambda: self.status_label.config(text=f"🟢 {len(users)} online")
+                        0, lambda r=data.get("read_up_to", {}): self.update_read_receipts(r)
                     )
-                    if username != self.client.username:
+
+                elif msg_type == "typing":
+                    username = data.get("username")
+                    if username and username != self.client.username:
                         self.root.after(
                             0,
-                            lambda: self.show_system_message(f"{username} joined")
+                            lambda u=username, t=bool(data.get("typing")):
+                                self.update_typing_indicator(u, t)
                         )
 
-                elif msg_type == "user_left":
-                    username = data["username"]
-                    users = data["users"]
-                    self.root.after(
-                        0,
-                        lambda: self.status_label.config(text=f"🟢 {len(users)} online")
-                    )
-                    self.root.after(
-                        0,
-                        lambda: self.show_system_message(f"{username} left")
-                    )
+                elif msg_type == "presence":
+                    changes = self.client.presence.apply(data)
+                    if changes is None:
+                        self.client.request_presence()
+                    elif changes[0] or changes[1]:
+                        self.root.after(
+                            0, lambda j=changes[0], l=changes[1]: self.update_presence(j, l)
+                        )
+
+                elif msg_type == "file_attached":
+                    self.attachments[data["message_id"]] = data["filename"]
 
                 elif msg_type == "message_edited":
                     # Handle message edit
@@ -475,6 +709,17 @@ class ChatWindow:
                 print(f"Receive error: {e}")
                 break
 
+    def update_presence(self, joined, left):
+        """Show the member count and who joined or left"""
+        self.status_label.config(text=f"🟢 {len(self.client.presence.members)} online")
+        joined = [u for u in joined if u != self.client.username]
+        for names, verb in ((joined, "joined"), (left, "left")):
+            if len(names) > PRESENCE_NAMES_SHOWN:
+                self.show_system_message(f"{len(names)} people {verb}")
+            else:
+                for username in names:
+                    self.show_system_message(f"{username} {verb}")
+
     def show_system_message(self, text):
         """Show system message (user joined/left, etc.)"""
         self.chat.config(state="normal")
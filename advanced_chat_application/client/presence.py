@@ -0,0 +1,52 @@
+# client/presence.py
+
+
+class RoomPresence:
+    """
+    Members of the joined room, built from the server's version-stamped
+    presence frames: a full member list (`users`) on join, on request and
+    now and then, and `joined`/`left` deltas in between. A delta must
+    carry the next version; one that skips ahead means a frame was lost,
+    and the member list has to be requested again.
+    """
+
+    def __init__(self):
+        self.room = None
+        self.version = 0
+        self.members = set()
+
+    def reset(self, room, users, version):
+        self.room = room
+        self.version = version
+        self.members = set(users)
+
+    def apply(self, frame):
+        """
+        Apply a presence frame.
+        Returns: (joined, left) usernames, empty for a stale frame or one
+        for another room; None when a delta was missed.
+        """
+        if frame.get("room") != self.room:
+            return (), ()
+        version = frame.get("version", 0)
+
+        if "users" in frame:
+            if version < self.version:
+                return (), ()
+            users = set(frame["users"])
+            joined, left = users - self.members, self.members - users
+            self.members = users
+            self.version = version
+            return sorted(joined), sorted(left)
+
+        if version <= self.version:
+            return (), ()
+        if version != self.version + 1:
+            return None
+
+        joined = [u for u in frame.get("joined", ()) if u not in self.members]
+        left = [u for u in frame.get("left", ()) if u in self.members]
+        self.members.update(joined)
+        self.members.difference_update(left)
+        self.version = version
+        return joined, left
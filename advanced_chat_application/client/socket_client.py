@@ -1,7 +1,11 @@
 # client/socket_client.py
 import socket
-import json
 import threading
+from collections import deque
+from protocol.codec import JSON, FrameDecoder, available_codecs, get_codec
+from client.presence import RoomPresence
+
+RECV_SIZE = 65536
 
 
 class ChatClient:
@@ -11,7 +15,10 @@ class ChatClient:
         self.host = host
         self.port = port
         self.sock = None
-        self.buffer = ""
+        self.codec = JSON
+        self.decoder = FrameDecoder(JSON)
+        self.pending = deque()  # Frames read early, returned by recv() first
+        self.presence = RoomPresence()  # Members of the joined room
         self.session = None
         self.username = None
         self.connected = False
@@ -29,7 +36,7 @@ class ChatClient:
             return False
 
     def send(self, data):
-        """Send JSON data to server"""
+        """Send data to server"""
         if not self.connected:
             raise ConnectionError("Not connected to server")
 
@@ -39,8 +46,7 @@ class ChatClient:
                 if self.session and "session" not in data:
                     data["session"] = self.session
 
-                payload = json.dumps(data) + "\n"
-                self.sock.sendall(payload.encode())
+                self.sock.sendall(self.codec.encode(data))
                 return True
         except Exception as e:
             print(f"Send error: {e}")
@@ -48,17 +54,21 @@ class ChatClient:
             raise ConnectionError("Server disconnected")
 
     def recv(self):
-        """Receive and parse JSON data from server"""
+        """Receive and decode the next frame from server"""
+        if self.pending:
+            return self.pending.popleft()
+
         try:
-            while "\n" not in self.buffer:
-                chunk = self.sock.recv(4096).decode()
+            while True:
+                frame = self.decoder.next_frame()
+                if frame is not None:
+                    return frame
+
+                chunk = self.sock.recv(RECV_SIZE)
                 if not chunk:
                     self.connected = False
                     return None
-                self.buffer += chunk
-
-            line, self.buffer = self.buffer.split("\n", 1)
-            return json.loads(line.strip())
+                self.decoder.feed(chunk)
 
         except Exception as e:
             print(f"Receive error: {e}")
@@ -78,13 +88,18 @@ class ChatClient:
         self.send({
             "action": action,
             "username": username,
-            "password": password
+            "password": password,
+            "codecs": available_codecs()
         })
 
         response = self.recv()
         if not response:
             return False, "No response from server"
 
+        # Servers without codec negotiation keep JSON lines
+        self.codec = get_codec(response.get("codec"))
+        self.decoder.codec = self.codec
+
         if response.get("ok"):
             self.session = response.get("session")
             self.username = username
@@ -100,9 +115,45 @@ class ChatClient:
             "session": self.session
         })
 
-        # Wait for confirmation
-        response = self.recv()
-        return response.get("ok", False)
+        # Wait for confirmation; room traffic that arrives first is kept
+        # for the chat window
+        while True:
+            response = self.recv()
+            if not response:
+                return False
+            if "ok" in response:
+                if response.get("ok"):
+                    self.presence.reset(
+                        room, response.get("users", ()), response.get("presence_version", 0)
+                    )
+                return response.get("ok", False)
+            self.pending.append(response)
+
+    def request_presence(self):
+        """Ask for the room's member list again (after a missed presence delta)"""
+        self.send({
+            "type": "presence",
+            "session": self.session
+        })
+
+    def request_history(self, before, limit=50):
+        """Request messages older than the `before` cursor of a history page"""
+        self.send({
+            "type": "history",
+            "before": before,
+            "limit": limit,
+            "session": self.session
+        })
+
+    def search(self, query, before=None, limit=20):
+        """Search the room; pass a results page's `cursor` as `before` for more"""
+        self.send({
+            "type": "search",
+            "query": query,
+            "before": before,
+            "limit": limit,
+            "session": self.session
+        })
 
     def send_message(self, message, message_id, reply_to=None):
         """Send a chat message"""
@@ -122,11 +173,11 @@ class ChatClient:
             "session": self.session
         })
 
-    def mark_as_read(self, message_id):
-        """Mark a message as read"""
+    def mark_read_up_to(self, message_id):
+        """Mark a message and every earlier one in the room as read"""
         self.send({
             "type": "read",
-            "message_id": message_id,
+            "up_to": message_id,
             "session": self.session
         })
 
@@ -147,26 +198,46 @@ class ChatClient:
             "session": self.session
         })
 
-    def upload_file(self, message_id, filename, file_type, file_data_b64):
-        """Upload a file attachment"""
+    def upload_init(self, message_id, filename, file_type, size, upload_id=None):
+        """Start a chunked upload, or resume `upload_id`"""
         self.send({
-            "type": "upload",
+            "type": "upload_init",
+            "upload_id": upload_id,
             "message_id": message_id,
             "filename": filename,
             "file_type": file_type,
-            "file_data": file_data_b64,
+            "size": size,
             "session": self.session
         })
 
-    def download_file(self, message_id):
-        """Download a file attachment"""
+    def upload_chunk(self, upload_id, index, data, sha256):
+        """Send one chunk of an upload"""
         self.send({
-            "type": "download",
-            "message_id": message_id,
+            "type": "upload_chunk",
+            "upload_id": upload_id,
+            "index": index,
+            "data": self.codec.pack_bytes(data),
+            "sha256": sha256,
             "session": self.session
         })
 
-        return self.recv()
+    def upload_commit(self, upload_id, sha256):
+        """Finish an upload once all chunks have been sent"""
+        self.send({
+            "type": "upload_commit",
+            "upload_id": upload_id,
+            "sha256": sha256,
+            "session": self.session
+        })
+
+    def download_range(self, message_id, offset=0):
+        """Request the next window of chunks of an attachment"""
+        self.send({
+            "type": "download_range",
+            "message_id": message_id,
+            "offset": offset,
+            "session": self.session
+        })
 
     def close(self):
         """Close ***"""
@@ -0,0 +1,211 @@
+# client/transfers.py
+import os
+import threading
+from protocol.chunks import chunk_hash, tree_hash, read_chunks
+
+# Largest file the server accepts
+MAX_ATTACHMENT_SIZE = 100 * 1024 * 1024
+
+# Times an upload re-sends the chunks the server reports missing
+MAX_UPLOAD_RETRIES = 3
+
+
+class _Upload:
+    def __init__(self, path, message_id, on_done):
+        self.path = path
+        self.message_id = message_id
+        self.on_done = on_done
+        self.filename = os.path.basename(path)
+        self.file_type = os.path.splitext(self.filename)[1]
+        self.size = os.path.getsize(path)
+        self.upload_id = None
+        self.chunk_size = None
+        self.retries = 0
+
+
+class _Download:
+    def __init__(self, message_id, dest, on_done):
+        self.message_id = message_id
+        self.dest = dest
+        self.part = dest + ".part"
+        self.on_done = on_done
+        self.file = None
+        self.hashes = {}
+        self.info = None
+
+
+class TransferManager:
+    """
+    Chunked file uploads and downloads over a ChatClient.
+    The chat window's receive loop passes every frame to handle(); file
+    data is streamed one chunk at a time, so no transfer is ever held
+    in memory whole. on_done(ok, msg) is called from a background thread.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.uploads = {}    # message_id -> _Upload
+        self.downloads = {}  # message_id -> _Download
+        self.handlers = {
+            "upload_ready": self._on_upload_ready,
+            "upload_error": self._on_upload_error,
+            "upload_complete": self._on_upload_complete,
+            "download_range": self._on_download_range,
+            "download_chunk": self._on_download_chunk,
+            "download_error": self._on_download_error,
+        }
+
+    def upload(self, path, message_id, on_done):
+        upload = _Upload(path, message_id, on_done)
+        self.uploads[message_id] = upload
+        self.client.upload_init(message_id, upload.filename, upload.file_type, upload.size)
+
+    def download(self, message_id, dest, on_done):
+        """Download an attachment to `dest`, resuming a leftover .part file"""
+        download = _Download(message_id, dest, on_done)
+        self.downloads[message_id] = download
+        offset = os.path.getsize(download.part) if os.path.exists(download.part) else 0
+        self.client.download_range(message_id, offset)
+
+    def handle(self, data):
+        """Process a transfer frame; returns False for any other frame"""
+        handler = self.handlers.get(data.get("type"))
+        if handler is None:
+            return False
+        handler(data)
+        return True
+
+    # ----- Uploads -----
+
+    def _on_upload_ready(self, data):
+        upload = self.uploads.get(data.get("message_id"))
+        if upload is None:
+            return
+        upload.upload_id = data["upload_id"]
+        upload.chunk_size = data["chunk_size"]
+        self._start_sending(upload, data.get("missing") or ())
+
+    def _start_sending(self, upload, missing):
+        threading.Thread(
+            target=self._send_chunks, args=(upload, set(missing)), daemon=True
+        ).start()
+
+    def _send_chunks(self, upload, missing):
+        """Send the chunks the server is missing, then commit"""
+        try:
+            hashes = []
+            with open(upload.path, "rb") as f:
+                for index, data in read_chunks(f, upload.chunk_size):
+                    digest = chunk_hash(data)
+                    hashes.append(digest)
+                    if index in missing:
+                        self.client.upload_chunk(upload.upload_id, index, data, digest)
+            self.client.upload_commit(upload.upload_id, tree_hash(hashes))
+        except Exception as e:
+            self._finish_upload(upload, False, f"Upload failed: {e}")
+
+    def _on_upload_error(self, data):
+        upload = self._upload_for(data)
+        if upload is None:
+            return
+
+        if data.get("index") is not None:
+            # One rejected chunk; the commit reports it as missing
+            print(f"Chunk {data['index']} rejected: {data.get('msg')}")
+            return
+
+        missing = data.get("missing")
+        if missing and upload.retries < MAX_UPLOAD_RETRIES:
+            upload.retries += 1
+            self._start_sending(upload, missing)
+            return
+
+        self._finish_upload(upload, False, data.get("msg", "Upload failed"))
+
+    def _on_upload_complete(self, data):
+        upload = self._upload_for(data)
+        if upload:
+            self._finish_upload(upload, True, "Upload complete")
+
+    def _upload_for(self, data):
+        """Uploads are keyed by message id; chunk errors only carry the upload id"""
+        upload = self.uploads.get(data.get("message_id"))
+        if upload is None:
+            for candidate in self.uploads.values():
+                if candidate.upload_id == data.get("upload_id"):
+                    return candidate
+        return upload
+
+    def _finish_upload(self, upload, ok, msg):
+        self.uploads.pop(upload.message_id, None)
+        upload.on_done(ok, msg)
+
+    # ----- Downloads -----
+
+    def _on_download_range(self, data):
+        download = self.downloads.get(data.get("message_id"))
+        if download is None:
+            return
+
+        download.info = data
+        if download.file is None:
+            resuming = os.path.exists(download.part)
+            download.file = open(download.part, "r+b" if resuming else "w+b")
+            if resuming:
+                # Hash the chunks kept from the interrupted download
+                for index, chunk in read_chunks(download.file, data["chunk_size"]):
+                    if index >= data["first"]:
+                        break
+                    download.hashes[index] = chunk_hash(chunk)
+
+        if data["count"] == 0:
+            self._finish_download(download)
+
+    def _on_download_chunk(self, data):
+        download = self.downloads.get(data.get("message_id"))
+        if download is None or download.info is None:
+            return
+
+        info = download.info
+        chunk = self.client.codec.unpack_bytes(data["data"])
+        if chunk_hash(chunk) != data["sha256"]:
+            self._fail_download(download, "Corrupted chunk received")
+            return
+
+        index = data["index"]
+        download.file.seek(index * info["chunk_size"])
+        download.file.write(chunk)
+        download.hashes[index] = data["sha256"]
+
+        if index == info["chunks"] - 1:
+            self._finish_download(download)
+        elif index == info["first"] + info["count"] - 1:
+            # End of this window: ask for the next one
+            self.client.download_range(download.message_id, (index + 1) * info["chunk_size"])
+
+    def _on_download_error(self, data):
+        download = self.downloads.get(data.get("message_id"))
+        if download:
+            self._fail_download(download, data.get("msg", "Download failed"))
+
+    def _finish_download(self, download):
+        info = download.info
+        hashes = [download.hashes.get(i) for i in range(info["chunks"])]
+        download.file.truncate(info["size"])
+        download.file.close()
+        self.downloads.pop(download.message_id, None)
+
+        if None in hashes or tree_hash(hashes) != info["sha256"]:
+            os.remove(download.part)
+            download.on_done(False, "Downloaded file failed its checksum")
+            return
+
+        os.replace(download.part, download.dest)
+        download.on_done(True, f"Saved {os.path.basename(download.dest)}")
+
+    def _fail_download(self, download, msg):
+        """Stop a download, keeping the .part file so it can be resumed"""
+        if download.file:
+            download.file.close()
+        self.downloads.pop(download.message_id, None)
+        download.on_done(False, msg)
@@ -0,0 +1,50 @@
+import sys
+import os
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import database
+from server.blob_store import store_chunks, collect_garbage, GC_GRACE_SECONDS
+from server.transfers import AttachmentReader, LEGACY_FILES_DIR
+
+parser = argparse.ArgumentParser(description="Attachment store maintenance")
+parser.add_argument("db", nargs="?", help="database path (default: the server's)")
+parser.add_argument("--migrate", action="store_true",
+                    help="move attachments stored in chat.db into the blob store first")
+parser.add_argument("--grace", type=int, default=GC_GRACE_SECONDS,
+                    help="seconds an unreferenced blob is kept (default: %(default)s)")
+args = parser.parse_args()
+
+if args.db:
+    database.DB_PATH = args.db
+
+database.init_db()
+
+if args.migrate:
+    ids = database.list_unmigrated_attachments()
+    print(f"Migrating {len(ids)} attachment(s)...\n")
+
+    for shard, attachment_id in ids:
+        row = database.get_attachment_by_id(attachment_id, shard)
+        room = row["message_room"]
+        if not room:
+            print(f"✗ {row['filename']}: message not found, room unknown")
+            continue
+
+        reader = AttachmentReader(row, room)
+        blob_id, sha256 = store_chunks(
+            (data for _, data in reader.chunks(0, reader.count)),
+            reader.size, reader.chunk_size
+        )
+        database.set_attachment_blob(
+            attachment_id, room, blob_id, reader.size, reader.chunk_size, sha256
+        )
+        if row["storage_path"]:
+            os.remove(os.path.join(LEGACY_FILES_DIR, row["storage_path"]))
+        print(f"✓ {row['filename']} ({reader.size:,} bytes)")
+
+    print("\nRun VACUUM on the database to give the freed pages back to the OS.")
+
+removed = collect_garbage(args.grace)
+print("\n" + "="*50)
+print(f"Removed {removed} unreferenced file(s).")
@@ -0,0 +1,63 @@
+import sys
+import os
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import database, maintenance
+
+parser = argparse.ArgumentParser(description="chat.db retention, archival and compaction")
+parser.add_argument("--db", help="database path (default: the server's)")
+parser.add_argument("--archive-dir", help="where archived messages go (default: archive/)")
+parser.add_argument("--policy", nargs=2, action="append", metavar=("ROOM", "DAYS"),
+                    help="archive ROOM's messages after DAYS days ('*': every room "
+                         "without its own policy; DAYS 'off': never archive, "
+                         "'default': drop the room's own policy)")
+parser.add_argument("--policies", action="store_true", help="list retention policies")
+parser.add_argument("--segments", action="store_true", help="list archive segment files")
+parser.add_argument("--full-vacuum", action="store_true",
+                    help="rebuild the database once to enable incremental vacuum "
+                         "(locks it throughout: only while no server is running)")
+parser.add_argument("--no-run", action="store_true",
+                    help="only apply the options above, skip the maintenance pass")
+args = parser.parse_args()
+
+if args.db:
+    database.DB_PATH = args.db
+if args.archive_dir:
+    maintenance.ARCHIVE_DIR = args.archive_dir
+
+database.init_db()
+
+for room, days in args.policy or ():
+    if days == "default":
+        database.clear_retention_policy(room)
+        print(f"✓ {room}: default policy")
+    elif days == "off":
+        database.set_retention_policy(room, None)
+        print(f"✓ {room}: never archived")
+    else:
+        database.set_retention_policy(room, int(days))
+        print(f"✓ {room}: archive after {days} day(s)")
+
+if args.policies:
+    print("\nRetention policies:")
+    for room, days in sorted(database.get_retention_policies().items()):
+        print(f"  {room:<20} " + ("never archived" if days is None else f"archive after {days} day(s)"))
+
+if args.segments:
+    print("\nArchive segments:")
+    for segment in database.list_archive_segments():
+        print(f"  {segment['room']:<20} ids {segment['first_id']}-{segment['last_id']} "
+              f"{segment['rows']:>7,} rows {segment['bytes']:>10,} bytes  {segment['path']}")
+
+if args.full_vacuum:
+    before = maintenance.database_bytes()
+    for path in database.shard_paths():
+        database.full_vacuum(path)
+    print(f"\n✓ Rebuilt: {before:,} -> {maintenance.database_bytes():,} bytes, incremental vacuum on")
+
+if not args.no_run:
+    report = maintenance.run_maintenance()
+    print("\n" + "="*50)
+    print(maintenance.format_report(report))
+    print(f"Done in {report['seconds']:.1f}s")
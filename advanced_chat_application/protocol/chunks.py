@@ -0,0 +1,37 @@
+# protocol/chunks.py - Chunk hashing shared by both ends of a file transfer
+import hashlib
+
+
+def chunk_count(size, chunk_size):
+    """Chunks in a file of `size` bytes (an empty file is one empty chunk)"""
+    return max(1, -(-size // chunk_size))
+
+
+def chunk_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def tree_hash(chunk_hashes):
+    """
+    Whole-file digest: sha256 over the per-chunk sha256 digests in order.
+    Unlike a plain sha256 of the file it can be computed from chunks that
+    arrived out of order, as they do when an upload is resumed.
+    """
+    digest = hashlib.sha256()
+    for h in chunk_hashes:
+        digest.update(bytes.fromhex(h))
+    return digest.hexdigest()
+
+
+def read_chunks(f, chunk_size, first=0):
+    """Yield (index, data) for the chunks of an open file from `first` on"""
+    f.seek(first * chunk_size)
+    index = first
+    while True:
+        data = f.read(chunk_size)
+        if not data and index > 0:
+            return
+        yield index, data
+        if len(data) < chunk_size:
+            return
+        index += 1
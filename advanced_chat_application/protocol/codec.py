@@ -0,0 +1,159 @@
+# protocol/codec.py - Wire framing shared by the server and the client
+import base64
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # Optional: falls back to JSON lines
+    msgpack = None
+
+# Newline-delimited JSON: the original protocol, always available
+CODEC_JSON = "json"
+# 4-byte big-endian length prefix followed by a MessagePack body
+CODEC_MSGPACK = "msgpack"
+
+# Largest frame accepted from the network
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+_LENGTH = struct.Struct(">I")
+
+# Consumed bytes are only cut off the front of the buffer past this size
+_COMPACT_THRESHOLD = 64 * 1024
+
+
+class FrameError(Exception):
+    """Raised for malformed or oversized frames"""
+
+
+class JsonLinesCodec:
+    name = CODEC_JSON
+
+    def encode(self, data):
+        return (json.dumps(data) + "\n").encode()
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+    def pack_bytes(self, data):
+        """Binary field value: JSON can only carry it as base64 text"""
+        return base64.b64encode(data).decode()
+
+    def unpack_bytes(self, value):
+        return base64.b64decode(value)
+
+
+class MsgpackCodec:
+    name = CODEC_MSGPACK
+
+    def encode(self, data):
+        body = msgpack.packb(data, use_bin_type=True)
+        return _LENGTH.pack(len(body)) + body
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+    def pack_bytes(self, data):
+        return bytes(data)
+
+    def unpack_bytes(self, value):
+        return value
+
+
+JSON = JsonLinesCodec()
+CODECS = {CODEC_JSON: JSON}
+if msgpack is not None:
+    CODECS[CODEC_MSGPACK] = MsgpackCodec()
+
+
+def available_codecs():
+    """Codec names this side supports, most preferred first"""
+    return [name for name in (CODEC_MSGPACK, CODEC_JSON) if name in CODECS]
+
+
+def get_codec(name):
+    """Look up a codec by name, defaulting to JSON lines"""
+    return CODECS.get(name, JSON)
+
+
+def negotiate(offered):
+    """Pick the first codec from a peer's preference list that we support"""
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return JSON
+
+
+class FrameDecoder:
+    """
+    Incremental frame decoder.
+    Bytes are appended to one bytearray and frames are sliced out by
+    offset, so a large frame arriving in many chunks costs O(size), and
+    multi-byte UTF-8 sequences split across chunks decode correctly.
+    """
+
+    def __init__(self, codec=JSON):
+        self.codec = codec
+        self._buf = bytearray()
+        self._pos = 0    # start of the first unconsumed frame
+        self._scan = 0   # where to resume looking for a newline
+
+    def feed(self, data):
+        self._buf += data
+
+    def next_frame(self):
+        """Return the next complete frame, or None if more bytes are needed"""
+        while True:
+            if self.codec.name == CODEC_JSON:
+                payload = self._next_line()
+            else:
+                payload = self._next_prefixed()
+
+            if payload is None:
+                return None
+            if self.codec.name == CODEC_JSON and not payload.strip():
+                continue  # Blank line
+
+            try:
+                return self.codec.decode(payload)
+            except Exception as e:
+                raise FrameError(f"Undecodable {self.codec.name} frame: {e}")
+
+    def _next_line(self):
+        end = self._buf.find(b"\n", max(self._scan, self._pos))
+        if end < 0:
+            self._scan = len(self._buf)
+            if self._scan - self._pos > MAX_FRAME_SIZE:
+                raise FrameError("Frame exceeds maximum size")
+            return None
+
+        payload = bytes(self._buf[self._pos:end])
+        self._consume(end + 1)
+        return payload
+
+    def _next_prefixed(self):
+        available = len(self._buf) - self._pos
+        if available < _LENGTH.size:
+            return None
+
+        (length,) = _LENGTH.unpack_from(self._buf, self._pos)
+        if length > MAX_FRAME_SIZE:
+            raise FrameError("Frame exceeds maximum size")
+        if available < _LENGTH.size + length:
+            return None
+
+        start = self._pos + _LENGTH.size
+        payload = bytes(self._buf[start:start + length])
+        self._consume(start + length)
+        return payload
+
+    def _consume(self, end):
+        self._pos = end
+        self._scan = end
+        if self._pos == len(self._buf):
+            self._buf.clear()
+            self._pos = self._scan = 0
+        elif self._pos > _COMPACT_THRESHOLD:
+            del self._buf[:self._pos]
+            self._scan -= self._pos
+            self._pos = 0
@@ -0,0 +1,51 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import database
+from server.reshard import reshard, plan_moves, ReshardError
+
+parser = argparse.ArgumentParser(
+    description="Spread rooms over several database files (run with the server stopped)"
+)
+parser.add_argument("shards", nargs="?", type=int,
+                    help="number of shard files to use (1: everything in chat.db)")
+parser.add_argument("--db", help="database path (default: the server's)")
+parser.add_argument("--dry-run", action="store_true", help="only list the rooms that would move")
+args = parser.parse_args()
+
+if args.db:
+    database.DB_PATH = args.db
+
+database.init_db()
+# A crashed server's message log names rooms, not shards: apply it first
+database.open_message_log()
+
+if args.shards is not None:
+    if args.dry_run:
+        moves = plan_moves(list(range(args.shards)))
+        for room, source, target in moves:
+            print(f"  {room:<20} shard {source} -> {target}")
+        print(f"{len(moves)} room(s) would move")
+    else:
+        start = time.perf_counter()
+        try:
+            moves, dropped, removed = reshard(
+                args.shards,
+                on_move=lambda room, source, target, count: print(
+                    f"✓ {room}: {count:,} message(s) shard {source} -> {target}"
+                )
+            )
+        except ReshardError as e:
+            print(f"✗ {e}")
+            sys.exit(1)
+        print(f"\n{len(moves)} room(s) moved, {dropped} old room copies deleted, "
+              f"{removed} unused file(s) removed in {time.perf_counter() - start:.1f}s")
+
+print("\n" + "="*50)
+for shard in database.get_shards():
+    path = database.shard_path(shard)
+    print(f"shard {shard:<3} {len(database.shard_rooms(shard)):>6} room(s) "
+          f"{os.path.getsize(path):>14,} bytes  {path}")
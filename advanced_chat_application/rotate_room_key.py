@@ -0,0 +1,45 @@
+import sys
+import os
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import database
+from server.crypto import rotate_room_key
+from server.rekey import next_rotation, run_rotation, REKEY_IO_BUDGET
+
+parser = argparse.ArgumentParser(description="Room key rotation")
+parser.add_argument("rooms", nargs="*", help="rooms to give a new key")
+parser.add_argument("--all", action="store_true", help="rotate every room with messages")
+parser.add_argument("--db", help="database path (default: the server's)")
+parser.add_argument("--run", action="store_true",
+                    help="re-encrypt now instead of leaving it to the server "
+                         "(only while no server is running)")
+parser.add_argument("--io-budget", type=int, default=REKEY_IO_BUDGET,
+                    help="bytes per second --run may write (default: %(default)s)")
+parser.add_argument("--status", action="store_true", help="list rotations and their progress")
+args = parser.parse_args()
+
+if args.db:
+    database.DB_PATH = args.db
+
+database.init_db()
+
+rooms = database.list_rooms() if args.all else args.rooms
+for room in rooms:
+    version = rotate_room_key(room)
+    print(f"✓ {room}: key version {version}")
+
+if args.run:
+    while True:
+        rotation = next_rotation(min_age=0)
+        if rotation is None:
+            break
+        run_rotation(rotation, args.io_budget)
+        print(f"✓ {rotation['room']}: re-encrypted for key version {rotation['version']}")
+
+if args.status or not (rooms or args.run):
+    print("\n" + "="*50)
+    for rotation in database.list_key_rotations():
+        state = "done" if rotation["finished_at"] else rotation["phase"]
+        print(f"{rotation['room']:<20} v{rotation['version']:<4} {state:<12} "
+              f"{rotation['rewritten']:>8} row(s) rewritten")
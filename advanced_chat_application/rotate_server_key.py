@@ -0,0 +1,75 @@
+import sys
+import os
+import argparse
+import base64
+import hashlib
+import hmac
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cryptography.fernet import Fernet, InvalidToken
+from server import blob_store, crypto, database
+from server.search import index_room
+
+parser = argparse.ArgumentParser(
+    description="Move everything protected by an old server key to the current one "
+                "(run with the server stopped, after a backup)"
+)
+parser.add_argument("--old", required=True,
+                    help="the old key file, e.g. a copy of server/secret.key")
+parser.add_argument("--db", help="database path (default: the server's)")
+parser.add_argument("--secret-key", help="the new key file (created if missing)")
+parser.add_argument("--media-dir", help="attachment directory (default: media/)")
+args = parser.parse_args()
+
+if args.db:
+    database.DB_PATH = args.db
+if args.secret_key:
+    crypto.SECRET_KEY_PATH = args.secret_key
+if args.media_dir:
+    blob_store.use_media_dir(args.media_dir)
+
+database.init_db()
+
+old_secret = crypto.load_secret_key(args.old)
+new_secret = crypto.get_server_secret()
+if old_secret == new_secret:
+    print("✗ The old and the current server key are the same; nothing to do")
+    sys.exit(1)
+old, new = Fernet(old_secret), Fernet(new_secret)
+new_hmac_key = base64.urlsafe_b64decode(new_secret)
+
+rewrapped = renamed = 0
+for table, key, wrapped in database.list_wrapped_keys():
+    try:
+        plain = old.decrypt(wrapped.encode())
+    except InvalidToken:
+        continue  # already under the new key (an interrupted earlier run)
+    wrapped = new.encrypt(plain).decode()
+
+    if table == "room_keys":
+        database.set_room_key_wrapping(*key, wrapped)
+        rewrapped += 1
+        continue
+
+    # Blob ids are keyed too: an unused blob keeps its name until it is collected
+    content_hash = database.blob_content_hash(key)
+    if content_hash is None:
+        database.set_blob_wrapping(key, wrapped)
+        rewrapped += 1
+        continue
+    new_id = hmac.new(new_hmac_key, bytes.fromhex(content_hash), hashlib.sha256).hexdigest()
+    source, target = blob_store.blob_path(key), blob_store.blob_path(new_id)
+    if os.path.exists(source):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+    database.rename_blob(key, new_id, wrapped)
+    renamed += 1
+
+print(f"✓ {rewrapped} key(s) rewrapped, {renamed} blob(s) renamed")
+
+database.clear_search_index()
+for room in database.list_rooms():
+    print(f"✓ {room}: {index_room(room)} message(s) re-indexed for search")
+
+print("\n" + "="*50)
+print(f"Done. Keep {crypto.SECRET_KEY_PATH} safe and delete the old key.")
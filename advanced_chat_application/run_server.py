@@ -3,17 +3,297 @@
 
 import sys
 import os
+import argparse
+import logging
+import multiprocessing
+import shutil
+import tempfile
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from server.server import start_server
+from server import (
+    auth, blob_store, crypto, database, maintenance, message_log, metrics, outbound,
+    rekey, transfers, write_behind
+)
+from server.database import enable_write_behind, init_db, open_message_log
+from server.server import start_server, PORT
+from server.async_server import start_async_server
+from server.bus import BusBroker, SocketBus, use_bus
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Advanced Chat Server")
+    parser.add_argument(
+        "--mode",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="threads: one thread per connection; asyncio: single event loop"
+    )
+    parser.add_argument(
+        "--send-queue-size",
+        type=int,
+        default=outbound.SEND_QUEUE_SIZE,
+        help="frames buffered per client before the slow-consumer policy applies"
+    )
+    parser.add_argument(
+        "--slow-consumer-policy",
+        choices=outbound.POLICIES,
+        default=outbound.SLOW_CONSUMER_POLICY,
+        help="what to do when a client's send queue is full"
+    )
+    parser.add_argument(
+        "--write-behind",
+        choices=("off",) + write_behind.DURABILITY_MODES,
+        default="off",
+        help="batch message/receipt writes into group commits; "
+             "flush_on_ack waits for the commit before acknowledging"
+    )
+    parser.add_argument(
+        "--batch-ms",
+        type=int,
+        default=write_behind.BATCH_INTERVAL_MS,
+        help="write-behind: longest a queued write waits for its batch"
+    )
+    parser.add_argument(
+        "--batch-rows",
+        type=int,
+        default=write_behind.BATCH_MAX_ROWS,
+        help="write-behind: most rows committed per transaction"
+    )
+    parser.add_argument(
+        "--message-log",
+        choices=("off",) + write_behind.DURABILITY_MODES,
+        default="off",
+        help="append message/receipt writes to a log that a background indexer "
+             "applies to the database; flush_on_ack waits for the fsync"
+    )
+    parser.add_argument(
+        "--message-log-dir",
+        help="message log directory (default: next to the database, <name>-log)"
+    )
+    parser.add_argument(
+        "--fsync-ms",
+        type=int,
+        default=message_log.FSYNC_INTERVAL_MS,
+        help="message log: longest an append waits for its fsync"
+    )
+    parser.add_argument(
+        "--bcrypt-rounds",
+        type=int,
+        default=auth.BCRYPT_ROUNDS,
+        help="bcrypt work factor for new password hashes"
+    )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=auth.HASH_WORKERS,
+        help="threads used for password hashing"
+    )
+    parser.add_argument(
+        "--crypto-workers",
+        type=int,
+        default=crypto.CRYPTO_WORKERS,
+        help="threads that split large history decrypt batches (0: off)"
+    )
+    parser.add_argument(
+        "--rekey-io-budget",
+        type=int,
+        default=rekey.REKEY_IO_BUDGET,
+        help="bytes per second the background re-encryption after a key rotation may write"
+    )
+    parser.add_argument(
+        "--maintenance-interval",
+        type=int,
+        default=maintenance.MAINTENANCE_INTERVAL,
+        help="seconds between archival/purge/vacuum passes (0: off)"
+    )
+    parser.add_argument(
+        "--archive-dir",
+        help="where archived messages are written (default: archive/)"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=PORT,
+        help="port to listen on"
+    )
+    parser.add_argument(
+        "--db",
+        help="database path (default: server/chat.db)"
+    )
+    parser.add_argument(
+        "--secret-key",
+        help="server key file, created if missing (default: $CHAT_SECRET_KEY_FILE "
+             "or ~/.config/advanced_chat/secret.key; $CHAT_SECRET_KEY overrides both)"
+    )
+    parser.add_argument(
+        "--media-dir",
+        help="attachment storage directory (default: media/)"
+    )
+    parser.add_argument(
+        "--ip-attempt-rate",
+        type=float,
+        default=auth.IP_ATTEMPT_RATE,
+        help="login/register attempts per second allowed from one address; "
+             "raise it for load tests from a single machine"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="server processes sharing the port (SO_REUSEPORT) and a message bus"
+    )
+    parser.add_argument(
+        "--bus",
+        help="message bus address (Unix socket path or host:port); with one "
+             "worker, joins other servers on this bus"
+    )
+    parser.add_argument(
+        "--run-bus",
+        action="store_true",
+        help="host the message bus broker in this process"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=metrics.METRICS_PORT,
+        help="serve Prometheus metrics on 127.0.0.1:PORT/metrics (0: off); "
+             "worker N uses PORT+N"
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        default="INFO",
+        help="DEBUG logs every frame received; INFO connections and logins"
+    )
+    args = parser.parse_args()
+    if args.run_bus and not args.bus:
+        parser.error("--run-bus needs --bus")
+    if args.message_log != "off" and args.write_behind != "off":
+        parser.error("--message-log and --write-behind are alternatives; pick one")
+    if args.message_log != "off" and args.workers > 1:
+        parser.error("--message-log needs a single worker (one process appends to the log)")
+    return args
+
+
+def configure(args):
+    """Apply command line settings to the server modules"""
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    metrics.METRICS_PORT = args.metrics_port
+    outbound.SEND_QUEUE_SIZE = args.send_queue_size
+    outbound.SLOW_CONSUMER_POLICY = args.slow_consumer_policy
+    auth.BCRYPT_ROUNDS = args.bcrypt_rounds
+    auth.HASH_WORKERS = args.hash_workers
+    crypto.CRYPTO_WORKERS = args.crypto_workers
+    rekey.REKEY_IO_BUDGET = args.rekey_io_budget
+    maintenance.MAINTENANCE_INTERVAL = args.maintenance_interval
+    if args.archive_dir:
+        maintenance.ARCHIVE_DIR = args.archive_dir
+    auth.ip_limiter.rate = args.ip_attempt_rate
+    auth.ip_limiter.capacity = max(auth.IP_ATTEMPT_BURST, args.ip_attempt_rate)
+    if args.db:
+        database.DB_PATH = args.db
+    if args.secret_key:
+        crypto.SECRET_KEY_PATH = args.secret_key
+    if args.media_dir:
+        blob_store.use_media_dir(args.media_dir)
+        transfers.LEGACY_FILES_DIR = os.path.join(args.media_dir, "files")
+    if args.message_log_dir:
+        database.MESSAGE_LOG_DIR = args.message_log_dir
+    if args.message_log != "off":
+        database.MESSAGE_LOG_MODE = args.message_log
+        message_log.FSYNC_INTERVAL_MS = args.fsync_ms
+
+    if args.write_behind != "off":
+        enable_write_behind(
+            durability=args.write_behind,
+            interval_ms=args.batch_ms,
+            max_rows=args.batch_rows
+        )
+
+
+def serve(args, reuse_port=False):
+    if args.bus:
+        use_bus(SocketBus(args.bus, crypto.bus_key()))
+
+    if args.mode == "asyncio":
+        start_async_server(port=args.port, reuse_port=reuse_port)
+    else:
+        start_server(port=args.port, reuse_port=reuse_port)
+
+
+def run_worker(args, index):
+    """Entry point of one worker process"""
+    configure(args)
+    # The other workers leave background re-encryption and maintenance to the first
+    rekey.REKEY_WORKER_ENABLED = index == 0
+    maintenance.MAINTENANCE_ENABLED = index == 0
+    if metrics.METRICS_PORT:
+        metrics.METRICS_PORT += index
+    try:
+        serve(args, reuse_port=True)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(args):
+    """Start the bus broker here and args.workers server processes"""
+    if args.db:
+        database.DB_PATH = args.db
+    if args.message_log_dir:
+        database.MESSAGE_LOG_DIR = args.message_log_dir
+    if args.secret_key:
+        crypto.SECRET_KEY_PATH = args.secret_key
+    init_db()  # once, before the workers race to migrate
+    crypto.get_server_secret()  # and to create the server key
+    open_message_log()  # and replay what a crashed single-process run left
+
+    # Only this user may reach a default socket: it lives in a private (0700) directory
+    bus_dir = None
+    if not args.bus:
+        bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+        args.bus = os.path.join(bus_dir, "bus.sock")
+    broker = BusBroker(args.bus, crypto.bus_key())
+    broker.start()
+    print(f"Message bus on {args.bus}, starting {args.workers} workers")
+
+    # spawn: workers must not inherit this process's database connections
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_worker, args=(args, index), name=f"chat-worker-{index}")
+        for index in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        print("\n[!] Stopping workers...")
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+    finally:
+        broker.close()
+        if bus_dir:
+            shutil.rmtree(bus_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
+    args = parse_args()
+
     print("=" * 50)
     print("  Advanced Chat Server")
     print("=" * 50)
     print()
 
-    start_server()
\ No newline at end of file
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        configure(args)
+        if args.run_bus:
+            BusBroker(args.bus, crypto.bus_key()).start()
+        serve(args)
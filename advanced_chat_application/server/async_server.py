@@ -0,0 +1,234 @@
+# server/async_server.py
+import asyncio
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from server import auth
+from server.auth import flush_last_seen
+from server.database import (
+    init_db, disable_write_behind, open_message_log, close_message_log, watch_queued_writes
+)
+from server.outbound import OutboundQueue
+from server.rekey import start_rekey_worker, stop_rekey_worker
+from server.maintenance import start_maintenance_worker, stop_maintenance_worker
+from server.typing_tracker import typing_tracker
+from server.read_receipts import receipts
+from server.presence import room_presence
+from server.bus import get_bus
+from server.metrics import start_metrics_server, stop_metrics_server
+from protocol.codec import JSON, FrameDecoder, FrameError
+from server.server import (
+    HOST, PORT, RECV_SIZE, LISTEN_BACKLOG, handle_authentication, dispatch_message,
+    register_client, unregister_client, broadcast_typing_expired,
+    broadcast_read_receipts, get_room_users, deliver_presence, deliver_presence_snapshot,
+    connect_bus, invalidate_room_cache, hold_room_cache, log, CONNECTIONS
+)
+
+# Handlers do blocking DB and crypto work, so they run on this pool
+# while the event loop only does socket I/O.
+EXECUTOR_WORKERS = 32
+
+# Logins wait for bcrypt, so they run on a pool of their own and a login
+# storm cannot take the handler threads. It has a thread per hash slot
+# (auth.HASH_WORKERS + auth.HASH_QUEUE_LIMIT) plus these spares, which
+# turn the logins past the hash queue away as "busy".
+AUTH_SPARE_WORKERS = 8
+
+
+class AsyncClientConnection:
+    """Client connection driven by asyncio streams"""
+
+    def __init__(self, reader, writer, loop):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.codec = JSON
+        self.decoder = FrameDecoder(JSON)
+        self.ready = asyncio.Event()
+        self.queue = OutboundQueue(
+            on_ready=self._wake_writer,
+            on_overflow=self._on_overflow
+        )
+        self.writer_task = loop.create_task(self._writer_loop())
+
+    def set_codec(self, codec):
+        """Switch framing for every frame after the one just queued"""
+        self.codec = codec
+        self.decoder.codec = codec
+
+    def send(self, data):
+        """Send data to client (waits for queue space)"""
+        return self.queue.put(self.codec.encode(data), block=True)
+
+    def send_bytes(self, payload, coalesce_key=None):
+        """Queue an already encoded frame; never blocks the caller"""
+        return self.queue.put(payload, coalesce_key)
+
+    def _wake_writer(self):
+        """Called from any thread when frames become available"""
+        try:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        except RuntimeError:
+            pass  # Event loop already closed
+
+    def _on_overflow(self):
+        """Slow consumer under the disconnect policy: drop the transport"""
+        try:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+        except RuntimeError:
+            pass
+
+    async def _writer_loop(self):
+        """Drain the send queue, honouring transport flow control"""
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+
+                batch = self.queue.take_all()
+                if batch:
+                    self.writer.write(b"".join(batch))
+                    await self.writer.drain()
+                if self.queue.closed and not self.queue.depth:
+                    return
+        except (ConnectionError, RuntimeError) as e:
+            log.warning("Send error: %s", e)
+            self.queue.close()
+
+    async def recv(self):
+        """Receive and decode the next frame from client"""
+        try:
+            while True:
+                frame = self.decoder.next_frame()
+                if frame is not None:
+                    log.debug("Received: %r", frame)
+                    return frame
+
+                chunk = await self.reader.read(RECV_SIZE)
+                if not chunk:
+                    return None
+                self.decoder.feed(chunk)
+        except FrameError as e:
+            log.warning("[!] Frame decode error: %s", e)
+            return None
+        except ConnectionError as e:
+            log.warning("[!] Receive error: %s", e)
+            return None
+
+    async def close(self):
+        """Flush queued frames and close the connection"""
+        self.queue.close()
+        try:
+            await asyncio.wait_for(self.writer_task, timeout=1.0)
+        except (asyncio.TimeoutError, Exception):
+            self.writer_task.cancel()
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+async def handle_async_client(reader, writer, executor, auth_executor):
+    """Per-connection coroutine: same protocol as server.handle_client"""
+    loop = asyncio.get_running_loop()
+    conn = AsyncClientConnection(reader, writer, loop)
+    addr = writer.get_extra_info("peername")
+    username = None
+    registered = False
+    CONNECTIONS.inc()
+    log.info("[+] New connection from %s", addr)
+
+    try:
+        auth_data = await conn.recv()
+        if not auth_data:
+            return
+
+        username, session = await loop.run_in_executor(
+            auth_executor, handle_authentication, conn, auth_data, addr
+        )
+        if not username:
+            log.info("[!] Authentication failed for %s", addr)
+            return
+
+        # The connection object is the client key in asyncio mode
+        register_client(conn, conn, username, session, addr)
+        registered = True
+        log.info("[✓] %s authenticated successfully", username)
+
+        while True:
+            data = await conn.recv()
+            if not data:
+                break
+
+            # Awaiting keeps frames from one client handled in order
+            await loop.run_in_executor(
+                executor, dispatch_message, conn, conn, data, username
+            )
+
+    except Exception as e:
+        log.exception("[!] Error handling %s: %s", username or addr, e)
+
+    finally:
+        if registered:
+            await loop.run_in_executor(executor, unregister_client, conn, username)
+        await conn.close()
+        log.info("[-] %s disconnected", username or addr)
+
+
+async def serve(host=HOST, port=PORT, reuse_port=False):
+    """Run the asyncio chat server until cancelled"""
+    executor = ThreadPoolExecutor(
+        max_workers=EXECUTOR_WORKERS,
+        thread_name_prefix="chat-handler"
+    )
+    auth_executor = ThreadPoolExecutor(
+        max_workers=auth.HASH_WORKERS + auth.HASH_QUEUE_LIMIT + AUTH_SPARE_WORKERS,
+        thread_name_prefix="chat-auth"
+    )
+
+    server = await asyncio.start_server(
+        lambda r, w: handle_async_client(r, w, executor, auth_executor),
+        host, port,
+        backlog=LISTEN_BACKLOG,
+        family=socket.AF_INET,
+        reuse_address=True,
+        reuse_port=reuse_port
+    )
+
+    print(f"✅ Server running on {host}:{port} (asyncio)")
+    print("Waiting for connections...")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False)
+        auth_executor.shutdown(wait=False)
+        stop_rekey_worker()
+        stop_maintenance_worker()
+        typing_tracker.stop_expiry()
+        receipts.stop()
+        room_presence.stop()
+        get_bus().close()
+        stop_metrics_server()
+        flush_last_seen()
+        disable_write_behind()
+        close_message_log()
+
+
+def start_async_server(host=HOST, port=PORT, reuse_port=False):
+    """Start the chat server in asyncio mode"""
+    init_db()
+    watch_queued_writes(hold_room_cache)
+    open_message_log()
+    connect_bus()
+    start_metrics_server()
+    start_rekey_worker()
+    start_maintenance_worker(on_archived=invalidate_room_cache)
+    typing_tracker.start_expiry(broadcast_typing_expired)
+    receipts.start(broadcast_read_receipts)
+    room_presence.start(get_room_users, deliver_presence, deliver_presence_snapshot)
+
+    try:
+        asyncio.run(serve(host, port, reuse_port))
+    except KeyboardInterrupt:
+        print("\n[!] Server shutting down...")
@@ -1,12 +1,109 @@
 # server/auth.py
 import bcrypt
 import uuid
-from server.database import create_user, get_user, create_session, validate_session, update_last_seen
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from server.bus import get_bus
+from server.database import (
+    create_user, get_user, create_session, validate_session,
+    update_last_seen, update_last_seen_many
+)
+from server.ratelimit import KeyedRateLimiter
+
+# bcrypt work factor for new password hashes (existing hashes keep theirs)
+BCRYPT_ROUNDS = 12
+
+# Password hashing runs on this many threads (bcrypt releases the GIL)
+HASH_WORKERS = 4
+
+# Hash jobs allowed to wait for a worker before requests are turned away
+HASH_QUEUE_LIMIT = 64
+
+# Login/register attempts: sustained rate per second and burst size
+IP_ATTEMPT_RATE, IP_ATTEMPT_BURST = 1.0, 20
+USERNAME_ATTEMPT_RATE, USERNAME_ATTEMPT_BURST = 0.2, 5
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+_hash_slots = None
+
+ip_limiter = KeyedRateLimiter(IP_ATTEMPT_RATE, IP_ATTEMPT_BURST)
+username_limiter = KeyedRateLimiter(USERNAME_ATTEMPT_RATE, USERNAME_ATTEMPT_BURST)
+
+
+class HashPoolBusy(Exception):
+    """Raised when the password hashing queue is full"""
+
+
+# Seconds a validated session is trusted before it is re-checked in the DB
+SESSION_CACHE_TTL = 60.0
+
+# Sessions cached at most; the least recently used go first
+SESSION_CACHE_SIZE = 10_000
+
+# Seconds between batched last_seen updates
+LAST_SEEN_FLUSH_INTERVAL = 30.0
+
+
+class SessionCache:
+    """
+    In-memory TTL cache of session id -> username, LRU-bounded. An entry
+    is dropped after the TTL or when its session expires, if sooner.
+    """
+
+    def __init__(self, ttl=SESSION_CACHE_TTL, maxsize=SESSION_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+
+            username, expires = entry
+            if time.monotonic() >= expires:
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+            return username
+
+    def put(self, session_id, username, expires_in=None):
+        """Cache a session that the DB says expires in `expires_in` seconds"""
+        ttl = self.ttl if expires_in is None else min(self.ttl, expires_in)
+        with self._lock:
+            self._entries[session_id] = (username, time.monotonic() + ttl)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+session_cache = SessionCache()
+
+# Users seen since the last flush; written to the DB in one batch
+_seen_users = set()
+_seen_lock = threading.Lock()
+_last_flush = time.monotonic()
 
 
 def hash_password(password):
     """Hash a password using bcrypt"""
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(BCRYPT_ROUNDS))
 
 
 def verify_password(password, hashed):
@@ -14,11 +111,46 @@ def verify_password(password, hashed):
     return bcrypt.checkpw(password.encode(), hashed)
 
 
-def register_user(username, password):
+def _run_hash_job(func, *args):
+    """
+    Run a bcrypt call on the bounded hashing pool and wait for it.
+    Raises HashPoolBusy instead of queueing past HASH_QUEUE_LIMIT, so a
+    login storm cannot tie up every connection handler.
+    """
+    global _hash_pool, _hash_slots
+
+    if _hash_pool is None:
+        with _hash_pool_lock:
+            if _hash_pool is None:
+                _hash_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_LIMIT)
+                _hash_pool = ThreadPoolExecutor(
+                    max_workers=HASH_WORKERS,
+                    thread_name_prefix="bcrypt"
+                )
+
+    if not _hash_slots.acquire(blocking=False):
+        raise HashPoolBusy()
+    try:
+        return _hash_pool.submit(func, *args).result()
+    finally:
+        _hash_slots.release()
+
+
+def _check_attempt_limits(username, client_ip):
+    """Token-bucket throttling per client IP and per username"""
+    if not ip_limiter.allow(client_ip):
+        return False
+    return username_limiter.allow(username)
+
+
+def register_user(username, password, client_ip=None):
     """
     Register a new user
     Returns: (success: bool, message: str, session: str or None)
     """
+    if not ip_limiter.allow(client_ip):
+        return False, "Too many attempts, please wait and try again", None
+
     if not username or len(username) < 3:
         return False, "Username must be at least 3 characters", None
 
@@ -29,7 +161,10 @@ def register_user(username, password):
     if not username.replace("_", "").replace("-", "").isalnum():
         return False, "Username can only contain letters, numbers, _ and -", None
 
-    hashed = hash_password(password)
+    try:
+        hashed = _run_hash_job(hash_password, password)
+    except HashPoolBusy:
+        return False, "Server busy, please try again", None
 
     if create_user(username, hashed):
         # Auto-login after registration
@@ -40,11 +175,14 @@ def register_user(username, password):
         return False, "Username already taken", None
 
 
-def login_user(username, password):
+def login_user(username, password, client_ip=None):
     """
     Authenticate a user
     Returns: (success: bool, message: str, session: str or None)
     """
+    if not _check_attempt_limits(username, client_ip):
+        return False, "Too many attempts, please wait and try again", None
+
     user = get_user(username)
 
     if not user:
@@ -52,7 +190,12 @@ def login_user(username, password):
 
     stored_hash = user["password_hash"]
 
-    if not verify_password(password, stored_hash):
+    try:
+        valid = _run_hash_job(verify_password, password, stored_hash)
+    except HashPoolBusy:
+        return False, "Server busy, please try again", None
+
+    if not valid:
         return False, "Invalid username or password", None
 
     # Update last seen
@@ -73,13 +216,54 @@ def authenticate_session(session_id):
     if not session_id:
         return None
 
-    username = validate_session(session_id)
-    if username:
-        update_last_seen(username)
+    username = session_cache.get(session_id)
+    if username is None:
+        session = validate_session(session_id)
+        if not session:
+            return None
+        username, expires_in = session
+        session_cache.put(session_id, username, expires_in)
 
+    _mark_seen(username)
     return username
 
 
+def sessions_ended(session_ids):
+    """Drop deleted sessions from the cache here and in the other server processes"""
+    forget_sessions(session_ids)
+    if session_ids:
+        get_bus().publish("sessions_ended", sessions=list(session_ids))
+
+
+def forget_sessions(session_ids):
+    for session_id in session_ids:
+        session_cache.invalidate(session_id)
+
+
+def _mark_seen(username):
+    """Record activity; last_seen is written at most every flush interval"""
+    global _last_flush
+
+    with _seen_lock:
+        _seen_users.add(username)
+        due = time.monotonic() - _last_flush >= LAST_SEEN_FLUSH_INTERVAL
+        if due:
+            _last_flush = time.monotonic()
+
+    if due:
+        flush_last_seen()
+
+
+def flush_last_seen():
+    """Write pending last_seen updates in a single transaction"""
+    with _seen_lock:
+        usernames = list(_seen_users)
+        _seen_users.clear()
+
+    if usernames:
+        update_last_seen_many(usernames)
+
+
 def require_auth(func):
     """Decorator to require authentication for handler functions"""
     def wrapper(conn, data, *args, **kwargs):
@@ -0,0 +1,169 @@
+# server/blob_store.py
+import mmap
+import os
+import threading
+import time
+import uuid
+from server.crypto import (
+    BLOB_CHUNK_OVERHEAD, blob_id_for, new_blob_key, wrap_blob_key,
+    encrypt_blob_chunk, decrypt_blob_chunk
+)
+from server.database import (
+    get_blob, insert_blob, touch_blob, find_orphan_blobs, delete_blob
+)
+from protocol.chunks import chunk_hash, tree_hash
+
+MEDIA_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "media"
+)
+BLOB_DIR = os.path.join(MEDIA_DIR, "blobs")
+PARTIAL_DIR = os.path.join(MEDIA_DIR, "partial")
+
+CHUNK_SIZE = 256 * 1024  # plaintext bytes per chunk
+
+# Unreferenced blobs and stray files younger than this are left alone,
+# so an upload between its commit and its attachment row is never collected
+GC_GRACE_SECONDS = 60 * 60
+
+# Serializes "does this blob exist / add it" across uploads
+_commit_lock = threading.Lock()
+
+
+def use_media_dir(path):
+    """Keep blobs and partial uploads under `path` instead of media/"""
+    global MEDIA_DIR, BLOB_DIR, PARTIAL_DIR
+    MEDIA_DIR = path
+    BLOB_DIR = os.path.join(path, "blobs")
+    PARTIAL_DIR = os.path.join(path, "partial")
+
+
+def blob_path(blob_id):
+    """media/blobs/ab/cd/abcd... - two levels keep directories small"""
+    return os.path.join(BLOB_DIR, blob_id[:2], blob_id[2:4], blob_id)
+
+
+class BlobFile:
+    """
+    A file of AES-GCM encrypted chunks in fixed-size slots, so chunk i
+    can be written at a known offset in any order. Only the last slot
+    may be short.
+    """
+
+    def __init__(self, path, chunk_size, key):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.key = key
+        self.slot_size = chunk_size + BLOB_CHUNK_OVERHEAD
+
+    def create(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        open(self.path, "wb").close()
+
+    def write(self, index, data):
+        with open(self.path, "r+b") as f:
+            f.seek(index * self.slot_size)
+            f.write(encrypt_blob_chunk(self.key, data))
+
+    def read(self, first, count):
+        """
+        Yield (index, plaintext) for `count` chunks from `first`.
+        The file is memory-mapped and each slot is decrypted straight
+        from the mapping, without copying it into a read buffer first.
+        """
+        with open(self.path, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for index in range(first, first + count):
+                    start = index * self.slot_size
+                    record = view[start:min(start + self.slot_size, len(view))]
+                    try:
+                        yield index, decrypt_blob_chunk(self.key, record)
+                    finally:
+                        record.release()
+            finally:
+                view.release()
+
+
+def new_partial(chunk_size=CHUNK_SIZE):
+    """An empty blob file under a fresh key, for an upload in progress"""
+    partial = BlobFile(
+        os.path.join(PARTIAL_DIR, uuid.uuid4().hex), chunk_size, new_blob_key()
+    )
+    partial.create()
+    return partial
+
+
+def commit_partial(partial, content_hash, size):
+    """
+    Turn a finished partial file into a blob and return its id.
+    If a blob with the same contents exists, the partial is discarded
+    and the existing blob is shared.
+    """
+    blob_id = blob_id_for(content_hash)
+
+    with _commit_lock:
+        if get_blob(blob_id):
+            touch_blob(blob_id)
+            os.remove(partial.path)
+            return blob_id
+
+        path = blob_path(blob_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(partial.path, path)
+        insert_blob(blob_id, size, partial.chunk_size, wrap_blob_key(partial.key))
+
+    return blob_id
+
+
+def store_chunks(chunks, size, chunk_size=CHUNK_SIZE):
+    """
+    Store a file given as an iterable of in-order plaintext chunks.
+    Returns (blob_id, content_hash).
+    """
+    partial = new_partial(chunk_size)
+    hashes = []
+    try:
+        for index, data in enumerate(chunks):
+            partial.write(index, data)
+            hashes.append(chunk_hash(data))
+    except Exception:
+        os.remove(partial.path)
+        raise
+
+    content_hash = tree_hash(hashes)
+    return commit_partial(partial, content_hash, size), content_hash
+
+
+def collect_garbage(grace=GC_GRACE_SECONDS):
+    """
+    Delete blobs no attachment references any more, plus blob and
+    partial files that have no database row (left by a crash).
+    Returns the number of files removed.
+    """
+    removed = 0
+
+    for blob_id in find_orphan_blobs(grace):
+        with _commit_lock:
+            # Re-checked under the lock: a new upload may share the blob
+            if not delete_blob(blob_id, grace):
+                continue
+            try:
+                os.remove(blob_path(blob_id))
+                removed += 1
+            except FileNotFoundError:
+                pass
+
+    cutoff = time.time() - grace
+    for directory in (BLOB_DIR, PARTIAL_DIR):
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                if directory == BLOB_DIR and get_blob(name):
+                    continue
+                os.remove(path)
+                removed += 1
+
+    return removed
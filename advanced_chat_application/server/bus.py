@@ -0,0 +1,408 @@
+# server/bus.py
+import hashlib
+import hmac
+import os
+import queue
+import socket
+import threading
+import time
+import traceback
+import uuid
+from protocol.codec import JSON, FrameDecoder, FrameError
+
+# Identifies this server process on the bus
+NODE_ID = uuid.uuid4().hex[:12]
+
+# Seconds between attempts to reach the broker after losing it
+RECONNECT_INTERVAL = 1.0
+
+RECV_SIZE = 65536
+
+# Seconds a connecting node has to answer the broker's challenge
+HELLO_TIMEOUT = 5.0
+
+# Frames the broker queues for one node before dropping it as too slow
+PEER_QUEUE_FRAMES = 10_000
+
+
+def hello_proof(key, nonce, node):
+    """What a node answers the broker's challenge with: it holds the bus key"""
+    return hmac.new(key, f"{nonce}:{node}".encode(), hashlib.sha256).hexdigest()
+
+
+def parse_address(address):
+    """'host:port' for TCP, anything else is a Unix socket path"""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    return socket.AF_UNIX, address
+
+
+class Bus:
+    """
+    Publish/subscribe between the server processes sharing rooms.
+    Messages are dicts; every one is tagged with the sending node, and a
+    node never receives its own. The base class is a bus with no peers,
+    for a server running as a single process.
+    """
+
+    node = NODE_ID
+
+    def __init__(self):
+        self._handlers = []
+        self._on_connect = []
+
+    def subscribe(self, handler):
+        """Call handler(message) for every message from another node"""
+        self._handlers.append(handler)
+
+    def on_connect(self, callback):
+        """Call callback() whenever the bus (re)connects to its peers"""
+        self._on_connect.append(callback)
+
+    def publish(self, kind, **fields):
+        pass
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _dispatch(self, message):
+        if message.get("node") == self.node:
+            return
+        for handler in self._handlers:
+            try:
+                handler(message)
+            except Exception:
+                traceback.print_exc()
+
+    def _connected(self):
+        for callback in self._on_connect:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+
+
+class LocalBus(Bus):
+    """
+    In-process bus: LocalBus instances sharing one `hub` list see each
+    other's messages. Lets several nodes run in one process.
+    """
+
+    def __init__(self, hub=None, node=None):
+        super().__init__()
+        self.hub = hub if hub is not None else []
+        if node:
+            self.node = node
+
+    def start(self):
+        self.hub.append(self)
+        self._connected()
+
+    def publish(self, kind, **fields):
+        message = dict(fields, kind=kind, node=self.node)
+        for peer in list(self.hub):
+            if peer is not self:
+                peer._dispatch(message)
+
+    def close(self):
+        if self in self.hub:
+            self.hub.remove(self)
+
+
+class SocketBus(Bus):
+    """
+    Bus through a BusBroker on a local socket. Frames are JSON lines, as
+    in the client protocol. The broker only relays for nodes that prove
+    they hold `key`. If the broker goes away, publishing becomes a no-op
+    until the connection is re-established.
+    """
+
+    def __init__(self, address, key):
+        super().__init__()
+        self.address = address
+        self.key = key
+        self._sock = None
+        self._decoder = None
+        self._send_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._connect()
+        self._thread = threading.Thread(target=self._run, name="bus", daemon=True)
+        self._thread.start()
+
+    def publish(self, kind, **fields):
+        payload = JSON.encode(dict(fields, kind=kind, node=self.node))
+        with self._send_lock:
+            if self._sock is None:
+                return
+            try:
+                self._sock.sendall(payload)
+            except OSError:
+                self._drop()
+
+    def close(self):
+        self._closed.set()
+        with self._send_lock:
+            self._drop()
+        if self._thread is not None:
+            self._thread.join(timeout=RECONNECT_INTERVAL * 2)
+
+    def _connect(self):
+        family, address = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        decoder = FrameDecoder(JSON)
+        try:
+            sock.settimeout(HELLO_TIMEOUT)
+            sock.connect(address)
+            challenge = None
+            while challenge is None:
+                chunk = sock.recv(RECV_SIZE)
+                if not chunk:
+                    raise OSError("the broker closed the connection")
+                decoder.feed(chunk)
+                challenge = decoder.next_frame()
+            sock.sendall(JSON.encode({
+                "kind": "hello",
+                "node": self.node,
+                "proof": hello_proof(self.key, challenge.get("nonce", ""), self.node)
+            }))
+            sock.settimeout(None)
+        except (OSError, FrameError):
+            sock.close()
+            return False
+        with self._send_lock:
+            self._sock = sock
+            self._decoder = decoder
+        return True
+
+    def _drop(self):
+        """Forget the broker connection (caller holds _send_lock)"""
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+
+    def _run(self):
+        while not self._closed.is_set():
+            sock = self._sock
+            if sock is None:
+                if not self._connect():
+                    self._closed.wait(RECONNECT_INTERVAL)
+                    continue
+                print("[*] Reconnected to the message bus")
+                sock = self._sock
+
+            self._connected()
+            self._read(sock, self._decoder)
+
+            with self._send_lock:
+                if self._sock is sock:
+                    self._drop()
+            if not self._closed.is_set():
+                print("[!] Lost the message bus; retrying")
+
+    def _read(self, sock, decoder):
+        try:
+            while True:
+                message = decoder.next_frame()
+                if message is not None:
+                    self._dispatch(message)
+                    continue
+                chunk = sock.recv(RECV_SIZE)
+                if not chunk:
+                    return
+                decoder.feed(chunk)
+        except (OSError, FrameError):
+            return
+
+
+class _Peer:
+    """A node connected to the broker, with its own writer thread"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.queue = queue.Queue(maxsize=PEER_QUEUE_FRAMES)
+        threading.Thread(target=self._write, name="bus-peer", daemon=True).start()
+
+    def send(self, payload):
+        """Queue a frame; a node that has fallen this far behind is dropped"""
+        try:
+            self.queue.put_nowait(payload)
+        except queue.Full:
+            print(f"[!] Message bus: dropping a node {PEER_QUEUE_FRAMES} frames behind")
+            self.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def stop(self):
+        """End the writer thread (a full queue means it is stuck in a send)"""
+        self.close()
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _write(self):
+        while True:
+            payloads = [self.queue.get()]
+            while True:
+                try:
+                    payloads.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in payloads:
+                return
+            try:
+                self.sock.sendall(b"".join(payloads))
+            except OSError:
+                return  # its _serve loop notices and cleans up
+
+
+class BusBroker:
+    """
+    Relays every frame from one node to all the others. A node must
+    first answer a challenge with the bus key; each then has a bounded
+    queue, so a stalled node cannot hold up the rest. When a node
+    disconnects, the others are told with a `node_down` message so they
+    can drop the users it was serving.
+    """
+
+    def __init__(self, address, key):
+        self.address = address
+        self.key = key
+        self._peers = {}  # socket -> _Peer
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+        self._server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(address)
+        if family == socket.AF_UNIX:
+            os.chmod(address, 0o600)
+        self._server.listen(64)
+        threading.Thread(target=self._accept_loop, name="bus-broker", daemon=True).start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        with self._lock:
+            peers = list(self._peers)
+        for sock in peers:
+            sock.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _hello(self, sock, decoder):
+        """Challenge a new connection; returns its node id, or None"""
+        nonce = os.urandom(16).hex()
+        sock.settimeout(HELLO_TIMEOUT)
+        sock.sendall(JSON.encode({"kind": "challenge", "nonce": nonce}))
+        message = None
+        while message is None:
+            chunk = sock.recv(RECV_SIZE)
+            if not chunk:
+                return None
+            decoder.feed(chunk)
+            message = decoder.next_frame()
+        sock.settimeout(None)
+
+        node = message.get("node")
+        proof = message.get("proof")
+        if (message.get("kind") != "hello" or not isinstance(node, str)
+                or not isinstance(proof, str)
+                or not hmac.compare_digest(proof, hello_proof(self.key, nonce, node))):
+            print("[!] Message bus: refused a connection without the bus key")
+            return None
+        return node
+
+    def _serve(self, sock):
+        decoder = FrameDecoder(JSON)
+        node = peer = None
+        try:
+            node = self._hello(sock, decoder)
+            if node is None:
+                return
+            peer = _Peer(sock)
+            with self._lock:
+                self._peers[sock] = peer
+            self._relay(sock, JSON.encode({"kind": "hello", "node": node}))
+
+            while True:
+                # Frames are relayed as JSON lines, re-encoded once each
+                while True:
+                    message = decoder.next_frame()
+                    if message is None:
+                        break
+                    self._relay(sock, JSON.encode(message))
+                chunk = sock.recv(RECV_SIZE)
+                if not chunk:
+                    break
+                decoder.feed(chunk)
+        except (OSError, FrameError):
+            pass
+        finally:
+            with self._lock:
+                self._peers.pop(sock, None)
+            if peer is not None:
+                peer.stop()
+            sock.close()
+            if peer is not None:
+                self._relay(None, JSON.encode({"kind": "node_down", "node": node}))
+
+    def _relay(self, sender, payload):
+        with self._lock:
+            peers = [peer for sock, peer in self._peers.items() if sock is not sender]
+        for peer in peers:
+            peer.send(payload)
+
+
+def run_broker(address, key):
+    """Run a broker in this process until interrupted"""
+    broker = BusBroker(address, key)
+    broker.start()
+    print(f"✅ Message bus listening on {address}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.close()
+
+
+_bus = Bus()
+
+
+def get_bus():
+    return _bus
+
+
+def use_bus(bus):
+    """Make `bus` the one the server publishes to (before start_server())"""
+    global _bus
+    _bus = bus
+    return bus
@@ -1,10 +1,53 @@
 # server/crypto.py
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import base64
+import functools
 import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from server.database import get_room_keys, get_room_key_version, add_room_key
 
-# Room-based encryption keys (in production, store these securely)
-ROOM_KEYS = {}
+# Fernet ciphers of the most recently used rooms
+CIPHER_CACHE_SIZE = 1024
+
+# Seconds a cached cipher is used before checking for a newer key
+# version (e.g. rotated by another process)
+KEY_REFRESH_SECONDS = 30
+
+# Threads that split up large decrypt_many()/encrypt_many() batches;
+# 0 keeps every batch on the calling thread
+CRYPTO_WORKERS = 0
+
+# Smallest batch worth splitting across CRYPTO_WORKERS
+PARALLEL_BATCH_MIN = 2000
+
+_ciphers = OrderedDict()
+_cipher_lock = threading.Lock()
+_crypto_pool = None
+_crypto_pool_lock = threading.Lock()
+
+# Server-wide Fernet key: wraps blob and room keys, names blobs and keys
+# the search index. Taken from $CHAT_SECRET_KEY if set, otherwise read
+# from SECRET_KEY_PATH (created on first use). Keep it out of the repository.
+SECRET_KEY_ENV = "CHAT_SECRET_KEY"
+SECRET_KEY_PATH = os.environ.get("CHAT_SECRET_KEY_FILE") or os.path.join(
+    os.path.expanduser("~"), ".config", "advanced_chat", "secret.key"
+)
+
+# Bytes kept of each search index token (see search_tokens)
+SEARCH_TOKEN_BYTES = 12
+
+# AES-GCM nonce and tag added to every attachment chunk
+BLOB_CHUNK_OVERHEAD = 12 + 16
+
+_server_secret = None
+_secret_fernet = None
+_secret_lock = threading.Lock()
 
 
 def generate_room_key(room_name):
@@ -15,11 +58,65 @@ def generate_room_key(room_name):
     return base64.urlsafe_b64encode(key_material)
 
 
+class _RoomCipher:
+    """A room's keys: encrypts with the newest, decrypts with any"""
+
+    def __init__(self, room):
+        keys = get_room_keys(room)
+        self.version = keys[0]["version"] if keys else 0
+        fernets = [Fernet(unwrap_blob_key(row["wrapped_key"])) for row in keys]
+        fernets.append(Fernet(generate_room_key(room)))
+        self.primary = fernets[0]
+        self.cipher = MultiFernet(fernets)
+        self.checked = time.monotonic()
+
+
+def _room_cipher(room):
+    with _cipher_lock:
+        entry = _ciphers.get(room)
+        if entry is not None:
+            _ciphers.move_to_end(room)
+
+    if entry is not None and time.monotonic() - entry.checked >= KEY_REFRESH_SECONDS:
+        if get_room_key_version(room) == entry.version:
+            entry.checked = time.monotonic()
+        else:
+            entry = None
+
+    if entry is None:
+        entry = _RoomCipher(room)
+        with _cipher_lock:
+            _ciphers[room] = entry
+            _ciphers.move_to_end(room)
+            if len(_ciphers) > CIPHER_CACHE_SIZE:
+                _ciphers.popitem(last=False)
+    return entry
+
+
 def get_room_cipher(room):
-    """Get or create Fernet cipher for a room"""
-    if room not in ROOM_KEYS:
-        ROOM_KEYS[room] = generate_room_key(room)
-    return Fernet(ROOM_KEYS[room])
+    """
+    Cipher for a room (LRU-cached). Encrypts with the room's newest key
+    version and decrypts rows written under any earlier one.
+    """
+    return _room_cipher(room).cipher
+
+
+def get_room_key_ciphers(room):
+    """(newest key only, all keys) for re-encrypting a room's rows"""
+    entry = _room_cipher(room)
+    return entry.primary, entry.cipher
+
+
+def rotate_room_key(room):
+    """
+    Give a room a new random key. Existing rows stay readable and are
+    re-encrypted in the background by server/rekey.py.
+    Returns the new key version.
+    """
+    version = add_room_key(room, wrap_blob_key(Fernet.generate_key()))
+    with _cipher_lock:
+        _ciphers.pop(room, None)
+    return version
 
 
 def encrypt_message(room, message):
@@ -42,6 +139,57 @@ def decrypt_message(room, encrypted_message):
         return encrypted_message  # Fallback to returning as-is
 
 
+def _decrypt_batch(cipher, tokens):
+    results = []
+    for token in tokens:
+        try:
+            results.append(cipher.decrypt(token.encode()).decode())
+        except Exception as e:
+            print(f"Decryption error: {e}")
+            results.append(token)
+    return results
+
+
+def _encrypt_batch(cipher, messages):
+    return [cipher.encrypt(message.encode()).decode() for message in messages]
+
+
+def _run_batch(func, cipher, items):
+    """Run func over items, split across the crypto pool when large"""
+    global _crypto_pool
+
+    if CRYPTO_WORKERS <= 1 or len(items) < PARALLEL_BATCH_MIN:
+        return func(cipher, items)
+
+    if _crypto_pool is None:
+        with _crypto_pool_lock:
+            if _crypto_pool is None:
+                _crypto_pool = ThreadPoolExecutor(
+                    max_workers=CRYPTO_WORKERS, thread_name_prefix="crypto"
+                )
+
+    size = -(-len(items) // CRYPTO_WORKERS)
+    parts = [items[i:i + size] for i in range(0, len(items), size)]
+    results = []
+    for part in _crypto_pool.map(lambda part: func(cipher, part), parts):
+        results.extend(part)
+    return results
+
+
+def decrypt_many(room, encrypted_messages):
+    """Decrypt a list of messages from one room, in order"""
+    return _run_batch(_decrypt_batch, get_room_cipher(room), list(encrypted_messages))
+
+
+def encrypt_many(room, messages):
+    """Encrypt a list of messages for one room, in order"""
+    try:
+        return _run_batch(_encrypt_batch, get_room_cipher(room), list(messages))
+    except Exception as e:
+        print(f"Encryption error: {e}")
+        return list(messages)  # Fallback to plaintext
+
+
 def encrypt_file(room, file_data):
     """Encrypt file data for a specific room"""
     try:
@@ -59,4 +207,105 @@ def decrypt_file(room, encrypted_data):
         return cipher.decrypt(encrypted_data)
     except Exception as e:
         print(f"File decryption error: {e}")
-        return encrypted_data
\ No newline at end of file
+        return encrypted_data
+
+
+def encrypted_chunk_size(size):
+    """Length of encrypt_chunk() output for `size` bytes of plaintext"""
+    # version + timestamp + IV, AES-CBC blocks (always padded), HMAC
+    return 1 + 8 + 16 + (size // 16 + 1) * 16 + 32
+
+
+def decrypt_chunk(room, token):
+    """Decrypt a raw Fernet token from a per-room chunk file"""
+    return get_room_cipher(room).decrypt(base64.urlsafe_b64encode(token))
+
+
+def load_secret_key(path):
+    with open(path, "rb") as f:
+        return f.read().strip()
+
+
+def get_server_secret():
+    """Load the server key, creating it on first use"""
+    global _server_secret
+
+    with _secret_lock:
+        if _server_secret is None:
+            if os.environ.get(SECRET_KEY_ENV):
+                _server_secret = os.environ[SECRET_KEY_ENV].strip().encode()
+                return _server_secret
+            try:
+                _server_secret = load_secret_key(SECRET_KEY_PATH)
+            except FileNotFoundError:
+                _server_secret = Fernet.generate_key()
+                os.makedirs(os.path.dirname(SECRET_KEY_PATH), mode=0o700, exist_ok=True)
+                fd = os.open(SECRET_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(_server_secret)
+                print(f"[*] New server key created in {SECRET_KEY_PATH}; back it up")
+        return _server_secret
+
+
+def blob_id_for(content_hash):
+    """
+    Storage name of an attachment's contents. Keyed, so the name does
+    not reveal the file hash, but equal files still share one blob.
+    """
+    secret = base64.urlsafe_b64decode(get_server_secret())
+    return hmac.new(secret, bytes.fromhex(content_hash), hashlib.sha256).hexdigest()
+
+
+def bus_key():
+    """Key the server processes prove to the message bus broker"""
+    secret = base64.urlsafe_b64decode(get_server_secret())
+    return hmac.new(secret, b"bus", hashlib.sha256).digest()
+
+
+@functools.lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def _search_key(room):
+    secret = base64.urlsafe_b64decode(get_server_secret())
+    return hmac.new(secret, b"search:" + room.encode(), hashlib.sha256).digest()
+
+
+def search_tokens(room, terms):
+    """
+    Blind index tokens for search terms. Keyed per room, so the index
+    holds no words, the same word differs between rooms, and rotating
+    a room key does not change them.
+    """
+    key = _search_key(room)
+    return [
+        hmac.new(key, term.encode(), hashlib.sha256).digest()[:SEARCH_TOKEN_BYTES]
+        for term in terms
+    ]
+
+
+def new_blob_key():
+    return AESGCM.generate_key(bit_length=256)
+
+
+def _secret_cipher():
+    global _secret_fernet
+    if _secret_fernet is None:
+        _secret_fernet = Fernet(get_server_secret())
+    return _secret_fernet
+
+
+def wrap_blob_key(key):
+    return _secret_cipher().encrypt(key).decode()
+
+
+def unwrap_blob_key(wrapped):
+    return _secret_cipher().decrypt(wrapped.encode())
+
+
+def encrypt_blob_chunk(key, data):
+    """AES-GCM encrypt one attachment chunk: nonce + ciphertext + tag"""
+    nonce = os.urandom(12)
+    return nonce + AESGCM(key).encrypt(nonce, data, None)
+
+
+def decrypt_blob_chunk(key, record):
+    """Decrypt a chunk from encrypt_blob_chunk(); accepts a memoryview"""
+    return AESGCM(key).decrypt(record[:12], record[12:], None)
@@ -1,24 +1,598 @@
 import sqlite3
+import bisect
+import functools
+import hashlib
 import os
-from datetime import datetime
+import queue
+import threading
+import time
+from datetime import datetime, timezone
 from contextlib import contextmanager
+from server.write_behind import WriteBehindQueue, DURABILITY_ASYNC
+from server.message_log import MessageLog, MessageLogError
+from server.metrics import Counter, Histogram
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "chat.db")
 
+# Connection pool tuning
+POOL_SIZE = 16                # connections kept open per database file
+BUSY_TIMEOUT = 10.0           # seconds to wait on a locked database
+STATEMENT_CACHE_SIZE = 256    # prepared statements cached per connection
+CACHE_SIZE_KB = 16384         # page cache per connection
+SYNCHRONOUS = "NORMAL"        # WAL + NORMAL only fsyncs at checkpoints
 
-@contextmanager
-def get_db():
-    """Context manager for database ***s"""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# Append-only message log in front of the room tables (see open_message_log)
+MESSAGE_LOG_MODE = None       # None: off, otherwise a write-behind durability mode
+MESSAGE_LOG_DIR = None        # default: next to DB_PATH, "<name>-log"
+
+
+def _connect(path):
+    """Open a connection configured for concurrent use (WAL journaling)"""
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
     conn.row_factory = sqlite3.Row
+    # Lets maintenance give free pages back a few at a time. Only takes
+    # effect on a new database (before WAL mode); VACUUM converts old ones.
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    """Thread-safe pool of long-lived connections to one database file"""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take an idle connection, opening a new one while under the limit"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = _connect(self.path)
+                self._all.append(conn)
+                return conn
+
+        DB_POOL_WAITS.inc()
+        return self._idle.get()
+
+    def release(self, conn):
+        """Return a connection, discarding any uncommitted work"""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        """Close every connection owned by the pool"""
+        with self._lock:
+            for conn in self._all:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._all.clear()
+        self._idle = queue.LifoQueue()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+DB_SECONDS = Histogram(
+    "chat_db_seconds", "Time spent in database calls, by query or write", ("query",)
+)
+DB_BATCH_ROWS = Histogram(
+    "chat_db_write_batch_rows", "Writes per write-behind group commit or message log batch",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2000)
+)
+DB_POOL_WAITS = Counter(
+    "chat_db_pool_waits_total", "Connection requests that found the pool exhausted"
+)
+
+
+def _timed(func):
+    """Record a database function's duration in DB_SECONDS"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, name)
+    return wrapper
+
+
+def get_pool(path=None):
+    """Get the connection pool for a database file (DB_PATH by default)"""
+    path = path or DB_PATH
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(path)
+            if pool is None:
+                pool = _pools[path] = ConnectionPool(path)
+    return pool
+
+
+def close_db():
+    """Close all pooled connections (e.g. before deleting the database)"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+@contextmanager
+def get_db(path=None):
+    """Context manager for pooled database connections"""
+    pool = get_pool(path)
+    conn = pool.acquire()
     try:
         yield conn
     finally:
-        conn.close()
+        pool.release(conn)
+
+
+# Points per shard on the hash ring; more points, more even rooms per shard
+SHARD_RING_POINTS = 64
+
+
+def _ring_point(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class ShardMap:
+    """
+    Consistent-hash ring from room names to shard numbers. Adding or
+    removing a shard only moves the rooms on the ring arcs it takes
+    over or gives up, about 1/N of them.
+    """
+
+    def __init__(self, shards=(0,), points=SHARD_RING_POINTS):
+        self.shards = sorted(shards)
+        ring = sorted(
+            (_ring_point(f"shard-{shard}#{i}"), shard)
+            for shard in self.shards for i in range(points)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [shard for _, shard in ring]
+
+    def shard_for(self, room):
+        if len(self.shards) == 1:
+            return self.shards[0]
+        i = bisect.bisect(self._points, _ring_point(room)) % len(self._points)
+        return self._owners[i]
+
+
+# Room tables (messages, read_watermarks, attachments, search_index) live
+# in the shard file of their room; everything else stays in DB_PATH.
+# Shard 0 is DB_PATH itself. Set from the shards table by init_db().
+_shard_map = ShardMap()
+
+
+def shard_path(shard):
+    """Database file of a shard: chat.db, chat-shard1.db, ..."""
+    if shard == 0:
+        return DB_PATH
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}-shard{shard}{ext}"
+
+
+def shard_paths():
+    """Database files of every shard in use"""
+    return [shard_path(shard) for shard in _shard_map.shards]
+
+
+def room_shard(room):
+    return _shard_map.shard_for(room)
+
+
+def room_db(room):
+    """Pooled connection to the shard holding a room's tables"""
+    return get_db(shard_path(_shard_map.shard_for(room)))
+
+
+# Optional group-commit stage for hot-path writes (see enable_write_behind)
+_write_behind = None
+
+
+def _run_write_batch(ops):
+    """Apply queued writes in one transaction per shard"""
+    start = time.perf_counter()
+    # Every queued op takes its room first; order is kept within a shard
+    by_shard = {}
+    for op, args in ops:
+        by_shard.setdefault(room_shard(args[0]), []).append((op, args))
+    for shard, shard_ops in by_shard.items():
+        with get_db(shard_path(shard)) as conn:
+            cur = conn.cursor()
+            for op, args in shard_ops:
+                try:
+                    op(cur, *args)
+                except sqlite3.IntegrityError:
+                    pass  # Duplicate row; the rest of the batch still commits
+            conn.commit()
+    DB_SECONDS.observe(time.perf_counter() - start, "write_batch")
+    DB_BATCH_ROWS.observe(len(ops))
+
+
+def enable_write_behind(durability=DURABILITY_ASYNC, interval_ms=None,
+                        max_rows=None, limit=None):
+    """Route message and receipt writes through a group-commit queue"""
+    global _write_behind
+    if _write_behind is None:
+        _write_behind = WriteBehindQueue(
+            _run_write_batch,
+            interval_ms=interval_ms,
+            max_rows=max_rows,
+            limit=limit,
+            durability=durability,
+            on_done=lambda ops: _queued_writes_done([(op.__name__, args) for op, args in ops])
+        )
+        _write_behind.start()
+    return _write_behind
+
+
+def disable_write_behind():
+    """Drain queued writes and go back to committing every statement"""
+    global _write_behind
+    if _write_behind is not None:
+        _write_behind.stop()
+        _write_behind = None
+
+
+def write_behind_pending():
+    """Writes waiting in the write-behind queue (0 when it is off)"""
+    return _write_behind.pending if _write_behind is not None else 0
+
+
+# Optional append-only log for hot-path writes (see open_message_log)
+_message_log = None
+_log_replay = {}
+
+SET_LOG_POSITION_SQL = "INSERT OR REPLACE INTO message_log_position (id, lsn) VALUES (0, ?)"
+
+
+def _log_position(cur):
+    cur.execute("SELECT lsn FROM message_log_position WHERE id = 0")
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def _apply_log_batch(records):
+    """
+    Apply message log records in one transaction per shard. Each shard
+    saves the position of its last record in the same transaction, so a
+    replay skips exactly what it already has. Commits are fsynced: the
+    log segments are deleted once their records are applied.
+    Returns: records applied (not skipped)
+    """
+    start = time.perf_counter()
+    applied_count = 0
+    by_shard = {}
+    for lsn, name, args in records:
+        by_shard.setdefault(room_shard(args[0]), []).append((lsn, _LOGGED_OPS[name], args))
+    for shard, shard_records in by_shard.items():
+        with get_db(shard_path(shard)) as conn:
+            conn.execute("PRAGMA synchronous=FULL")
+            try:
+                cur = conn.cursor()
+                applied = _log_position(cur)
+                for lsn, op, args in shard_records:
+                    if lsn <= applied:
+                        continue
+                    applied_count += 1
+                    try:
+                        op(cur, *args)
+                    except sqlite3.IntegrityError:
+                        pass  # Duplicate row; the rest of the batch still commits
+                cur.execute(SET_LOG_POSITION_SQL, (max(applied, shard_records[-1][0]),))
+                conn.commit()
+            finally:
+                conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+    DB_SECONDS.observe(time.perf_counter() - start, "log_batch")
+    DB_BATCH_ROWS.observe(len(records))
+    return applied_count
+
+
+def _last_log_position():
+    """Newest message log position applied to any shard"""
+    last = 0
+    for path in shard_paths():
+        with get_db(path) as conn:
+            last = max(last, _log_position(conn.cursor()))
+    return last
+
+
+def message_log_dir():
+    if MESSAGE_LOG_DIR:
+        return MESSAGE_LOG_DIR
+    return os.path.splitext(DB_PATH)[0] + "-log"
+
+
+def open_message_log():
+    """
+    Replay whatever a previous run left in the message log, then, if
+    MESSAGE_LOG_MODE is set, append message and receipt writes to the log
+    while a background indexer applies them here. Call after init_db().
+    Returns: (records replayed, seconds)
+    """
+    global _message_log, _log_replay
+    if not MESSAGE_LOG_MODE and not os.path.isdir(message_log_dir()):
+        return 0, 0.0
+    log = MessageLog(
+        message_log_dir(), _apply_log_batch, _last_log_position,
+        durability=MESSAGE_LOG_MODE or DURABILITY_ASYNC,
+        on_indexed=_queued_writes_done
+    )
+    replayed, seconds = log.replay()
+    _log_replay = {"replayed": replayed, "replay_seconds": seconds}
+    if replayed:
+        print(f"✅ Replayed {replayed:,} message log record(s) in {seconds:.2f}s")
+    if MESSAGE_LOG_MODE and _message_log is None:
+        log.start()
+        _message_log = log
+    return replayed, seconds
+
+
+def close_message_log():
+    """Index everything still in the message log and stop appending to it"""
+    global _message_log
+    if _message_log is not None:
+        _message_log.stop()
+        _message_log = None
+
+
+def message_log_stats():
+    """The startup replay and, while the log is on, its counters and unindexed bytes"""
+    stats = dict(_log_replay)
+    if _message_log is not None:
+        stats.update(_message_log.stats, unindexed_bytes=_message_log.unindexed_bytes)
+    return stats
+
+
+# Message writes per room waiting in the message log or write-behind
+# queue. A room's history read from the database while it has any may
+# miss them, so the watcher is told when a room gets its first and
+# loses its last one (see watch_queued_writes).
+_queued_history = {}
+_queued_lock = threading.Lock()
+_queued_watcher = None
+
+
+def watch_queued_writes(callback):
+    """
+    Call callback(room, queued) when a room gets queued message writes
+    (queued=True) and once they have all been applied or lost (False).
+    """
+    global _queued_watcher
+    _queued_watcher = callback
+
+
+def _count_queued(room, delta):
+    with _queued_lock:
+        before = _queued_history.get(room, 0)
+        after = max(before + delta, 0)
+        if after:
+            _queued_history[room] = after
+        else:
+            _queued_history.pop(room, None)
+        # Told under the lock, so a room's changes arrive in order
+        if _queued_watcher and bool(before) != bool(after):
+            _queued_watcher(room, bool(after))
+
+
+def _queued_writes_done(ops):
+    """Called with the (op name, args) of queued writes that were applied or lost"""
+    for name, args in ops:
+        if name in _HISTORY_OPS:
+            _count_queued(args[0], -1)
+
+
+def _write(op, *args):
+    """
+    Append a write to the message log or the write-behind queue when
+    either is on, otherwise run it in its own transaction. Writes that
+    touch queued rows (edits, deletes) take the same path so they apply
+    in order. The first argument of every op is its room, which picks
+    the shard.
+    """
+    queued = _message_log is not None or _write_behind is not None
+    if queued and op.__name__ in _HISTORY_OPS:
+        _count_queued(args[0], 1)
+
+    if _message_log is not None:
+        try:
+            _message_log.append(op.__name__, args)
+        except MessageLogError:
+            _queued_writes_done([(op.__name__, args)])
+            raise
+        return
+
+    if _write_behind is not None:
+        _write_behind.submit(op, args)
+        return
+
+    start = time.perf_counter()
+    with room_db(args[0]) as conn:
+        op(conn.cursor(), *args)
+        conn.commit()
+    DB_SECONDS.observe(time.perf_counter() - start, op.__name__.lstrip("_"))
+
+
+# Secondary indexes for the hot queries below; check_query_plans.py
+# fails if any of HOT_QUERIES stops using them. ROOM_INDEXES are on the
+# room tables and exist in every shard file.
+ROOM_INDEXES = [
+    # Room history: filter by room, skip deleted rows, keyset on id
+    """CREATE INDEX IF NOT EXISTS idx_messages_room_seq
+       ON messages (room, is_deleted, id)""",
+    """CREATE INDEX IF NOT EXISTS idx_attachments_message
+       ON attachments (message_id)""",
+    # Blob reference checks during garbage collection
+    """CREATE INDEX IF NOT EXISTS idx_attachments_blob
+       ON attachments (blob_id)""",
+    # Removing a message's tokens when it is edited or deleted
+    """CREATE INDEX IF NOT EXISTS idx_search_index_row
+       ON search_index (message_row)""",
+]
+
+INDEXES = [
+    """CREATE INDEX IF NOT EXISTS idx_blobs_last_used
+       ON blobs (last_used)""",
+    # Expired session cleanup and per-user session lookups
+    """CREATE INDEX IF NOT EXISTS idx_sessions_expires
+       ON sessions (expires_at)""",
+    """CREATE INDEX IF NOT EXISTS idx_sessions_username
+       ON sessions (username)""",
+    # A room's latest archive segment
+    """CREATE INDEX IF NOT EXISTS idx_archive_segments_latest
+       ON archive_segments (room)""",
+]
+
+
+# Indexes superseded by the ones above
+DROPPED_INDEXES = [
+    "idx_messages_room_history",
+    "idx_archive_segments_room",
+]
+
+
+# Columns added after the first release: (table, column, definition).
+# init_db() adds any that an existing database is missing.
+ADDED_COLUMNS = [
+    # Chunked attachments live in a file under media/files; file_data
+    # is only used by attachments uploaded in a single frame
+    ("attachments", "storage_path", "TEXT"),
+    ("attachments", "chunk_size", "INTEGER"),
+    ("attachments", "sha256", "TEXT"),
+    # Content-addressed blob under media/blobs (see server/blob_store.py)
+    ("attachments", "blob_id", "TEXT"),
+    ("attachments", "room", "TEXT"),
+    # Row ids change when a room moves to another shard; message ids don't
+    ("archive_segments", "last_message_id", "TEXT"),
+]
+
+
+def _migrate_read_receipts(cur):
+    """Fold the old one-row-per-message receipts into watermarks"""
+    cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'read_receipts'"
+    )
+    if cur.fetchone() is None:
+        return
+    cur.execute("""
+        INSERT OR IGNORE INTO read_watermarks (room, username, last_read_id)
+        SELECT m.room, r.username, MAX(m.id)
+        FROM read_receipts r JOIN messages m ON m.message_id = r.message_id
+        GROUP BY m.room, r.username
+    """)
+    cur.execute("DROP TABLE read_receipts")
+
+
+def _add_missing_columns(cur):
+    for table, column, definition in ADDED_COLUMNS:
+        existing = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+        # A shard file only has the room tables
+        if existing and column not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _create_room_tables(cur):
+    """
+    Tables whose rows belong to one room, kept in the room's shard, and
+    the shard's message log position
+    """
+    # Last message log record applied to this shard (see open_message_log)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS message_log_position (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            lsn INTEGER NOT NULL
+        )
+    """)
+
+    # Messages table with enhanced features
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id TEXT UNIQUE NOT NULL,
+            room TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            edited_at TIMESTAMP,
+            is_deleted INTEGER DEFAULT 0,
+            reply_to TEXT,
+            FOREIGN KEY (sender) REFERENCES users(username)
+        )
+    """)
+
+    # Read receipts: each user has read a room up to one message
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS read_watermarks (
+            room TEXT NOT NULL,
+            username TEXT NOT NULL,
+            last_read_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (room, username)
+        )
+    """)
+    _migrate_read_receipts(cur)
+
+    # Media attachments table
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            file_data BLOB NOT NULL,
+            file_size INTEGER NOT NULL,
+            FOREIGN KEY (message_id) REFERENCES messages(message_id)
+        )
+    """)
+
+    # Blind search index: one row per distinct word of a message, as
+    # a token keyed per room (see server/search.py)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS search_index (
+            token BLOB NOT NULL,
+            message_row INTEGER NOT NULL,
+            PRIMARY KEY (token, message_row)
+        ) WITHOUT ROWID
+    """)
+
+
+def init_shard(shard):
+    """Create the room tables in a shard file (shard 0 is done by init_db)"""
+    with get_db(shard_path(shard)) as conn:
+        cur = conn.cursor()
+        _create_room_tables(cur)
+        _add_missing_columns(cur)
+        for statement in ROOM_INDEXES:
+            cur.execute(statement)
+        conn.commit()
 
 
 def init_db():
     """Initialize database with all required tables"""
+    global _shard_map
     with get_db() as conn:
         cur = conn.cursor()
         
@@ -33,58 +607,73 @@ def init_db():
             )
         """)
         
-        # Messages table with enhanced features
+        # Messages, read watermarks, attachments and search tokens
+        _create_room_tables(cur)
+        
+        # Typing state is kept in memory (server/typing_tracker.py)
+        cur.execute("DROP TABLE IF EXISTS typing_status")
+        
+        # Attachment contents, shared by every attachment with equal bytes
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id TEXT UNIQUE NOT NULL,
+            CREATE TABLE IF NOT EXISTS blobs (
+                blob_id TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                chunk_size INTEGER NOT NULL,
+                wrapped_key TEXT NOT NULL,
+                last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Versioned room keys, wrapped with the server key. Version 0 is
+        # the key derived from the room name and is never stored.
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS room_keys (
                 room TEXT NOT NULL,
-                sender TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                edited_at TIMESTAMP,
-                is_deleted INTEGER DEFAULT 0,
-                reply_to TEXT,
-                FOREIGN KEY (sender) REFERENCES users(username)
+                version INTEGER NOT NULL,
+                wrapped_key TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (room, version)
             )
         """)
-        
-        # Read receipts table
+
+        # Re-encryption progress, one row per key rotation
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS read_receipts (
+            CREATE TABLE IF NOT EXISTS key_rotations (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id TEXT NOT NULL,
-                username TEXT NOT NULL,
-                read_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(message_id, username),
-                FOREIGN KEY (message_id) REFERENCES messages(message_id),
-                FOREIGN KEY (username) REFERENCES users(username)
+                room TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                upto_id INTEGER,
+                phase TEXT NOT NULL DEFAULT 'pending',
+                last_id INTEGER NOT NULL DEFAULT 0,
+                rewritten INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
             )
         """)
-        
-        # Typing indicators table
+
+        # Archival policy: messages older than archive_after_days move to
+        # compressed segment files. Room '*' applies to every other room.
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS typing_status (
-                room TEXT NOT NULL,
-                username TEXT NOT NULL,
-                last_typed TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (room, username)
+            CREATE TABLE IF NOT EXISTS retention_policies (
+                room TEXT PRIMARY KEY,
+                archive_after_days INTEGER  -- NULL: never archive
             )
         """)
-        
-        # Media attachments table
+
+        # Archive segment files (see server/maintenance.py)
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS attachments (
+            CREATE TABLE IF NOT EXISTS archive_segments (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id TEXT NOT NULL,
-                filename TEXT NOT NULL,
-                file_type TEXT NOT NULL,
-                file_data BLOB NOT NULL,
-                file_size INTEGER NOT NULL,
-                FOREIGN KEY (message_id) REFERENCES messages(message_id)
+                room TEXT NOT NULL,
+                path TEXT NOT NULL,
+                first_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                rows INTEGER NOT NULL,
+                bytes INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        
+
         # Sessions table
         cur.execute("""
             CREATE TABLE IF NOT EXISTS sessions (
@@ -95,11 +684,56 @@ def init_db():
                 FOREIGN KEY (username) REFERENCES users(username)
             )
         """)
-        
+
+        # Shards on the room hash ring (none: everything in this file).
+        # Changed only by reshard_db.py.
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS shards (
+                shard INTEGER PRIMARY KEY
+            )
+        """)
+
+        _add_missing_columns(cur)
+
+        # Indexes (IF NOT EXISTS also migrates older databases)
+        for name in DROPPED_INDEXES:
+            cur.execute(f"DROP INDEX IF EXISTS {name}")
+        for statement in ROOM_INDEXES + INDEXES:
+            cur.execute(statement)
+
         conn.commit()
-        print("✅ Database initialized successfully")
+        conn.execute("PRAGMA optimize")
 
+        cur.execute("SELECT shard FROM shards ORDER BY shard")
+        shards = [row[0] for row in cur.fetchall()]
 
+    _shard_map = ShardMap(shards or (0,))
+    for shard in _shard_map.shards:
+        if shard != 0:
+            init_shard(shard)
+    print("✅ Database initialized successfully")
+
+
+def get_shards():
+    """Shard numbers in use"""
+    return list(_shard_map.shards)
+
+
+def set_shards(shards):
+    """
+    Switch every room to a new shard set in one transaction. Only
+    reshard_db.py calls this, after copying the rooms that move.
+    """
+    global _shard_map
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM shards")
+        cur.executemany("INSERT INTO shards (shard) VALUES (?)", [(s,) for s in shards])
+        conn.commit()
+    _shard_map = ShardMap(shards)
+
+
+@_timed
 def create_user(username, password_hash):
     """Create a new user"""
     try:
@@ -115,14 +749,15 @@ def create_user(username, password_hash):
         return False
 
 
+GET_USER_SQL = "SELECT username, password_hash FROM users WHERE username = ?"
+
+
+@_timed
 def get_user(username):
     """Get user by username"""
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute(
-            "SELECT username, password_hash FROM users WHERE username = ?",
-            (username,)
-        )
+        cur.execute(GET_USER_SQL, (username,))
         return cur.fetchone()
 
 
@@ -137,140 +772,666 @@ def update_last_seen(username):
         conn.commit()
 
 
-def save_message(room, sender, message, message_id, reply_to=None):
-    """Save a message to the database"""
+@_timed
+def update_last_seen_many(usernames):
+    """Update last seen for several users at once"""
+    now = datetime.now()
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO messages (message_id, room, sender, message, reply_to)
-            VALUES (?, ?, ?, ?, ?)
-        """, (message_id, room, sender, message, reply_to))
+        cur.executemany(
+            "UPDATE users SET last_seen = ? WHERE username = ?",
+            [(now, username) for username in usernames]
+        )
         conn.commit()
 
 
-def fetch_room_history(room, limit=100):
-    """Fetch recent messages from a room"""
-    with get_db() as conn:
+INDEX_TOKEN_SQL = "INSERT OR IGNORE INTO search_index (token, message_row) VALUES (?, ?)"
+
+UNINDEX_MESSAGE_SQL = """
+    DELETE FROM search_index
+    WHERE message_row = (SELECT id FROM messages WHERE message_id = ?)
+"""
+
+
+def _insert_message(cur, room, sender, message, message_id, reply_to, tokens=(),
+                    timestamp=None):
+    cur.execute("""
+        INSERT INTO messages (message_id, room, sender, message, reply_to, timestamp)
+        VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+    """, (message_id, room, sender, message, reply_to, timestamp))
+    row_id = cur.lastrowid
+    cur.executemany(INDEX_TOKEN_SQL, [(token, row_id) for token in tokens])
+
+
+def save_message(room, sender, message, message_id, reply_to=None, tokens=()):
+    """Save a message and its search tokens to the database"""
+    # A logged message may reach the table long after it was sent
+    timestamp = None
+    if _message_log is not None:
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    _write(_insert_message, room, sender, message, message_id, reply_to, tokens, timestamp)
+
+
+# Keyset pagination: `id` increases with insertion order, so a page is
+# "the newest LIMIT rows below the cursor message's id" and never needs
+# OFFSET. The cursor is a message_id so pages cached in memory, whose
+# row ids are unknown, can hand out cursors too.
+FETCH_ROOM_HISTORY_SQL = """
+    SELECT id, sender, message, message_id, 
+           strftime('%H:%M', timestamp) as time,
+           reply_to, edited_at
+    FROM messages
+    WHERE room = ? AND is_deleted = 0
+    AND id < COALESCE((SELECT id FROM messages WHERE message_id = ?), ?)
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+# Upper bound used when there is no cursor
+NEWEST = 2 ** 63 - 1
+
+
+def _cursor_bound(before):
+    """
+    Fallback for a `before` cursor's row id: NEWEST when there is no
+    cursor, 0 (an empty page) when the cursor's message is not in the
+    table, e.g. still queued for a write or archived. Falling back to
+    NEWEST would serve the newest page again as if it were older.
+    """
+    return NEWEST if before is None else 0
+
+
+@_timed
+def fetch_room_history(room, limit=100, before=None):
+    """
+    Fetch a page of messages from a room, oldest first.
+    `before` is the message_id of the oldest message already loaded;
+    None fetches the newest page, an unknown one an empty page.
+    Returns: (rows, has_more)
+    """
+    with room_db(room) as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT sender, message, message_id, 
-                   strftime('%H:%M', timestamp) as time,
-                   reply_to, edited_at
-            FROM messages
-            WHERE room = ? AND is_deleted = 0
-            ORDER BY timestamp DESC
-            LIMIT ?
-        """, (room, limit))
-        return list(reversed(cur.fetchall()))
+        cur.execute(FETCH_ROOM_HISTORY_SQL, (room, before, _cursor_bound(before), limit + 1))
+        rows = cur.fetchall()
+        has_more = len(rows) > limit
+        return list(reversed(rows[:limit])), has_more
+
 
+DELETE_MESSAGE_SQL = "UPDATE messages SET is_deleted = 1 WHERE message_id = ?"
 
-def delete_message(message_id):
+
+def _soft_delete_message(cur, room, message_id):
+    cur.execute(DELETE_MESSAGE_SQL, (message_id,))
+    cur.execute(UNINDEX_MESSAGE_SQL, (message_id,))
+
+
+def delete_message(room, message_id):
     """Soft delete a message"""
-    with get_db() as conn:
+    _write(_soft_delete_message, room, message_id)
+
+
+EDIT_MESSAGE_SQL = """
+    UPDATE messages 
+    SET message = ?, edited_at = ?
+    WHERE message_id = ?
+"""
+
+
+def _update_message(cur, room, message_id, new_text, edited_at, tokens=None):
+    cur.execute(EDIT_MESSAGE_SQL, (new_text, edited_at, message_id))
+    if tokens is not None:
+        cur.execute(UNINDEX_MESSAGE_SQL, (message_id,))
+        cur.execute("SELECT id FROM messages WHERE message_id = ?", (message_id,))
+        row = cur.fetchone()
+        if row:
+            cur.executemany(INDEX_TOKEN_SQL, [(token, row[0]) for token in tokens])
+
+
+def edit_message(room, message_id, new_text, tokens=None):
+    """Edit an existing message; `tokens` replace its search tokens"""
+    _write(_update_message, room, message_id, new_text, datetime.now(), tokens)
+
+
+CLEAR_ROOM_SQL = "UPDATE messages SET is_deleted = 1 WHERE room = ?"
+
+UNINDEX_ROOM_SQL = """
+    DELETE FROM search_index
+    WHERE message_row IN (SELECT id FROM messages WHERE room = ?)
+"""
+
+
+def _soft_delete_room(cur, room):
+    cur.execute(CLEAR_ROOM_SQL, (room,))
+    cur.execute(UNINDEX_ROOM_SQL, (room,))
+
+
+def clear_room(room):
+    """Clear all messages in a room"""
+    _write(_soft_delete_room, room)
+
+
+def _advance_read_watermark(cur, room, username, message_id):
+    # Looked up at write time, so a message still queued for write-behind
+    # is found; the watermark never moves backwards
+    cur.execute("""
+        INSERT INTO read_watermarks (room, username, last_read_id)
+        SELECT room, ?, id FROM messages WHERE message_id = ? AND room = ?
+        ON CONFLICT (room, username) DO UPDATE
+        SET last_read_id = MAX(last_read_id, excluded.last_read_id),
+            updated_at = CURRENT_TIMESTAMP
+    """, (username, message_id, room))
+
+
+READ_POSITION_SQL = """
+    SELECT m.id,
+           (SELECT last_read_id FROM read_watermarks WHERE room = m.room AND username = ?)
+    FROM messages m
+    WHERE m.message_id = ? AND m.room = ?
+"""
+
+
+@_timed
+def read_position(room, username, message_id):
+    """
+    (row id of a message of the room, row id of the user's stored
+    watermark or None); (None, None) if the room has no such message
+    """
+    with room_db(room) as conn:
+        row = conn.execute(READ_POSITION_SQL, (username, message_id, room)).fetchone()
+        return tuple(row) if row else (None, None)
+
+
+def mark_read_up_to(room, username, message_id):
+    """Record that a user has read a room up to and including a message"""
+    _write(_advance_read_watermark, room, username, message_id)
+
+
+# Writes a message log record may name
+_LOGGED_OPS = {
+    op.__name__: op for op in (
+        _insert_message, _soft_delete_message, _update_message,
+        _soft_delete_room, _advance_read_watermark
+    )
+}
+
+# The ones that change what a room's history shows
+_HISTORY_OPS = {
+    op.__name__ for op in (
+        _insert_message, _soft_delete_message, _update_message, _soft_delete_room
+    )
+}
+
+
+GET_READ_WATERMARKS_SQL = """
+    SELECT w.username, m.message_id
+    FROM read_watermarks w JOIN messages m ON m.id = w.last_read_id
+    WHERE w.room = ?
+"""
+
+
+# Messages holding every token, newest first. The first token's posting
+# list drives the scan (CROSS JOIN keeps that order); the others are
+# primary key probes.
+SEARCH_MESSAGES_SQL = """
+    SELECT m.id, m.sender, m.message, m.message_id,
+           strftime('%H:%M', m.timestamp) as time,
+           m.reply_to, m.edited_at
+    FROM search_index s CROSS JOIN messages m ON m.id = s.message_row
+    WHERE s.token = ?
+    AND s.message_row < COALESCE((SELECT id FROM messages WHERE message_id = ?), ?)
+    AND m.room = ? AND m.is_deleted = 0
+    {}
+    ORDER BY s.message_row DESC
+    LIMIT ?
+"""
+
+SEARCH_ALSO_SQL = """
+    AND EXISTS (SELECT 1 FROM search_index WHERE token = ? AND message_row = s.message_row)
+"""
+
+# Postings counted per token, at most, to pick the rarest one
+POSTINGS_PROBE_LIMIT = 10_000
+
+COUNT_POSTINGS_SQL = "SELECT COUNT(*) FROM (SELECT 1 FROM search_index WHERE token = ? LIMIT ?)"
+
+
+def search_sql(terms):
+    return SEARCH_MESSAGES_SQL.format(SEARCH_ALSO_SQL * (terms - 1))
+
+
+@_timed
+def search_messages(room, tokens, limit=20, before=None):
+    """
+    Messages of a room whose search tokens include all of `tokens`,
+    newest first, below the `before` cursor (a message_id; an unknown
+    one gives no results).
+    Returns: (rows, has_more)
+    """
+    with room_db(room) as conn:
         cur = conn.cursor()
+        if len(tokens) > 1:
+            counts = {}
+            for token in tokens:
+                cur.execute(COUNT_POSTINGS_SQL, (token, POSTINGS_PROBE_LIMIT))
+                counts[token] = cur.fetchone()[0]
+            tokens = sorted(tokens, key=counts.get)
+
+        first, *others = tokens
         cur.execute(
-            "UPDATE messages SET is_deleted = 1 WHERE message_id = ?",
-            (message_id,)
+            search_sql(len(tokens)),
+            (first, before, _cursor_bound(before), room, *others, limit + 1)
+        )
+        rows = cur.fetchall()
+        return rows[:limit], len(rows) > limit
+
+
+def index_messages(room, entries):
+    """Add search tokens for a room's existing messages: [(messages.id, tokens)]"""
+    with room_db(room) as conn:
+        conn.executemany(
+            INDEX_TOKEN_SQL,
+            [(token, row_id) for row_id, tokens in entries for token in tokens]
         )
         conn.commit()
 
 
-def edit_message(message_id, new_text):
-    """Edit an existing message"""
-    with get_db() as conn:
+@_timed
+def get_read_watermarks(room):
+    """{username: id of the last message read} for a room"""
+    with room_db(room) as conn:
+        cur = conn.cursor()
+        cur.execute(GET_READ_WATERMARKS_SQL, (room,))
+        return {row["username"]: row["message_id"] for row in cur.fetchall()}
+
+
+@_timed
+def save_blob_attachment(message_id, room, filename, file_type, blob_id,
+                         file_size, chunk_size, sha256):
+    """Save the metadata of an attachment whose contents are in the blob store"""
+    with room_db(room) as conn:
         cur = conn.cursor()
         cur.execute("""
-            UPDATE messages 
-            SET message = ?, edited_at = ?
-            WHERE message_id = ?
-        """, (new_text, datetime.now(), message_id))
+            INSERT INTO attachments (message_id, room, filename, file_type, file_data,
+                                     file_size, blob_id, chunk_size, sha256)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (message_id, room, filename, file_type, b"", file_size,
+              blob_id, chunk_size, sha256))
         conn.commit()
 
 
-def clear_room(room):
-    """Clear all messages in a room"""
+# Attachments saved before they recorded their room take the room of
+# their message
+GET_ATTACHMENT_SQL = """
+    SELECT a.filename, a.file_type, a.file_data, a.file_size, a.storage_path,
+           a.chunk_size, a.sha256, a.blob_id, COALESCE(a.room, m.room) AS room
+    FROM attachments a
+    LEFT JOIN messages m ON m.message_id = a.message_id
+    WHERE a.message_id = ?
+"""
+
+BLOB_KEY_SQL = "SELECT wrapped_key FROM blobs WHERE blob_id = ?"
+
+
+@_timed
+def get_attachment(room, message_id):
+    """Get attachment for a message, with its blob's wrapped key"""
+    with room_db(room) as conn:
+        cur = conn.cursor()
+        cur.execute(GET_ATTACHMENT_SQL, (message_id,))
+        row = cur.fetchone()
+    if row is None:
+        return None
+
+    # Blobs are shared by every room, so they stay in the main file
+    attachment = dict(row, wrapped_key=None)
+    if row["blob_id"]:
+        with get_db() as conn:
+            key = conn.execute(BLOB_KEY_SQL, (row["blob_id"],)).fetchone()
+            attachment["wrapped_key"] = key[0] if key else None
+    return attachment
+
+
+@_timed
+def get_blob(blob_id):
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute(
-            "UPDATE messages SET is_deleted = 1 WHERE room = ?",
-            (room,)
+        cur.execute("SELECT * FROM blobs WHERE blob_id = ?", (blob_id,))
+        return cur.fetchone()
+
+
+def insert_blob(blob_id, size, chunk_size, wrapped_key):
+    with get_db() as conn:
+        conn.execute("""
+            INSERT INTO blobs (blob_id, size, chunk_size, wrapped_key)
+            VALUES (?, ?, ?, ?)
+        """, (blob_id, size, chunk_size, wrapped_key))
+        conn.commit()
+
+
+def touch_blob(blob_id):
+    """Mark a blob as just used, protecting it from garbage collection"""
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE blobs SET last_used = CURRENT_TIMESTAMP WHERE blob_id = ?",
+            (blob_id,)
         )
         conn.commit()
 
 
-def mark_message_read(message_id, username):
-    """Mark a message as read by a user"""
-    try:
-        with get_db() as conn:
+ORPHAN_BLOBS_SQL = """
+    SELECT blob_id FROM blobs b
+    WHERE last_used < datetime('now', ?)
+      AND NOT EXISTS (SELECT 1 FROM attachments a WHERE a.blob_id = b.blob_id)
+"""
+
+
+BLOB_REFERENCED_SQL = "SELECT 1 FROM attachments WHERE blob_id = ? LIMIT 1"
+
+
+def _blob_referenced_elsewhere(blob_id):
+    """Whether an attachment in a shard other than the main file uses a blob"""
+    for path in shard_paths()[1:]:
+        with get_db(path) as conn:
+            if conn.execute(BLOB_REFERENCED_SQL, (blob_id,)).fetchone():
+                return True
+    return False
+
+
+def find_orphan_blobs(grace_seconds):
+    """Blobs no attachment refers to, unused for at least grace_seconds"""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(ORPHAN_BLOBS_SQL, (f"-{int(grace_seconds)} seconds",))
+        orphans = [row[0] for row in cur.fetchall()]
+    return [blob_id for blob_id in orphans if not _blob_referenced_elsewhere(blob_id)]
+
+
+def delete_blob(blob_id, grace_seconds):
+    """Delete a blob row if it is still an orphan; returns True if deleted"""
+    # An upload touches its blob before saving the attachment, so the
+    # grace period covers a reference added after this check
+    if _blob_referenced_elsewhere(blob_id):
+        return False
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            DELETE FROM blobs WHERE blob_id = ?
+              AND last_used < datetime('now', ?)
+              AND NOT EXISTS (SELECT 1 FROM attachments WHERE blob_id = ?)
+        """, (blob_id, f"-{int(grace_seconds)} seconds", blob_id))
+        conn.commit()
+        return cur.rowcount > 0
+
+
+def list_unmigrated_attachments():
+    """(shard, id) of attachments still stored as BLOBs or per-room chunk files"""
+    unmigrated = []
+    for shard in get_shards():
+        with get_db(shard_path(shard)) as conn:
             cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO read_receipts (message_id, username)
-                VALUES (?, ?)
-            """, (message_id, username))
+            cur.execute("SELECT id FROM attachments WHERE blob_id IS NULL")
+            unmigrated.extend((shard, row[0]) for row in cur.fetchall())
+    return unmigrated
+
+
+def get_attachment_by_id(attachment_id, shard=0):
+    """An attachment row with the room of its message"""
+    with get_db(shard_path(shard)) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT a.*, COALESCE(a.room, m.room) AS message_room
+            FROM attachments a
+            LEFT JOIN messages m ON m.message_id = a.message_id
+            WHERE a.id = ?
+        """, (attachment_id,))
+        return cur.fetchone()
+
+
+def set_attachment_blob(attachment_id, room, blob_id, file_size, chunk_size, sha256):
+    """Point a migrated attachment at its blob and drop the inline copy"""
+    with room_db(room) as conn:
+        conn.execute("""
+            UPDATE attachments
+            SET room = ?, blob_id = ?, file_size = ?, chunk_size = ?, sha256 = ?,
+                file_data = X'', storage_path = NULL
+            WHERE id = ?
+        """, (room, blob_id, file_size, chunk_size, sha256, attachment_id))
+        conn.commit()
+
+
+# ----- Server key rotation (rotate_server_key.py) -----
+
+def list_wrapped_keys():
+    """Every key wrapped with the server key: [(table, key, wrapped_key)]"""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT room, version, wrapped_key FROM room_keys")
+        keys = [("room_keys", (row[0], row[1]), row[2]) for row in cur.fetchall()]
+        cur.execute("SELECT blob_id, wrapped_key FROM blobs")
+        keys.extend(("blobs", row[0], row[1]) for row in cur.fetchall())
+    return keys
+
+
+def set_room_key_wrapping(room, version, wrapped_key):
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE room_keys SET wrapped_key = ? WHERE room = ? AND version = ?",
+            (wrapped_key, room, version)
+        )
+        conn.commit()
+
+
+def blob_content_hash(blob_id):
+    """SHA-256 of a blob's file, from an attachment that uses it (None: unused)"""
+    for shard in get_shards():
+        with get_db(shard_path(shard)) as conn:
+            row = conn.execute(
+                "SELECT sha256 FROM attachments WHERE blob_id = ? AND sha256 IS NOT NULL LIMIT 1",
+                (blob_id,)
+            ).fetchone()
+            if row:
+                return row[0]
+    return None
+
+
+def rename_blob(blob_id, new_id, wrapped_key):
+    """
+    Give a blob a new id and key wrapping, and point its attachments at
+    it. The new row goes in first so no attachment is left without one.
+    """
+    with get_db() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO blobs (blob_id, size, chunk_size, wrapped_key, last_used)
+            SELECT ?, size, chunk_size, ?, last_used FROM blobs WHERE blob_id = ?
+        """, (new_id, wrapped_key, blob_id))
+        conn.commit()
+    for shard in get_shards():
+        with get_db(shard_path(shard)) as conn:
+            conn.execute("UPDATE attachments SET blob_id = ? WHERE blob_id = ?", (new_id, blob_id))
             conn.commit()
-    except sqlite3.IntegrityError:
-        pass  # Already marked as read
+    with get_db() as conn:
+        conn.execute("DELETE FROM blobs WHERE blob_id = ?", (blob_id,))
+        conn.commit()
 
 
-def get_read_receipts(message_id):
-    """Get all users who read a message"""
+def set_blob_wrapping(blob_id, wrapped_key):
+    with get_db() as conn:
+        conn.execute("UPDATE blobs SET wrapped_key = ? WHERE blob_id = ?", (wrapped_key, blob_id))
+        conn.commit()
+
+
+def clear_search_index():
+    """Drop every search token (they are rebuilt with the new key)"""
+    for shard in get_shards():
+        with get_db(shard_path(shard)) as conn:
+            conn.execute("DELETE FROM search_index")
+            conn.commit()
+
+
+GET_ROOM_KEYS_SQL = """
+    SELECT version, wrapped_key FROM room_keys
+    WHERE room = ?
+    ORDER BY version DESC
+"""
+
+
+@_timed
+def get_room_keys(room):
+    """Stored keys of a room, newest first"""
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT username, read_at
-            FROM read_receipts
-            WHERE message_id = ?
-        """, (message_id,))
+        cur.execute(GET_ROOM_KEYS_SQL, (room,))
         return cur.fetchall()
 
 
-def update_typing_status(room, username):
-    """Update typing indicator for user in room"""
+ROOM_KEY_VERSION_SQL = "SELECT MAX(version) FROM room_keys WHERE room = ?"
+
+
+@_timed
+def get_room_key_version(room):
+    """Current key version of a room (0: the derived key)"""
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            INSERT OR REPLACE INTO typing_status (room, username, last_typed)
-            VALUES (?, ?, ?)
-        """, (room, username, datetime.now()))
+        cur.execute(ROOM_KEY_VERSION_SQL, (room,))
+        return cur.fetchone()[0] or 0
+
+
+def add_room_key(room, wrapped_key):
+    """
+    Store a new key version for a room and queue the re-encryption of
+    its existing rows. Returns the new version.
+    """
+    with get_db() as conn:
+        cur = conn.cursor()
+        # Take the write lock first so two rotations cannot pick one version
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(ROOM_KEY_VERSION_SQL, (room,))
+        version = (cur.fetchone()[0] or 0) + 1
+        cur.execute(
+            "INSERT INTO room_keys (room, version, wrapped_key) VALUES (?, ?, ?)",
+            (room, version, wrapped_key)
+        )
+        cur.execute(
+            "INSERT INTO key_rotations (room, version) VALUES (?, ?)",
+            (room, version)
+        )
         conn.commit()
+        return version
+
 
+def list_rooms(shard=None):
+    """Every room that has messages (in one shard file, if given)"""
+    rooms = []
+    for number in get_shards() if shard is None else [shard]:
+        with get_db(shard_path(number)) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT DISTINCT room FROM messages")
+            rooms.extend(row[0] for row in cur.fetchall() if row[0] not in rooms)
+    return rooms
 
-def get_typing_users(room):
-    """Get users currently typing in a room (within last 3 seconds)"""
+
+def next_key_rotation(min_age_seconds):
+    """Oldest unfinished rotation created at least min_age_seconds ago"""
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("""
-            SELECT username
-            FROM typing_status
-            WHERE room = ?
-            AND datetime(last_typed) > datetime('now', '-3 seconds')
-        """, (room,))
-        return [row[0] for row in cur.fetchall()]
+            SELECT * FROM key_rotations
+            WHERE finished_at IS NULL AND created_at <= datetime('now', ?)
+            ORDER BY id
+            LIMIT 1
+        """, (f"-{int(min_age_seconds)} seconds",))
+        return cur.fetchone()
 
 
-def save_attachment(message_id, filename, file_type, file_data):
-    """Save file attachment"""
+def list_key_rotations():
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO attachments (message_id, filename, file_type, file_data, file_size)
-            VALUES (?, ?, ?, ?, ?)
-        """, (message_id, filename, file_type, file_data, len(file_data)))
+        cur.execute("SELECT * FROM key_rotations ORDER BY id")
+        return cur.fetchall()
+
+
+def begin_key_rotation(rotation_id, room):
+    """Fix the last message id a rotation covers; later rows use the new key"""
+    with room_db(room) as conn:
+        upto_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    with get_db() as conn:
+        conn.execute("""
+            UPDATE key_rotations
+            SET upto_id = ?, phase = 'messages:0'
+            WHERE id = ? AND upto_id IS NULL
+        """, (upto_id, rotation_id))
         conn.commit()
 
 
-def get_attachment(message_id):
-    """Get attachment for a message"""
+REKEY_MESSAGES_SQL = """
+    SELECT id, message FROM messages
+    WHERE room = ? AND is_deleted = ? AND id > ? AND id <= ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+
+def fetch_rekey_messages(room, is_deleted, after_id, upto_id, limit):
+    with room_db(room) as conn:
+        cur = conn.cursor()
+        cur.execute(REKEY_MESSAGES_SQL, (room, is_deleted, after_id, upto_id, limit))
+        return cur.fetchall()
+
+
+def fetch_rekey_attachments(room, after_id, limit):
+    """Attachments still stored encrypted with the room key, in id order"""
+    with room_db(room) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT a.id, a.file_data FROM attachments a
+            LEFT JOIN messages m ON m.message_id = a.message_id
+            WHERE a.id > ? AND a.blob_id IS NULL AND a.storage_path IS NULL
+              AND COALESCE(a.room, m.room) = ?
+            ORDER BY a.id
+            LIMIT ?
+        """, (after_id, room, limit))
+        return cur.fetchall()
+
+
+# Rewritten row tables and their encrypted column
+REKEY_COLUMNS = {"messages": "message", "attachments": "file_data"}
+
+
+def save_rekey_batch(rotation_id, room, table, updates, phase, last_id):
+    """
+    Write re-encrypted values, then the rotation checkpoint. `updates`
+    holds (new, id, old); a row changed since it was read (e.g. edited)
+    keeps its newer value. The rows may be in a shard file: if the
+    checkpoint is lost, the batch is redone and its rows, already under
+    the new key, are skipped.
+    """
+    column = REKEY_COLUMNS[table]
+    if updates:
+        with room_db(room) as conn:
+            conn.executemany(
+                f"UPDATE {table} SET {column} = ? WHERE id = ? AND {column} = ?", updates
+            )
+            conn.commit()
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("""
-            SELECT filename, file_type, file_data, file_size
-            FROM attachments
-            WHERE message_id = ?
-        """, (message_id,))
-        return cur.fetchone()
+            UPDATE key_rotations
+            SET phase = ?, last_id = ?, rewritten = rewritten + ?
+            WHERE id = ?
+        """, (phase, last_id, len(updates), rotation_id))
+        conn.commit()
+
+
+def finish_key_rotation(rotation_id):
+    with get_db() as conn:
+        conn.execute("""
+            UPDATE key_rotations SET phase = 'done', finished_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, (rotation_id,))
+        conn.commit()
 
 
+@_timed
 def create_session(session_id, username, expires_in_hours=24):
     """Create user session"""
     from datetime import timedelta
@@ -285,23 +1446,428 @@ def create_session(session_id, username, expires_in_hours=24):
         conn.commit()
 
 
+VALIDATE_SESSION_SQL = """
+    SELECT username, (julianday(expires_at) - julianday('now')) * 86400
+    FROM sessions
+    WHERE session_id = ?
+    AND datetime(expires_at) > datetime('now')
+"""
+
+
+@_timed
 def validate_session(session_id):
-    """Validate and return username for session"""
+    """
+    Validate a session
+    Returns: (username, seconds until it expires) or None
+    """
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT username
-            FROM sessions
-            WHERE session_id = ?
-            AND datetime(expires_at) > datetime('now')
-        """, (session_id,))
+        cur.execute(VALIDATE_SESSION_SQL, (session_id,))
         result = cur.fetchone()
-        return result[0] if result else None
+        return (result[0], result[1]) if result else None
+
+
+DELETE_SESSION_SQL = "DELETE FROM sessions WHERE session_id = ?"
 
 
 def delete_session(session_id):
     """Delete a session (logout)""" 
     with get_db() as conn:
         cur = conn.cursor()
-        cur.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
-        conn.commit()
\ No newline at end of file
+        cur.execute(DELETE_SESSION_SQL, (session_id,))
+        conn.commit()
+
+
+# ----- Retention and compaction (server/maintenance.py) -----
+
+def set_retention_policy(room, archive_after_days):
+    """Archive a room's messages after this many days (None: keep them)"""
+    with get_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO retention_policies (room, archive_after_days) VALUES (?, ?)",
+            (room, archive_after_days)
+        )
+        conn.commit()
+
+
+def clear_retention_policy(room):
+    """Drop a room's own policy so the '*' default applies again"""
+    with get_db() as conn:
+        conn.execute("DELETE FROM retention_policies WHERE room = ?", (room,))
+        conn.commit()
+
+
+def get_retention_policies():
+    """{room: archive_after_days}, with '*' for the default"""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT room, archive_after_days FROM retention_policies")
+        return {row[0]: row[1] for row in cur.fetchall()}
+
+
+ARCHIVE_MESSAGES_SQL = """
+    SELECT id, message_id, sender, message, timestamp, edited_at, reply_to
+    FROM messages
+    WHERE room = ? AND is_deleted = 0 AND id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+
+def fetch_archive_messages(room, after_id, limit):
+    """Live messages of a room after `after_id`, oldest first"""
+    with room_db(room) as conn:
+        cur = conn.cursor()
+        cur.execute(ARCHIVE_MESSAGES_SQL, (room, after_id, limit))
+        return cur.fetchall()
+
+
+ARCHIVE_ATTACHMENTS_SQL = """
+    SELECT id, filename, file_type, file_data, file_size, storage_path,
+           chunk_size, sha256, blob_id
+    FROM attachments
+    WHERE message_id = ?
+    ORDER BY id
+"""
+
+
+def fetch_archive_attachments(room, message_ids):
+    """{message_id: [attachment rows]} for messages about to be archived"""
+    attachments = {}
+    with room_db(room) as conn:
+        cur = conn.cursor()
+        for message_id in message_ids:
+            cur.execute(ARCHIVE_ATTACHMENTS_SQL, (message_id,))
+            rows = cur.fetchall()
+            if rows:
+                attachments[message_id] = rows
+    return attachments
+
+
+def save_archive_segment(room, path, first_id, last_id, last_message_id, rows, size):
+    """Record a written segment file; delete_archived_messages() removes its rows"""
+    with get_db() as conn:
+        conn.execute("""
+            INSERT INTO archive_segments
+                (room, path, first_id, last_id, last_message_id, rows, bytes)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (room, path, first_id, last_id, last_message_id, rows, size))
+        conn.commit()
+
+
+LAST_ARCHIVED_SQL = """
+    SELECT last_message_id FROM archive_segments
+    WHERE room = ?
+    ORDER BY id DESC
+    LIMIT 1
+"""
+
+ARCHIVED_MESSAGES_SQL = """
+    SELECT id, message_id FROM messages
+    WHERE room = ? AND is_deleted = 0
+    AND id <= COALESCE((SELECT id FROM messages WHERE message_id = ?), 0)
+    ORDER BY id
+    LIMIT ?
+"""
+
+
+def last_archived_message(room):
+    """message_id of the newest message a segment of the room holds"""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(LAST_ARCHIVED_SQL, (room,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+
+def delete_archived_messages(room, last_message_id, limit):
+    """
+    Delete up to `limit` live messages (with their search tokens and
+    attachment rows) up to the last one a segment holds. Rows are deleted
+    oldest first, so once that message is gone nothing is left. Returns
+    the number deleted.
+    """
+    with room_db(room) as conn:
+        cur = conn.cursor()
+        cur.execute(ARCHIVED_MESSAGES_SQL, (room, last_message_id, limit))
+        rows = cur.fetchall()
+        ids = [(row["id"],) for row in rows]
+        cur.executemany("DELETE FROM search_index WHERE message_row = ?", ids)
+        cur.executemany(
+            "DELETE FROM attachments WHERE message_id = ?",
+            [(row["message_id"],) for row in rows]
+        )
+        cur.executemany("DELETE FROM messages WHERE id = ?", ids)
+        conn.commit()
+        return len(rows)
+
+
+def list_archive_segments(room=None):
+    with get_db() as conn:
+        cur = conn.cursor()
+        if room is None:
+            cur.execute("SELECT * FROM archive_segments ORDER BY room, id")
+        else:
+            cur.execute(
+                "SELECT * FROM archive_segments WHERE room = ? ORDER BY id", (room,)
+            )
+        return cur.fetchall()
+
+
+TOMBSTONES_SQL = """
+    SELECT id, message_id FROM messages
+    WHERE room = ? AND is_deleted = 1 AND id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+
+def purge_tombstones(room, after_id, limit):
+    """
+    Hard-delete up to `limit` soft-deleted messages of a room, with
+    their attachment rows, in one short transaction.
+    Returns: (messages deleted, attachments deleted, last id)
+    """
+    with room_db(room) as conn:
+        cur = conn.cursor()
+        cur.execute(TOMBSTONES_SQL, (room, after_id, limit))
+        rows = cur.fetchall()
+        if not rows:
+            return 0, 0, after_id
+        cur.executemany(
+            "DELETE FROM attachments WHERE message_id = ?",
+            [(row["message_id"],) for row in rows]
+        )
+        attachments = cur.rowcount
+        cur.executemany("DELETE FROM messages WHERE id = ?", [(row["id"],) for row in rows])
+        conn.commit()
+        return len(rows), attachments, rows[-1]["id"]
+
+
+EXPIRED_SESSIONS_SQL = "SELECT session_id FROM sessions WHERE expires_at < ? LIMIT ?"
+
+
+def purge_expired_sessions(limit):
+    """Delete up to `limit` expired sessions; returns their ids"""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(EXPIRED_SESSIONS_SQL, (datetime.now(), limit))
+        session_ids = [row[0] for row in cur.fetchall()]
+        cur.executemany(DELETE_SESSION_SQL, [(session_id,) for session_id in session_ids])
+        conn.commit()
+        return session_ids
+
+
+def database_pages(path=None):
+    """(auto_vacuum mode, page size, pages, free pages) of a database file"""
+    with get_db(path) as conn:
+        return tuple(
+            conn.execute(f"PRAGMA {name}").fetchone()[0]
+            for name in ("auto_vacuum", "page_size", "page_count", "freelist_count")
+        )
+
+
+def incremental_vacuum(pages, path=None):
+    """Give up to `pages` free pages back to the file system"""
+    with get_db(path) as conn:
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        conn.commit()
+        # In WAL mode the file only shrinks when the change is checkpointed
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+
+
+def full_vacuum(path=None):
+    """
+    Rebuild a database file, switching it to incremental auto-vacuum.
+    Locks it for the whole rebuild: run with the server stopped.
+    """
+    with get_db(path) as conn:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+
+# Moving rooms between shard files (server/reshard.py, server stopped)
+MOVE_BATCH_ROWS = 5000
+
+MESSAGE_COLUMNS = (
+    "message_id", "room", "sender", "message", "timestamp", "edited_at", "is_deleted", "reply_to"
+)
+ATTACHMENT_COLUMNS = (
+    "message_id", "filename", "file_type", "file_data", "file_size",
+    "storage_path", "chunk_size", "sha256", "blob_id", "room"
+)
+
+ROOM_ATTACHMENTS_SQL = """
+    SELECT a.* FROM attachments a
+    LEFT JOIN messages m ON m.message_id = a.message_id
+    WHERE COALESCE(a.room, m.room) = ? AND a.id > ?
+    ORDER BY a.id
+    LIMIT ?
+"""
+
+
+def shard_rooms(shard):
+    """Rooms with any rows in a shard file"""
+    with get_db(shard_path(shard)) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT room FROM messages
+            UNION SELECT room FROM read_watermarks
+            UNION SELECT room FROM attachments WHERE room IS NOT NULL
+        """)
+        return [row[0] for row in cur.fetchall()]
+
+
+def _delete_room_rows(cur, room):
+    cur.execute(UNINDEX_ROOM_SQL, (room,))
+    cur.execute("""
+        DELETE FROM attachments WHERE room = ?
+        OR (room IS NULL AND message_id IN (SELECT message_id FROM messages WHERE room = ?))
+    """, (room, room))
+    cur.execute("DELETE FROM messages WHERE room = ?", (room,))
+    cur.execute("DELETE FROM read_watermarks WHERE room = ?", (room,))
+
+
+def drop_room(room, shard):
+    """Delete all of a room's rows from one shard file"""
+    with get_db(shard_path(shard)) as conn:
+        _delete_room_rows(conn.cursor(), room)
+        conn.commit()
+
+
+def copy_room(room, source, target):
+    """
+    Copy a room's rows from one shard file to another in a single
+    transaction on the target, replacing an earlier partial copy.
+    Messages and attachments get new ids there in the same order;
+    search tokens and read watermarks follow their messages.
+    Returns the number of messages copied.
+    """
+    with get_db(shard_path(source)) as src, get_db(shard_path(target)) as dst:
+        cur = dst.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        _delete_room_rows(cur, room)
+
+        watermarks = src.execute(
+            "SELECT username, last_read_id, updated_at FROM read_watermarks WHERE room = ?",
+            (room,)
+        ).fetchall()
+        # New id of the newest copied message at or below each watermark
+        read_up_to = {}
+
+        copied = after_id = 0
+        while True:
+            rows = src.execute(f"""
+                SELECT id, {", ".join(MESSAGE_COLUMNS)} FROM messages
+                WHERE room = ? AND id > ? ORDER BY id LIMIT ?
+            """, (room, after_id, MOVE_BATCH_ROWS)).fetchall()
+            if not rows:
+                break
+
+            new_ids = {}
+            for row in rows:
+                cur.execute(
+                    f"INSERT INTO messages ({', '.join(MESSAGE_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(MESSAGE_COLUMNS))})",
+                    tuple(row)[1:]
+                )
+                new_ids[row["id"]] = cur.lastrowid
+
+            tokens = src.execute(
+                "SELECT token, message_row FROM search_index WHERE message_row BETWEEN ? AND ?",
+                (rows[0]["id"], rows[-1]["id"])
+            ).fetchall()
+            cur.executemany(INDEX_TOKEN_SQL, [
+                (token, new_ids[row_id]) for token, row_id in tokens if row_id in new_ids
+            ])
+
+            old_ids = [row["id"] for row in rows]
+            for mark in watermarks:
+                i = bisect.bisect_right(old_ids, mark["last_read_id"])
+                if i:
+                    read_up_to[mark["username"]] = new_ids[old_ids[i - 1]]
+
+            copied += len(rows)
+            after_id = rows[-1]["id"]
+
+        cur.executemany("""
+            INSERT INTO read_watermarks (room, username, last_read_id, updated_at)
+            VALUES (?, ?, ?, ?)
+        """, [
+            (room, mark["username"], read_up_to[mark["username"]], mark["updated_at"])
+            for mark in watermarks if mark["username"] in read_up_to
+        ])
+
+        after_id = 0
+        while True:
+            rows = src.execute(ROOM_ATTACHMENTS_SQL, (room, after_id, MOVE_BATCH_ROWS)).fetchall()
+            if not rows:
+                break
+            # Legacy rows without a room get it here; it is known from now on
+            cur.executemany(
+                f"INSERT INTO attachments ({', '.join(ATTACHMENT_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(ATTACHMENT_COLUMNS))})",
+                [tuple(room if column == "room" else row[column] for column in ATTACHMENT_COLUMNS)
+                 for row in rows]
+            )
+            after_id = rows[-1]["id"]
+
+        dst.commit()
+        return copied
+
+
+# Queries on the per-message path, with sample parameters for EXPLAIN
+HOT_QUERIES = {
+    "get_user": (GET_USER_SQL, ("alice",)),
+    "fetch_room_history": (FETCH_ROOM_HISTORY_SQL, ("general", "m1", NEWEST, 51)),
+    "delete_message": (DELETE_MESSAGE_SQL, ("m1",)),
+    "edit_message": (EDIT_MESSAGE_SQL, ("text", None, "m1")),
+    "clear_room": (CLEAR_ROOM_SQL, ("general",)),
+    "read_watermarks": (GET_READ_WATERMARKS_SQL, ("general",)),
+    "get_attachment": (GET_ATTACHMENT_SQL, ("m1",)),
+    "orphan_blobs": (ORPHAN_BLOBS_SQL, ("-3600 seconds",)),
+    "get_room_keys": (GET_ROOM_KEYS_SQL, ("general",)),
+    "room_key_version": (ROOM_KEY_VERSION_SQL, ("general",)),
+    "rekey_messages": (REKEY_MESSAGES_SQL, ("general", 0, 0, NEWEST, 200)),
+    "search_messages": (search_sql(2), (b"t1", "m1", NEWEST, "general", b"t2", 21)),
+    "count_postings": (COUNT_POSTINGS_SQL, (b"t1", POSTINGS_PROBE_LIMIT)),
+    "unindex_message": (UNINDEX_MESSAGE_SQL, ("m1",)),
+    "unindex_room": (UNINDEX_ROOM_SQL, ("general",)),
+    "archive_messages": (ARCHIVE_MESSAGES_SQL, ("general", 0, 5000)),
+    "archived_messages": (ARCHIVED_MESSAGES_SQL, ("general", "m1", 500)),
+    "last_archived": (LAST_ARCHIVED_SQL, ("general",)),
+    "read_position": (READ_POSITION_SQL, ("alice", "m1", "general")),
+    "archive_attachments": (ARCHIVE_ATTACHMENTS_SQL, ("m1",)),
+    "tombstones": (TOMBSTONES_SQL, ("general", 0, 500)),
+    "expired_sessions": (EXPIRED_SESSIONS_SQL, ("2024-01-01", 500)),
+    "validate_session": (VALIDATE_SESSION_SQL, ("s1",)),
+    "delete_session": (DELETE_SESSION_SQL, ("s1",)),
+}
+
+
+def explain_query_plan(sql, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement"""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row["detail"] for row in cur.fetchall()]
+
+
+def find_slow_query_plans():
+    """
+    Check every hot query's plan.
+    Returns {name: plan} for queries that scan a whole table or sort
+    through a temporary B-tree instead of walking an index.
+    """
+    slow = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = explain_query_plan(sql, params)
+        for detail in plan:
+            # "SCAN (subquery-N)" reads a subquery's rows, not a table
+            full_scan = (detail.startswith("SCAN ") and " USING " not in detail
+                         and not detail.startswith("SCAN (subquery"))
+            if full_scan or "TEMP B-TREE" in detail:
+                slow[name] = plan
+                break
+    return slow
\ No newline at end of file
@@ -0,0 +1,301 @@
+# server/maintenance.py
+import base64
+import gzip
+import json
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+from server import database
+from server.auth import sessions_ended
+from server.blob_store import collect_garbage
+
+# Segment files of archived messages: archive/<room>/<first id>-<last id>.jsonl.gz
+ARCHIVE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "archive"
+)
+
+ARCHIVE_SEGMENT_ROWS = 5000      # messages per segment file (and per delete)
+PURGE_BATCH_ROWS = 500           # tombstones / sessions deleted per transaction
+VACUUM_STEP_PAGES = 256          # free pages released per incremental vacuum
+MAINTENANCE_PAUSE = 0.05         # seconds between batches, so writers get the lock
+MAINTENANCE_INTERVAL = 6 * 60 * 60   # seconds between scheduled runs (0: off)
+
+# Only one process of a multi-process server runs the worker
+MAINTENANCE_ENABLED = True
+
+_worker = None
+
+
+def _pause(stop):
+    if stop is not None:
+        return stop.wait(MAINTENANCE_PAUSE)
+    time.sleep(MAINTENANCE_PAUSE)
+    return False
+
+
+def database_bytes():
+    """Size of the database and shard files plus their WALs"""
+    total = 0
+    for db_path in database.shard_paths():
+        for path in (db_path, db_path + "-wal"):
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+    return total
+
+
+def _write_segment(room, rows):
+    """
+    Write rows to a gzip JSON-lines segment; returns (path, bytes).
+    Messages stay encrypted under the room key they had.
+    """
+    attachments = database.fetch_archive_attachments(room, [row["message_id"] for row in rows])
+    directory = os.path.join(ARCHIVE_DIR, quote(room, safe=""))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{rows[0]['id']:012d}-{rows[-1]['id']:012d}.jsonl.gz")
+
+    # Written aside and renamed: a crash never leaves a truncated segment,
+    # and a segment written again after a crash replaces the first copy
+    partial = path + ".part"
+    with gzip.open(partial, "wt", encoding="utf-8") as f:
+        for row in rows:
+            record = dict(row, room=room)
+            if row["message_id"] in attachments:
+                record["attachments"] = [
+                    _archive_attachment(attachment)
+                    for attachment in attachments[row["message_id"]]
+                ]
+            f.write(json.dumps(record, default=str) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+    return path, os.path.getsize(path)
+
+
+def _archive_attachment(row):
+    """
+    An attachment's metadata for a segment. Contents stored inline in the
+    database (encrypted with the room key) go along; blobs do not, and
+    are collected once no live message uses them.
+    """
+    attachment = dict(row)
+    data = attachment.pop("file_data")
+    if data:
+        attachment["file_data"] = base64.b64encode(data).decode()
+    return attachment
+
+
+def read_segment(path):
+    """Yield the archived messages of a segment file"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _delete_archived(room, last_message_id, stop):
+    """Delete archived rows in small batches; True if stopped early"""
+    while database.delete_archived_messages(room, last_message_id, PURGE_BATCH_ROWS) == PURGE_BATCH_ROWS:
+        if _pause(stop):
+            return True
+    return False
+
+
+def archive_room(room, days, stop=None):
+    """
+    Move a room's messages older than `days` to segment files.
+    Returns: (messages archived, segment files, compressed bytes)
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    archived = segments = size = 0
+
+    # Rows left behind by an interrupted run are already in a segment
+    if _delete_archived(room, database.last_archived_message(room), stop):
+        return archived, segments, size
+
+    after_id = 0
+    while True:
+        rows = database.fetch_archive_messages(room, after_id, ARCHIVE_SEGMENT_ROWS)
+        # Ids grow with time, so the old rows are a prefix of the batch
+        old = []
+        for row in rows:
+            if row["timestamp"] >= cutoff:
+                break
+            old.append(row)
+        if not old:
+            return archived, segments, size
+
+        path, written = _write_segment(room, [dict(row) for row in old])
+        last = old[-1]
+        database.save_archive_segment(
+            room, path, old[0]["id"], last["id"], last["message_id"], len(old), written
+        )
+        archived += len(old)
+        segments += 1
+        size += written
+        after_id = last["id"]
+
+        if _delete_archived(room, last["message_id"], stop) or len(old) < len(rows):
+            return archived, segments, size
+
+
+def purge_room_tombstones(room, stop=None):
+    """Hard-delete a room's soft-deleted messages; returns (messages, attachments)"""
+    messages = attachments = 0
+    after_id = 0
+    while True:
+        deleted, files, after_id = database.purge_tombstones(room, after_id, PURGE_BATCH_ROWS)
+        messages += deleted
+        attachments += files
+        if deleted < PURGE_BATCH_ROWS or _pause(stop):
+            return messages, attachments
+
+
+def purge_sessions(stop=None):
+    purged = 0
+    while True:
+        deleted = database.purge_expired_sessions(PURGE_BATCH_ROWS)
+        sessions_ended(deleted)
+        purged += len(deleted)
+        if len(deleted) < PURGE_BATCH_ROWS or _pause(stop):
+            return purged
+
+
+def vacuum(path=None, stop=None):
+    """Release a database file's free pages in small steps; returns pages released"""
+    mode, _, _, free = database.database_pages(path)
+    if mode != 2:  # not incremental
+        return 0
+    released = 0
+    while free > 0:
+        database.incremental_vacuum(VACUUM_STEP_PAGES, path)
+        _, _, _, left = database.database_pages(path)
+        released += free - left
+        if left >= free or _pause(stop):
+            break
+        free = left
+    return released
+
+
+def run_maintenance(stop=None, on_archived=None):
+    """
+    One maintenance pass: archive by room policy, purge tombstones and
+    expired sessions, collect orphaned blobs and vacuum. Every step is
+    a series of short transactions. on_archived(room) is called for each
+    room that lost messages to the archive. Returns a report dict.
+    """
+    started = time.perf_counter()
+    size_before = database_bytes()
+    report = {
+        "archived": 0, "segments": 0, "archive_bytes": 0,
+        "tombstones": 0, "attachments": 0, "sessions": 0,
+        "blob_files": 0, "pages_released": 0
+    }
+
+    policies = database.get_retention_policies()
+    default = policies.pop("*", None)
+    rooms = database.list_rooms()
+    for room in rooms:
+        days = policies.get(room, default)
+        if days is None:
+            continue
+        archived, segments, size = archive_room(room, days, stop)
+        if archived and on_archived is not None:
+            on_archived(room)
+        report["archived"] += archived
+        report["segments"] += segments
+        report["archive_bytes"] += size
+
+    for room in rooms:
+        if stop is not None and stop.is_set():
+            break
+        messages, attachments = purge_room_tombstones(room, stop)
+        report["tombstones"] += messages
+        report["attachments"] += attachments
+
+    report["sessions"] = purge_sessions(stop)
+    report["blob_files"] = collect_garbage()
+
+    free_bytes = 0
+    incremental = True
+    for path in database.shard_paths():
+        report["pages_released"] += vacuum(path, stop)
+        mode, page_size, _, free = database.database_pages(path)
+        free_bytes += free * page_size
+        incremental = incremental and mode == 2
+
+    size_after = database_bytes()
+    report.update(
+        db_bytes_before=size_before,
+        db_bytes_after=size_after,
+        reclaimed_bytes=max(0, size_before - size_after),
+        free_bytes=free_bytes,
+        incremental_vacuum=incremental,
+        seconds=time.perf_counter() - started
+    )
+    return report
+
+
+def format_report(report):
+    lines = [
+        f"Archived       {report['archived']:>10,} message(s) in {report['segments']} "
+        f"segment(s), {report['archive_bytes']:,} bytes compressed",
+        f"Purged         {report['tombstones']:>10,} deleted message(s), "
+        f"{report['attachments']:,} attachment(s), {report['sessions']:,} expired session(s)",
+        f"Blob files     {report['blob_files']:>10,} removed",
+        f"Database       {report['db_bytes_before']:>10,} -> {report['db_bytes_after']:,} bytes "
+        f"({report['reclaimed_bytes']:,} reclaimed, {report['pages_released']:,} pages released)",
+    ]
+    if not report["incremental_vacuum"]:
+        lines.append(
+            f"               {report['free_bytes']:,} bytes free inside the file; "
+            "incremental vacuum is off (maintain_db.py --full-vacuum enables it)"
+        )
+    return "\n".join(lines)
+
+
+class MaintenanceWorker:
+    """Background thread running a maintenance pass every MAINTENANCE_INTERVAL"""
+
+    def __init__(self, on_archived=None):
+        self.on_archived = on_archived
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop after the current batch"""
+        self._stop.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(MAINTENANCE_INTERVAL):
+            try:
+                report = run_maintenance(self._stop, self.on_archived)
+                print(f"[*] Maintenance: {report['archived']} archived, "
+                      f"{report['tombstones']} purged, {report['sessions']} sessions, "
+                      f"{report['reclaimed_bytes']:,} bytes reclaimed "
+                      f"in {report['seconds']:.1f}s")
+            except Exception:
+                traceback.print_exc()
+
+
+def start_maintenance_worker(on_archived=None):
+    global _worker
+    if _worker is None and MAINTENANCE_ENABLED and MAINTENANCE_INTERVAL > 0:
+        _worker = MaintenanceWorker(on_archived)
+        _worker.start()
+
+
+def stop_maintenance_worker():
+    global _worker
+    if _worker is not None:
+        _worker.stop()
+        _worker = None
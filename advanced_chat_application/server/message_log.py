@@ -0,0 +1,358 @@
+# server/message_log.py
+import os
+import re
+import struct
+import threading
+import time
+import traceback
+import zlib
+from collections import deque
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:  # Optional: only needed when the message log is on
+    msgpack = None
+
+from server.write_behind import DURABILITY_ASYNC, DURABILITY_FLUSH_ON_ACK
+
+SEGMENT_BYTES = 64 * 1024 * 1024     # a segment is sealed past this size
+FSYNC_INTERVAL_MS = 10               # appends are fsynced together this often
+INDEX_INTERVAL_MS = 50               # longest the indexer waits to fill a batch
+INDEX_BATCH_ROWS = 2000              # records applied per transaction at most
+# Appended but not yet indexed bytes before writers block (backpressure).
+# Replay on startup never has more than this to apply.
+MAX_UNINDEXED_BYTES = 64 * 1024 * 1024
+RETRY_SECONDS = 1.0                  # pause before retrying a failed batch
+
+# Segment files: <directory>/<sequence>.log, a magic string then records of
+# (payload length, CRC-32 of payload, msgpack [op name, args])
+SEGMENT_MAGIC = b"CHATLOG1"
+_RECORD_HEADER = struct.Struct("<II")
+_SEGMENT_NAME = re.compile(r"(\d{12})\.log")
+
+# A record's position: segment sequence in the high bits, the offset just
+# past the record in the low ones. Positions only ever increase.
+_OFFSET_BITS = 40
+
+
+class MessageLogError(Exception):
+    pass
+
+
+def position(sequence, offset):
+    return (sequence << _OFFSET_BITS) | offset
+
+
+def position_sequence(lsn):
+    return lsn >> _OFFSET_BITS
+
+
+def _encode_default(value):
+    # Stored the way sqlite3 adapts a datetime, so a replayed row is identical
+    if isinstance(value, datetime):
+        return value.isoformat(" ")
+    raise TypeError(f"Cannot log {type(value).__name__}")
+
+
+def encode_record(name, args):
+    payload = msgpack.packb([name, list(args)], use_bin_type=True, default=_encode_default)
+    return _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_segment(path):
+    """
+    Records of a segment file as (end offset, op name, args), plus the
+    offset where valid data ends: a torn or corrupt record stops the read.
+    Returns: (records, valid end, file size)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(SEGMENT_MAGIC):
+        return [], 0, len(data)
+
+    records = []
+    offset = len(SEGMENT_MAGIC)
+    while offset + _RECORD_HEADER.size <= len(data):
+        length, checksum = _RECORD_HEADER.unpack_from(data, offset)
+        start = offset + _RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        name, args = msgpack.unpackb(payload, raw=False)
+        offset = start + length
+        records.append((offset, name, args))
+    return records, offset, len(data)
+
+
+class MessageLog:
+    """
+    Append-only write-ahead log in front of the database.
+    Writers append (op name, args) records to the current segment file;
+    one thread fsyncs the appends every FSYNC_INTERVAL_MS, another (the
+    indexer) applies them to the database in batches and deletes the
+    segments it has finished. replay() applies what a previous run left
+    unindexed and must be called before start(). A failed fsync is fatal:
+    the written pages may be gone, so appends stop and the segments are
+    kept for the next start to replay.
+    """
+
+    def __init__(self, directory, apply_batch, last_applied, durability=DURABILITY_ASYNC,
+                 fsync_ms=None, segment_bytes=None, max_unindexed=None, on_indexed=None):
+        if msgpack is None:
+            raise MessageLogError("The message log needs msgpack (pip install msgpack)")
+        self.directory = directory
+        # apply_batch(list of (position, op name, args)) -> records applied.
+        # The rows must be on disk when it returns: their segments go next.
+        self.apply_batch = apply_batch
+        self.last_applied = last_applied    # last_applied() -> highest position applied
+        self.on_indexed = on_indexed        # on_indexed(list of (op name, args)) once applied
+        self.durability = durability
+        self.fsync_interval = (fsync_ms or FSYNC_INTERVAL_MS) / 1000
+        self.segment_bytes = segment_bytes or SEGMENT_BYTES
+        self.max_unindexed = max_unindexed or MAX_UNINDEXED_BYTES
+
+        self._cond = threading.Condition()
+        self._pending = deque()        # (position, size, op name, args) not yet indexed
+        self._sequence = 0
+        self._fd = None
+        self._size = 0
+        self._appended = 0             # position of the newest record
+        self._synced = 0               # appends up to here are on disk
+        self._indexed = 0              # and up to here in the database
+        self._unindexed_bytes = 0
+        self._sealed = []              # (sequence, fd) waiting for their last fsync
+        self._closed = []              # sequences fsynced and closed, to delete once indexed
+        self._new_segment = False
+        self._fsync_error = None       # OSError of a failed fsync
+        self._stopping = False
+        self._threads = []
+        self.stats = {
+            "appended": 0,
+            "indexed": 0,
+            "batches": 0,
+            "fsyncs": 0,
+            "segments": 0,
+            "errors": 0,
+            "replayed": 0,
+            "replay_seconds": 0.0
+        }
+
+    @property
+    def unindexed_bytes(self):
+        return self._unindexed_bytes
+
+    def _path(self, sequence):
+        return os.path.join(self.directory, f"{sequence:012d}.log")
+
+    def segments(self):
+        """Sequence numbers of the segment files on disk"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(
+            int(match.group(1)) for match in map(_SEGMENT_NAME.fullmatch, names) if match
+        )
+
+    def replay(self):
+        """
+        Apply every record the database does not have yet, then delete the
+        segments. A torn record (a crash mid-append) ends its segment.
+        Returns: (records applied, seconds)
+        """
+        start = time.perf_counter()
+        sequences = self.segments()
+        replayed = 0
+        for sequence in sequences:
+            path = self._path(sequence)
+            records, end, size = read_segment(path)
+            if end < size:
+                print(f"[!] Message log: {size - end} byte(s) after the last valid "
+                      f"record of {path} ignored")
+            batch = [(position(sequence, offset), name, args) for offset, name, args in records]
+            for i in range(0, len(batch), INDEX_BATCH_ROWS):
+                replayed += self.apply_batch(batch[i:i + INDEX_BATCH_ROWS])
+
+        # New positions must be past everything the database has applied
+        last = max([self.last_applied()] + [position(s, 0) for s in sequences])
+        self._sequence = position_sequence(last)
+        self._appended = self._synced = self._indexed = last
+        self._remove_segments(sequences)
+
+        seconds = time.perf_counter() - start
+        self.stats["replayed"] = replayed
+        self.stats["replay_seconds"] = seconds
+        return replayed, seconds
+
+    def _remove_segments(self, sequences):
+        for sequence in sequences:
+            os.remove(self._path(sequence))
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self._cond:
+            self._open_segment()
+        for target, name in ((self._run_fsync, "log-fsync"), (self._run_indexer, "log-indexer")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _open_segment(self):
+        """Start the next segment file; caller holds the lock"""
+        if self._fd is not None:
+            self._sealed.append((self._sequence, self._fd))
+        self._sequence += 1
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+        self._fd = os.open(self._path(self._sequence), flags, 0o600)
+        os.write(self._fd, SEGMENT_MAGIC)
+        self._size = len(SEGMENT_MAGIC)
+        self._new_segment = True
+        self.stats["segments"] += 1
+
+    def append(self, name, args=()):
+        """
+        Append a write. Blocks while MAX_UNINDEXED_BYTES are waiting for the
+        indexer, and in flush_on_ack mode until the record is fsynced.
+        """
+        record = encode_record(name, args)
+        with self._cond:
+            while (self._unindexed_bytes >= self.max_unindexed and not self._stopping
+                   and self._fsync_error is None):
+                self._cond.wait()
+            self._check_failed()
+            if self._stopping:
+                raise MessageLogError("The message log is closed")
+            if self._size + len(record) > self.segment_bytes and self._size > len(SEGMENT_MAGIC):
+                self._open_segment()
+            os.write(self._fd, record)
+            self._size += len(record)
+            lsn = self._appended = position(self._sequence, self._size)
+            self._pending.append((lsn, len(record), name, args))
+            self._unindexed_bytes += len(record)
+            self.stats["appended"] += 1
+            self._cond.notify_all()
+
+            if self.durability == DURABILITY_FLUSH_ON_ACK:
+                while self._synced < lsn and self._fsync_error is None:
+                    self._cond.wait()
+                if self._synced < lsn:
+                    self._check_failed()
+
+    def _check_failed(self):
+        if self._fsync_error is not None:
+            raise MessageLogError("The message log could not be fsynced") from self._fsync_error
+
+    def flush(self):
+        """Wait until everything appended so far is in the database"""
+        with self._cond:
+            target = self._appended
+            while self._indexed < target and not self._stopping:
+                self._cond.wait()
+
+    def stop(self):
+        """Index everything still in the log, fsync and close it"""
+        self.flush()
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for _, fd in self._sealed:
+            os.close(fd)
+        self._sealed = []
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        # Fully indexed: nothing for the next start to replay. After a
+        # failed fsync the files stay; replay skips what was applied.
+        if self._fsync_error is None:
+            self._remove_segments(self.segments())
+
+    def _run_fsync(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopping, self.fsync_interval)
+                if self._stopping:
+                    sealed, fd = self._sealed, None
+                else:
+                    sealed, fd = self._sealed, self._fd
+                self._sealed = []
+                target = self._appended
+                new_segment, self._new_segment = self._new_segment, False
+
+            # Outside the lock: appends carry on while the disk catches up
+            closed = []
+            try:
+                for sequence, sealed_fd in sealed:
+                    os.fsync(sealed_fd)
+                    os.close(sealed_fd)
+                    closed.append(sequence)
+                if fd is not None and target > self._synced:
+                    os.fsync(fd)
+                if new_segment and hasattr(os, "O_DIRECTORY"):
+                    dir_fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+                    try:
+                        os.fsync(dir_fd)
+                    finally:
+                        os.close(dir_fd)
+            except OSError as e:
+                # Retrying is no good: the kernel may have dropped the dirty
+                # pages, so a second fsync would succeed without them
+                self.stats["errors"] += 1
+                print(f"[!] Message log fsync failed, appends stopped: {e}")
+                with self._cond:
+                    self._sealed = [s for s in sealed if s[0] not in closed] + self._sealed
+                    self._closed.extend(closed)
+                    self._fsync_error = e
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                self._closed.extend(closed)
+                self._synced = max(self._synced, target)
+                self.stats["fsyncs"] += 1
+                self._cond.notify_all()
+                if self._stopping:
+                    return
+
+    def _run_indexer(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._stopping)
+                if not self._pending:
+                    return
+                # Let a batch build up unless one is already full
+                deadline = time.monotonic() + INDEX_INTERVAL_MS / 1000
+                while len(self._pending) < INDEX_BATCH_ROWS and not self._stopping:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                batch = [self._pending[i] for i in range(min(len(self._pending), INDEX_BATCH_ROWS))]
+
+            try:
+                self.apply_batch([(lsn, name, args) for lsn, _, name, args in batch])
+            except Exception as e:
+                # The records are safe in the log: try the same batch again
+                self.stats["errors"] += 1
+                print(f"[!] Message log: indexing {len(batch)} record(s) failed: {e}")
+                traceback.print_exc()
+                time.sleep(RETRY_SECONDS)
+                continue
+
+            if self.on_indexed:
+                self.on_indexed([(name, args) for _, _, name, args in batch])
+            with self._cond:
+                for _ in batch:
+                    self._pending.popleft()
+                self._unindexed_bytes -= sum(size for _, size, _, _ in batch)
+                self._indexed = batch[-1][0]
+                self.stats["indexed"] += len(batch)
+                self.stats["batches"] += 1
+                done = [s for s in self._closed if s < position_sequence(self._indexed)]
+                self._closed = [s for s in self._closed if s not in done]
+                self._cond.notify_all()
+
+            self._remove_segments(done)
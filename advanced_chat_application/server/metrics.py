@@ -0,0 +1,153 @@
+# server/metrics.py
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Port of the /metrics endpoint on 127.0.0.1 (0: no endpoint)
+METRICS_PORT = 0
+
+# Seconds; suits handler and query latencies
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5
+)
+
+_registry = []
+_server = None
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=(), func=None):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        # func() returns the value, or {label values: value}, at scrape time
+        self.func = func
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self):
+        """[(suffix, label values, value)]"""
+        if self.func is not None:
+            values = self.func()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return [("", key if isinstance(key, tuple) else (key,), value)
+                    for key, value in values.items()]
+        with self._lock:
+            return [("", key, value) for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, n=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+
+class Gauge(_Metric):
+    """A value read from func() at scrape time"""
+    kind = "gauge"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # Per-bucket counts (last one is +Inf), count, sum
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            entry[0][slot] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), count, total)
+                      for key, (counts, count, total) in self._values.items()}
+
+        samples = []
+        for key, (counts, count, total) in values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append(("_bucket", key + (le,), cumulative))
+            samples.append(("_count", key, count))
+            samples.append(("_sum", key, total))
+        return samples
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        names = metric.labels + (("le",) if metric.kind == "histogram" else ())
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            lines.append(f"# error collecting {metric.name}: {_escape(e)}")
+            continue
+        for suffix, values, value in samples:
+            if suffix in ("_count", "_sum"):
+                pairs = zip(metric.labels, values)
+            else:
+                pairs = zip(names, values)
+            label_text = ",".join(f'{name}="{_escape(v)}"' for name, v in pairs)
+            label_text = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{metric.name}{suffix}{label_text} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes are not worth a log line each
+
+
+def start_metrics_server(port=None, host="127.0.0.1"):
+    """Serve /metrics from a background thread; no-op when the port is 0"""
+    global _server
+    port = METRICS_PORT if port is None else port
+    if not port or _server is not None:
+        return None
+    _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    print(f"📈 Metrics on http://{host}:{port}/metrics")
+    return _server
+
+
+def stop_metrics_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
@@ -0,0 +1,158 @@
+# server/outbound.py
+import threading
+import weakref
+from collections import deque
+
+# What to do when a client's send queue is full:
+#   drop       - discard the new frame
+#   disconnect - close the slow client's connection
+#   coalesce   - replace a queued frame with the same coalesce key; a frame
+#                with no key, or with no queued frame to replace, is dropped
+POLICY_DROP = "drop"
+POLICY_DISCONNECT = "disconnect"
+POLICY_COALESCE = "coalesce"
+POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_COALESCE)
+
+SEND_QUEUE_SIZE = 1024        # frames per connection
+SLOW_CONSUMER_POLICY = POLICY_COALESCE
+SEND_TIMEOUT = 5.0            # seconds a direct reply may wait for room
+
+# Live queues, for depth metrics
+_queues = weakref.WeakSet()
+
+_stats_lock = threading.Lock()
+_stats = {
+    "enqueued": 0,
+    "dropped": 0,
+    "coalesced": 0,
+    "disconnected": 0
+}
+
+
+def _count(name, n=1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def send_queue_stats():
+    """Snapshot of outbound queue counters and current depths"""
+    depths = [q.depth for q in list(_queues)]
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["connections"] = len(depths)
+    stats["queued_frames"] = sum(depths)
+    stats["max_depth"] = max(depths, default=0)
+    return stats
+
+
+class OutboundQueue:
+    """
+    Bounded queue of encoded frames waiting to be written to one client.
+    Producers are handler threads; the consumer is the connection's
+    writer (a thread or an asyncio task).
+    """
+
+    def __init__(self, maxsize=None, policy=None, on_ready=None, on_overflow=None):
+        self.maxsize = maxsize or SEND_QUEUE_SIZE
+        self.policy = policy or SLOW_CONSUMER_POLICY
+        self.on_ready = on_ready        # called when the queue becomes non-empty
+        self.on_overflow = on_overflow  # called once under the disconnect policy
+        self.closed = False
+        self._frames = deque()          # [coalesce_key, payload]
+        self._cond = threading.Condition()
+        _queues.add(self)
+
+    @property
+    def depth(self):
+        return len(self._frames)
+
+    def put(self, payload, key=None, block=False, timeout=None):
+        """
+        Queue an encoded frame.
+        block=True waits up to `timeout` for room before applying the
+        slow-consumer policy. Returns False if the frame was not queued.
+        """
+        overflow = False
+        was_empty = False
+
+        with self._cond:
+            if self.closed:
+                return False
+
+            if block and len(self._frames) >= self.maxsize:
+                self._cond.wait_for(
+                    lambda: self.closed or len(self._frames) < self.maxsize,
+                    timeout if timeout is not None else SEND_TIMEOUT
+                )
+                if self.closed:
+                    return False
+
+            if len(self._frames) >= self.maxsize:
+                if self.policy == POLICY_COALESCE and self._coalesce(payload, key):
+                    _count("coalesced")
+                    return True
+                if self.policy != POLICY_DISCONNECT:
+                    _count("dropped")
+                    return False
+                self.closed = True
+                overflow = True
+                self._cond.notify_all()
+            else:
+                was_empty = not self._frames
+                self._frames.append([key, payload])
+                self._cond.notify_all()
+
+        if overflow:
+            _count("disconnected")
+            if self.on_overflow:
+                self.on_overflow()
+            return False
+
+        _count("enqueued")
+        if was_empty and self.on_ready:
+            self.on_ready()
+        return True
+
+    def _coalesce(self, payload, key):
+        """Make room for a keyed frame on a full queue (caller holds the lock)"""
+        if key is None:
+            return False
+
+        # Only a frame with the same key is stale: evicting another key's
+        # frame would lose its last state (e.g. someone's typing: False)
+        for entry in self._frames:
+            if entry[0] == key:
+                entry[1] = payload
+                return True
+
+        return False
+
+    def take_all(self):
+        """Remove and return every queued payload without blocking"""
+        with self._cond:
+            batch = [payload for _, payload in self._frames]
+            self._frames.clear()
+            self._cond.notify_all()
+            return batch
+
+    def get_batch(self, timeout=None):
+        """
+        Block until frames are available and return all of them.
+        Returns None once the queue is closed and drained.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._frames or self.closed, timeout)
+            if not self._frames:
+                return None if self.closed else []
+            batch = [payload for _, payload in self._frames]
+            self._frames.clear()
+            self._cond.notify_all()
+            return batch
+
+    def close(self):
+        """Stop accepting frames; already queued frames can still be drained"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if self.on_ready:
+            self.on_ready()
@@ -0,0 +1,189 @@
+# server/presence.py
+import threading
+import time
+from collections import Counter, defaultdict
+
+PRESENCE_WINDOW_MS = 250           # joins and leaves in a room are announced at most this often
+PRESENCE_SNAPSHOT_SECONDS = 60     # rooms that changed get a full member list this often (0: off)
+
+
+class RemotePresence:
+    """
+    Users connected to the other server processes, by node and room,
+    as announced over the bus. A user connected twice counts twice, the
+    same as two local connections.
+    """
+
+    def __init__(self):
+        self._nodes = defaultdict(lambda: defaultdict(Counter))  # node -> room -> users
+        self._lock = threading.Lock()
+
+    def joined(self, node, room, username):
+        with self._lock:
+            self._nodes[node][room][username] += 1
+
+    def left(self, node, room, username):
+        with self._lock:
+            rooms = self._nodes.get(node)
+            if rooms is None or rooms[room][username] <= 0:
+                return
+            rooms[room][username] -= 1
+            if rooms[room][username] == 0:
+                del rooms[room][username]
+            if not rooms[room]:
+                del rooms[room]
+
+    def replace(self, node, rooms):
+        """Take a node's full {room: [usernames]} snapshot; returns the rooms it touched"""
+        with self._lock:
+            touched = set(self._nodes.get(node, ())) | set(rooms)
+            self._nodes[node] = defaultdict(
+                Counter, {room: Counter(users) for room, users in rooms.items() if users}
+            )
+        return touched
+
+    def drop(self, node):
+        """Forget a node that went away; returns its {room: [usernames]}"""
+        with self._lock:
+            rooms = self._nodes.pop(node, {})
+        return {room: list(users.elements()) for room, users in rooms.items()}
+
+    def users(self, room):
+        with self._lock:
+            return [
+                username
+                for rooms in self._nodes.values()
+                for username in rooms.get(room, Counter()).elements()
+            ]
+
+
+
+class PresenceTracker:
+    """
+    Versioned member sets of each room, announced as deltas.
+    changed() only marks a room; at most once per PRESENCE_WINDOW_MS a
+    background thread compares each marked room's members(room) with the
+    set last announced, bumps the room's version and hands the
+    difference to on_delta(room, version, joined, left). A burst of joins
+    and leaves thus costs one frame per member, and a user who joins and
+    leaves within the window is never announced. snapshot() is the
+    announced set a delta of the next version applies to; every
+    PRESENCE_SNAPSHOT_SECONDS the rooms that changed are also handed to
+    on_snapshot(room, version, users) so clients can resync.
+    """
+
+    def __init__(self, window_ms=None, snapshot_seconds=None):
+        self.window = (window_ms or PRESENCE_WINDOW_MS) / 1000
+        self.snapshot_interval = (
+            PRESENCE_SNAPSHOT_SECONDS if snapshot_seconds is None else snapshot_seconds
+        )
+        self._rooms = {}         # room -> [version, announced usernames, version last snapshotted]
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def changed(self, *rooms):
+        """Mark rooms whose members may have changed"""
+        with self._lock:
+            self._dirty.update(room for room in rooms if room)
+        self._wake.set()
+
+    def snapshot(self, room):
+        """(version, sorted usernames) as last announced"""
+        with self._lock:
+            state = self._rooms.get(room)
+            if state is None:
+                return 0, []
+            return state[0], sorted(state[1])
+
+    def take_deltas(self, members):
+        """[(room, version, joined, left)] for the rooms marked since the last call"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+
+        # members() takes the server's client locks: not while holding ours
+        current = {room: set(members(room)) for room in dirty}
+
+        deltas = []
+        with self._lock:
+            for room, users in current.items():
+                state = self._rooms.get(room)
+                announced = state[1] if state else set()
+                joined, left = users - announced, announced - users
+                if not joined and not left:
+                    continue
+                if not users:
+                    # Nobody left to tell; a room that fills again starts over
+                    del self._rooms[room]
+                    continue
+                if state is None:
+                    state = self._rooms[room] = [0, set(), 0]
+                state[0] += 1
+                state[1] = users
+                deltas.append((room, state[0], sorted(joined), sorted(left)))
+        return deltas
+
+    def take_snapshots(self):
+        """[(room, version, users)] for the rooms announced since their last snapshot"""
+        with self._lock:
+            changed = []
+            for room, state in self._rooms.items():
+                if state[2] != state[0]:
+                    state[2] = state[0]
+                    changed.append((room, state[0], sorted(state[1])))
+        return changed
+
+    # ----- Flush thread -----
+
+    def start(self, members, on_delta, on_snapshot):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(members, on_delta, on_snapshot),
+            name="presence", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, members, on_delta, on_snapshot):
+        interval = self.snapshot_interval
+        next_snapshot = time.monotonic() + interval if interval else None
+        while True:
+            timeout = None if next_snapshot is None else max(0, next_snapshot - time.monotonic())
+            self._wake.wait(timeout)
+            if self._stop.is_set():
+                return
+
+            if self._wake.is_set():
+                # Collect everything that arrives during the window
+                self._stop.wait(self.window)
+                self._wake.clear()
+                for room, version, joined, left in self.take_deltas(members):
+                    try:
+                        on_delta(room, version, joined, left)
+                    except Exception as e:
+                        print(f"Presence broadcast error: {e}")
+
+            if next_snapshot is not None and time.monotonic() >= next_snapshot:
+                for room, version, users in self.take_snapshots():
+                    try:
+                        on_snapshot(room, version, users)
+                    except Exception as e:
+                        print(f"Presence snapshot error: {e}")
+                next_snapshot = time.monotonic() + interval
+
+            if self._stop.is_set():
+                return
+
+
+remote_presence = RemotePresence()
+room_presence = PresenceTracker()
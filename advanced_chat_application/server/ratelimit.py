@@ -0,0 +1,59 @@
+# server/ratelimit.py
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Allows `rate` events per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, n=1):
+        """Consume n tokens if available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def wait_time(self, n=1):
+        """Seconds until n tokens will be available"""
+        missing = n - self.tokens
+        return max(0.0, missing / self.rate) if self.rate else float("inf")
+
+
+class KeyedRateLimiter:
+    """
+    One token bucket per key (IP address, username, ...).
+    Only the most recently used `max_keys` buckets are kept, so a flood
+    of distinct keys cannot grow memory without bound.
+    """
+
+    def __init__(self, rate, capacity, max_keys=100_000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key, n=1):
+        if key is None:
+            return True
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.take(n)
@@ -0,0 +1,100 @@
+# server/read_receipts.py
+import threading
+from collections import defaultdict
+
+RECEIPT_WINDOW_MS = 250  # read receipts in a room are broadcast at most this often
+
+
+class ReceiptAggregator:
+    """
+    Read watermarks of the users in each room, broadcast in batches.
+    update() records a user's new watermark only if it is past the one
+    recorded. Positions are message row ids; None marks a message not
+    committed yet, which any later receipt may replace. At most once per
+    RECEIPT_WINDOW_MS a background thread hands each changed room's
+    watermarks to on_flush(room, {username: message_id}). Every flush
+    carries the room's full state, so a slow client may safely skip all
+    but the newest one.
+    """
+
+    def __init__(self, window_ms=None):
+        self.window = (window_ms or RECEIPT_WINDOW_MS) / 1000
+        self._rooms = defaultdict(dict)   # room -> {username: (message_id, position)}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def update(self, room, username, message_id, position):
+        """Record a watermark; returns False if it is not past the current one"""
+        with self._lock:
+            current = self._rooms[room].get(username)
+            if current is not None and (
+                current[0] == message_id
+                or None not in (position, current[1]) and position < current[1]
+            ):
+                return False
+            self._rooms[room][username] = (message_id, position)
+            self._dirty.add(room)
+        self._wake.set()
+        return True
+
+    def forget(self, room, username):
+        """Drop a user who left the room; their watermark stays in the database"""
+        with self._lock:
+            readers = self._rooms.get(room)
+            if readers is not None:
+                readers.pop(username, None)
+                if not readers:
+                    del self._rooms[room]
+
+    def take_dirty(self):
+        """[(room, watermarks)] changed since the last call"""
+        with self._lock:
+            changed = [
+                (room, {
+                    username: message_id
+                    for username, (message_id, _) in self._rooms.get(room, {}).items()
+                })
+                for room in self._dirty
+            ]
+            self._dirty.clear()
+        return changed
+
+    # ----- Flush thread -----
+
+    def start(self, on_flush):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(on_flush,), name="read-receipts", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, on_flush):
+        while True:
+            self._wake.wait()
+            if self._stop.is_set():
+                return
+            # Collect everything that arrives during the window
+            self._stop.wait(self.window)
+            self._wake.clear()
+            for room, watermarks in self.take_dirty():
+                try:
+                    on_flush(room, watermarks)
+                except Exception as e:
+                    print(f"Read receipt broadcast error: {e}")
+            if self._stop.is_set():
+                return
+
+
+receipts = ReceiptAggregator()
@@ -0,0 +1,159 @@
+# server/rekey.py
+import threading
+import time
+import traceback
+from cryptography.fernet import InvalidToken
+from server.crypto import KEY_REFRESH_SECONDS, get_room_key_ciphers
+from server.database import (
+    next_key_rotation, begin_key_rotation, fetch_rekey_messages,
+    fetch_rekey_attachments, save_rekey_batch, finish_key_rotation
+)
+from server.ratelimit import TokenBucket
+
+REKEY_BATCH_ROWS = 200           # rows re-encrypted per transaction
+REKEY_IO_BUDGET = 512 * 1024     # ciphertext bytes rewritten per second
+REKEY_POLL_SECONDS = 10          # idle wait between checks for new rotations
+
+# Only one process of a multi-process server runs the worker
+REKEY_WORKER_ENABLED = True
+
+# A rotation walks these phases in order. Live messages go first so the
+# rows people actually read move to the new key soonest.
+PHASES = ("messages:0", "messages:1", "attachments", "done")
+
+_worker = None
+
+
+def _reencrypt(primary, cipher, token):
+    """Token under the newest key, or None if it already is (or is unreadable)"""
+    try:
+        primary.decrypt(token)
+        return None
+    except InvalidToken:
+        pass
+    try:
+        return cipher.rotate(token)
+    except InvalidToken:
+        return None  # plaintext fallback rows and foreign data are left alone
+
+
+def _fetch(rotation, phase, last_id, limit):
+    """(table, [(id, value)]) for the next batch of a phase"""
+    if phase.startswith("messages:"):
+        is_deleted = int(phase.split(":")[1])
+        rows = fetch_rekey_messages(
+            rotation["room"], is_deleted, last_id, rotation["upto_id"], limit
+        )
+        return "messages", [(row["id"], row["message"]) for row in rows]
+    rows = fetch_rekey_attachments(rotation["room"], last_id, limit)
+    return "attachments", [(row["id"], row["file_data"]) for row in rows]
+
+
+def run_rotation(rotation, budget=None, stop=None):
+    """
+    Re-encrypt the rows of one rotation under its room's newest key.
+    Resumes from the checkpoint saved after each batch, so an
+    interrupted rotation picks up where it left off. `budget` caps the
+    ciphertext bytes written per second. Returns False if stopped early.
+    """
+    budget = budget or REKEY_IO_BUDGET
+    bucket = TokenBucket(rate=budget, capacity=budget)
+    primary, cipher = get_room_key_ciphers(rotation["room"])
+    phase, last_id = rotation["phase"], rotation["last_id"]
+
+    while phase != "done":
+        if stop is not None and stop.is_set():
+            return False
+
+        table, rows = _fetch(rotation, phase, last_id, REKEY_BATCH_ROWS)
+        if not rows:
+            phase, last_id = PHASES[PHASES.index(phase) + 1], 0
+            save_rekey_batch(rotation["id"], rotation["room"], table, [], phase, last_id)
+            continue
+
+        updates = []
+        written = 0
+        for row_id, value in rows:
+            if value is None:
+                continue
+            is_text = isinstance(value, str)
+            new = _reencrypt(primary, cipher, value.encode() if is_text else value)
+            if new is None:
+                continue
+            updates.append((new.decode() if is_text else new, row_id, value))
+            written += len(new)
+
+        last_id = rows[-1][0]
+        save_rekey_batch(rotation["id"], rotation["room"], table, updates, phase, last_id)
+
+        # Spend the bytes just written from the I/O budget
+        while written > 0:
+            n = min(written, bucket.capacity)
+            if bucket.take(n):
+                written -= n
+            else:
+                time.sleep(bucket.wait_time(n))
+
+    finish_key_rotation(rotation["id"])
+    return True
+
+
+def next_rotation(min_age=KEY_REFRESH_SECONDS):
+    """
+    The next rotation to work on, started if need be. A new rotation
+    waits min_age seconds first, so every server process has picked up
+    the new key before the last row it covers is fixed.
+    """
+    rotation = next_key_rotation(min_age)
+    if rotation is not None and rotation["upto_id"] is None:
+        begin_key_rotation(rotation["id"], rotation["room"])
+        rotation = next_key_rotation(min_age)
+    return rotation
+
+
+class RekeyWorker:
+    """Background thread working through queued key rotations"""
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="rekey", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop after the current batch; progress is kept for the next start"""
+        self._stop.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                rotation = next_rotation()
+                if rotation is None:
+                    self._stop.wait(REKEY_POLL_SECONDS)
+                    continue
+                print(f"[*] Re-encrypting room '{rotation['room']}' "
+                      f"for key version {rotation['version']}")
+                if run_rotation(rotation, self.budget, self._stop):
+                    print(f"[*] Room '{rotation['room']}' re-encrypted")
+            except Exception:
+                traceback.print_exc()
+                self._stop.wait(REKEY_POLL_SECONDS)
+
+
+def start_rekey_worker():
+    global _worker
+    if _worker is None and REKEY_WORKER_ENABLED:
+        _worker = RekeyWorker()
+        _worker.start()
+
+
+def stop_rekey_worker():
+    global _worker
+    if _worker is not None:
+        _worker.stop()
+        _worker = None
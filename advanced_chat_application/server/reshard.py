@@ -0,0 +1,100 @@
+# server/reshard.py
+import glob
+import os
+import re
+from server import database
+
+
+class ReshardError(Exception):
+    pass
+
+
+def shard_files():
+    """Shard numbers with a file on disk, including ones no longer in use"""
+    root, ext = os.path.splitext(database.DB_PATH)
+    found = {0}
+    for path in glob.glob(f"{glob.escape(root)}-shard*{ext}"):
+        match = re.fullmatch(rf"-shard(\d+){re.escape(ext)}", path[len(root):])
+        if match:
+            found.add(int(match.group(1)))
+    return sorted(found)
+
+
+def plan_moves(shards):
+    """
+    [(room, from shard, to shard)] for the rooms that change shard when
+    going from the current shard set to `shards`. A room's rows in any
+    shard other than its current one are leftovers and don't count.
+    """
+    new_map = database.ShardMap(shards)
+    moves = []
+    for shard in database.get_shards():
+        for room in database.shard_rooms(shard):
+            if database.room_shard(room) != shard:
+                continue
+            target = new_map.shard_for(room)
+            if target != shard:
+                moves.append((room, shard, target))
+    return moves
+
+
+def remove_leftovers():
+    """
+    Delete rooms from the shard files that no longer own them, and the
+    files of shards no longer in use once they are empty.
+    Returns: (rooms dropped, files removed)
+    """
+    in_use = set(database.get_shards())
+    dropped = removed = 0
+    for shard in shard_files():
+        for room in database.shard_rooms(shard):
+            if shard not in in_use or database.room_shard(room) != shard:
+                database.drop_room(room, shard)
+                dropped += 1
+        if shard not in in_use:
+            database.close_db()
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(database.shard_path(shard) + suffix)
+                except FileNotFoundError:
+                    pass
+            removed += 1
+    return dropped, removed
+
+
+def reshard(count, on_move=None):
+    """
+    Spread rooms over `count` shard files. Run with the server stopped.
+
+    Rooms that move are copied first; the new shard set is then saved in
+    one transaction, and the old copies are deleted last. If interrupted,
+    running it again with the same count finishes the job: until the
+    switch the old shards are still authoritative, after it the new ones.
+    on_move(room, source, target, messages) is called after each copy.
+    Returns: (moves, rooms dropped, files removed)
+    """
+    if count < 1:
+        raise ReshardError("At least one shard is needed")
+    shards = list(range(count))
+    moves = plan_moves(shards)
+
+    # Re-encryption checkpoints hold row ids, which change on a move
+    rotating = {r["room"] for r in database.list_key_rotations() if r["finished_at"] is None}
+    blocked = sorted(rotating & {room for room, _, _ in moves})
+    if blocked:
+        raise ReshardError(
+            f"Key rotation in progress for {', '.join(blocked)}; let it finish first"
+        )
+
+    for shard in shards:
+        if shard != 0:
+            database.init_shard(shard)
+
+    for room, source, target in moves:
+        messages = database.copy_room(room, source, target)
+        if on_move is not None:
+            on_move(room, source, target, messages)
+
+    database.set_shards(shards)
+    dropped, removed = remove_leftovers()
+    return moves, dropped, removed
@@ -0,0 +1,217 @@
+# server/room_cache.py
+import threading
+from collections import OrderedDict, deque
+
+ROOM_CACHE_MESSAGES = 50                 # recent messages kept per room
+ROOM_CACHE_MAX_BYTES = 64 * 1024 * 1024  # across all rooms
+
+# Rough per-message overhead of the dict and its small values
+_MESSAGE_OVERHEAD = 400
+
+
+def _message_size(message):
+    return (
+        _MESSAGE_OVERHEAD
+        + len(message.get("message") or "")
+        + len(message.get("sender") or "")
+        + len(message.get("message_id") or "")
+    )
+
+
+class _RoomEntry:
+    """Ring buffer of one room's newest decrypted messages"""
+
+    def __init__(self, capacity, has_more):
+        self.messages = deque(maxlen=capacity)
+        self.has_more = has_more  # older messages exist beyond the buffer
+        self.bytes = 0
+
+
+class _Read:
+    """A history read from the database that may fill the cache"""
+
+    def __init__(self):
+        self.stale = False  # the room changed while it ran
+
+
+class RoomMessageCache:
+    """
+    Newest decrypted messages per room, so joins to busy rooms skip
+    SQLite and decryption. Rooms are evicted least recently used first
+    once the total size passes `max_bytes`.
+    """
+
+    def __init__(self, per_room=None, max_bytes=None):
+        self.per_room = per_room or ROOM_CACHE_MESSAGES
+        self.max_bytes = max_bytes or ROOM_CACHE_MAX_BYTES
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+        # Reads in progress per room; a write marks them stale, since
+        # their page may be missing it
+        self._reads = {}
+        # Nodes with message writes to a room still queued in front of
+        # the database; a read of the room may miss them, so it is not
+        # cached until they are all applied
+        self._holds = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def start_read(self, room):
+        """
+        Register a database read of a room's newest page. Pass it to
+        fill(), then end_read() whether or not it got that far.
+        """
+        read = _Read()
+        with self._lock:
+            self._reads.setdefault(room, set()).add(read)
+        return read
+
+    def end_read(self, room, read):
+        with self._lock:
+            reads = self._reads.get(room)
+            if reads is not None:
+                reads.discard(read)
+                if not reads:
+                    del self._reads[room]
+
+    def hold(self, room, node):
+        """A node has queued message writes to a room"""
+        with self._lock:
+            self._holds.setdefault(room, set()).add(node)
+            self._changed(room)
+
+    def release(self, room, node):
+        """A node's queued writes to a room have been applied"""
+        with self._lock:
+            self._release(room, node)
+
+    def release_node(self, node):
+        """Drop every hold of a node that went away"""
+        with self._lock:
+            for room in [room for room, nodes in self._holds.items() if node in nodes]:
+                self._release(room, node)
+
+    def get_page(self, room, limit):
+        """
+        Newest `limit` messages of a room, oldest first.
+        Returns (messages, has_more) or None on a miss.
+        """
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None or limit > self.per_room:
+                self.misses += 1
+                return None
+
+            self._rooms.move_to_end(room)
+            self.hits += 1
+            messages = list(entry.messages)[-limit:]
+            has_more = entry.has_more or len(entry.messages) > limit
+            return messages, has_more
+
+    def fill(self, room, messages, has_more, read):
+        """Cache a page read from the database by `read` (see start_read)"""
+        with self._lock:
+            if read.stale or room in self._holds or room in self._rooms:
+                return
+
+            entry = _RoomEntry(self.per_room, has_more)
+            for message in messages[-self.per_room:]:
+                self._push(entry, message)
+            if len(messages) > self.per_room:
+                entry.has_more = True
+
+            self._rooms[room] = entry
+            self._evict()
+
+    def append(self, room, message):
+        """Add a new message to a cached room"""
+        with self._lock:
+            self._changed(room)
+            entry = self._rooms.get(room)
+            if entry is None:
+                return
+
+            self._push(entry, message)
+            self._rooms.move_to_end(room)
+            self._evict()
+
+    def update(self, room, message_id, **fields):
+        """Apply an edit to a cached message"""
+        with self._lock:
+            self._changed(room)
+            entry = self._rooms.get(room)
+            if entry is None:
+                return
+
+            for i, message in enumerate(entry.messages):
+                if message["message_id"] == message_id:
+                    # Replace rather than mutate: pages handed out earlier
+                    # may still be being serialized
+                    updated = dict(message, **fields)
+                    entry.messages[i] = updated
+                    delta = _message_size(updated) - _message_size(message)
+                    entry.bytes += delta
+                    self.bytes += delta
+                    break
+
+    def contains(self, room, message_id):
+        """Whether a cached room holds a message"""
+        with self._lock:
+            entry = self._rooms.get(room)
+            return entry is not None and any(
+                message["message_id"] == message_id for message in entry.messages
+            )
+
+    def invalidate(self, room):
+        """Drop a room (e.g. after a delete)"""
+        with self._lock:
+            self._changed(room)
+            entry = self._rooms.pop(room, None)
+            if entry is not None:
+                self.bytes -= entry.bytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rooms": len(self._rooms),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def _changed(self, room):
+        for read in self._reads.get(room, ()):
+            read.stale = True
+
+    def _release(self, room, node):
+        nodes = self._holds.get(room)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del self._holds[room]
+
+    def _push(self, entry, message):
+        """Append to a ring buffer, accounting for the message it pushes out"""
+        if len(entry.messages) == entry.messages.maxlen:
+            dropped = entry.messages[0]
+            entry.bytes -= _message_size(dropped)
+            self.bytes -= _message_size(dropped)
+            entry.has_more = True
+
+        size = _message_size(message)
+        entry.messages.append(message)
+        entry.bytes += size
+        self.bytes += size
+
+    def _evict(self):
+        """Drop least recently used rooms until under the byte cap"""
+        while self.bytes > self.max_bytes and len(self._rooms) > 1:
+            _, entry = self._rooms.popitem(last=False)
+            self.bytes -= entry.bytes
+            self.evictions += 1
+
+
+room_cache = RoomMessageCache()
@@ -21,6 +21,10 @@ if __name__ == "__main__":
     db_path = os.path.join(os.path.dirname(__file__), "server", "chat.db")
     if os.path.exists(db_path):
         os.remove(db_path)
+        # WAL journal files belong to the old database
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
         print("🔄 Old database removed, creating fresh one...")
 
     init_db()
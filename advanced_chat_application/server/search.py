@@ -0,0 +1,88 @@
+# server/search.py
+import re
+import unicodedata
+from server.crypto import decrypt_many, search_tokens
+from server.database import NEWEST, fetch_rekey_messages, index_messages, search_messages
+
+# Words are runs of letters, digits and underscores, compared casefolded
+TERM_RE = re.compile(r"\w+")
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+
+# Words of a query beyond this are ignored
+MAX_QUERY_TERMS = 8
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
+# Messages decrypted and indexed per transaction by index_room()
+INDEX_BATCH_ROWS = 500
+
+
+def terms(text):
+    """Distinct normalized words of a message or query, in order"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return list(dict.fromkeys(
+        word for word in TERM_RE.findall(text)
+        if MIN_TERM_LENGTH <= len(word) <= MAX_TERM_LENGTH
+    ))
+
+
+def message_tokens(room, text):
+    """Search index tokens for a message about to be saved or edited"""
+    return search_tokens(room, terms(text))
+
+
+def search_room(room, query, limit=SEARCH_PAGE_SIZE, before=None):
+    """
+    Build a `search_results` frame: up to `limit` messages of the room
+    containing every word of the query, newest first, older than the
+    `before` cursor.
+    """
+    words = terms(query)[:MAX_QUERY_TERMS]
+    if words:
+        rows, has_more = search_messages(room, search_tokens(room, words), limit, before)
+    else:
+        rows, has_more = [], False
+
+    texts = decrypt_many(room, [row["message"] for row in rows])
+    results = [
+        {
+            "sender": row["sender"],
+            "message": text,
+            "message_id": row["message_id"],
+            "timestamp": row["time"],
+            "reply_to": row["reply_to"],
+            "edited": bool(row["edited_at"])
+        }
+        for row, text in zip(rows, texts)
+    ]
+
+    return {
+        "type": "search_results",
+        "room": room,
+        "query": query,
+        "before": before,
+        "results": results,
+        # Pass back as `before` for the next page of older hits
+        "cursor": results[-1]["message_id"] if results else before,
+        "has_more": has_more
+    }
+
+
+def index_room(room, after_id=0):
+    """
+    Index a room's messages saved before search existed. Safe to repeat:
+    tokens already present are left alone. Returns the messages indexed.
+    """
+    indexed = 0
+    while True:
+        rows = fetch_rekey_messages(room, 0, after_id, NEWEST, INDEX_BATCH_ROWS)
+        if not rows:
+            return indexed
+        texts = decrypt_many(room, [row["message"] for row in rows])
+        index_messages(room, [
+            (row["id"], message_tokens(room, text)) for row, text in zip(rows, texts)
+        ])
+        after_id = rows[-1]["id"]
+        indexed += len(rows)
@@ -3,20 +3,55 @@ import socket
 import threading
 import json
 import base64
+import logging
+import time
 from datetime import datetime
 from collections import defaultdict
-import traceback
-from server.auth import register_user, login_user, authenticate_session
+from server.auth import (
+    register_user, login_user, authenticate_session, flush_last_seen, forget_sessions
+)
 from server.database import (
-    init_db, save_message, fetch_room_history, delete_message,
-    edit_message, clear_room, mark_message_read, get_read_receipts,
-    update_typing_status, get_typing_users, save_attachment, get_attachment
+    init_db, disable_write_behind, open_message_log, close_message_log, save_message,
+    fetch_room_history, delete_message, edit_message, clear_room, mark_read_up_to,
+    get_read_watermarks, save_blob_attachment, get_attachment, read_position,
+    watch_queued_writes
+)
+from server.crypto import encrypt_message, decrypt_many
+from server.blob_store import store_chunks, CHUNK_SIZE
+from server.transfers import uploads, AttachmentReader, TransferError, DOWNLOAD_WINDOW
+from protocol.chunks import chunk_hash
+from server.outbound import OutboundQueue
+from protocol.codec import JSON, FrameDecoder, FrameError, negotiate
+from server.room_cache import room_cache
+from server.search import (
+    message_tokens, search_room, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE
 )
-from server.crypto import encrypt_message, decrypt_message, encrypt_file, decrypt_file
+from server.rekey import start_rekey_worker, stop_rekey_worker
+from server.maintenance import start_maintenance_worker, stop_maintenance_worker
+from server.typing_tracker import typing_tracker
+from server.read_receipts import receipts
+from server.bus import get_bus
+from server.presence import remote_presence, room_presence
+from server.metrics import Counter, Gauge, Histogram, start_metrics_server, stop_metrics_server
+from server.outbound import send_queue_stats
+from server.database import write_behind_pending, message_log_stats
 
 HOST, PORT = "0.0.0.0", 5555
 
-# Connected clients: {socket: {username, room, session}}
+# Pending connections the kernel may queue before accept()
+LISTEN_BACKLOG = 4096
+
+# Messages per history page (join and scroll-back)
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+# Bytes read from a socket per recv() call
+RECV_SIZE = 65536
+
+# Largest file sent in one frame to clients without chunked downloads
+LEGACY_DOWNLOAD_LIMIT = 5 * 1024 * 1024
+
+# Connected clients: {socket: {username, room, session, addr, conn}}
 clients = {}
 clients_lock = threading.Lock()
 
@@ -24,92 +59,207 @@ clients_lock = threading.Lock()
 rooms = defaultdict(set)
 rooms_lock = threading.Lock()
 
+# Room socket index: {room: set(client keys)}, guarded by clients_lock.
+# Lets broadcasts touch only the members of one room.
+room_members = defaultdict(set)
+
+log = logging.getLogger("chat.server")
+
+# ----- Metrics (served by server/metrics.py) -----
+MESSAGES = Counter("chat_messages_total", "Frames received, by type", ("type",))
+HANDLER_SECONDS = Histogram(
+    "chat_handler_seconds", "Time to handle a frame, by type", ("type",)
+)
+BROADCAST_RECIPIENTS = Histogram(
+    "chat_broadcast_recipients", "Local connections each room broadcast is queued on",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+CONNECTIONS = Counter("chat_connections_total", "Connections accepted")
+AUTHENTICATIONS = Counter(
+    "chat_authentications_total", "Login and register attempts", ("action", "result")
+)
+Gauge("chat_clients", "Authenticated clients connected", func=lambda: len(clients))
+Gauge("chat_rooms", "Rooms with connected members", func=lambda: len(room_members))
+Gauge(
+    "chat_send_queue_frames", "Frames waiting in client send queues",
+    ("stat",), func=lambda: {
+        (stat,): value for stat, value in send_queue_stats().items()
+        if stat in ("queued_frames", "max_depth")
+    }
+)
+Counter(
+    "chat_send_queue_events_total", "Frames enqueued, dropped or coalesced, and slow clients disconnected",
+    ("event",), func=lambda: {
+        (event,): value for event, value in send_queue_stats().items()
+        if event in ("enqueued", "dropped", "coalesced", "disconnected")
+    }
+)
+Gauge("chat_write_behind_pending", "Writes queued for group commit", func=write_behind_pending)
+Gauge("chat_message_log_unindexed_bytes", "Message log bytes not yet applied to the database",
+      func=lambda: message_log_stats().get("unindexed_bytes", 0))
+Gauge("chat_message_log_replay_seconds", "Time the last startup spent replaying the message log",
+      func=lambda: message_log_stats().get("replay_seconds", 0))
+Counter(
+    "chat_room_cache_lookups_total", "History pages looked up in the room cache",
+    ("result",), func=lambda: {("hit",): room_cache.hits, ("miss",): room_cache.misses}
+)
+Counter("chat_room_cache_evictions_total", "Rooms evicted from the room cache",
+        func=lambda: room_cache.evictions)
+
 
 class ClientConnection:
     """Wrapper for client socket with buffered reading"""
 
     def __init__(self, sock):
         self.sock = sock
-        self.buffer = ""
+        self.codec = JSON
+        self.decoder = FrameDecoder(JSON)
+        self.queue = OutboundQueue(on_overflow=self._on_overflow)
+        self.writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer.start()
+
+    def set_codec(self, codec):
+        """Switch framing for every frame after the one just queued"""
+        self.codec = codec
+        self.decoder.codec = codec
 
     def send(self, data):
-        """Send JSON data to client"""
+        """Send data to client (waits for queue space)"""
+        return self.queue.put(self.codec.encode(data), block=True)
+
+    def send_bytes(self, payload, coalesce_key=None):
+        """Queue an already encoded frame; never blocks the caller"""
+        return self.queue.put(payload, coalesce_key)
+
+    def _writer_loop(self):
+        """Drain the send queue, writing queued frames in one syscall"""
+        while True:
+            batch = self.queue.get_batch()
+            if batch is None:
+                return
+            try:
+                self.sock.sendall(b"".join(batch))
+            except Exception as e:
+                log.warning("Send error: %s", e)
+                self.queue.close()
+                return
+
+    def _on_overflow(self):
+        """Slow consumer under the disconnect policy: end its recv loop"""
         try:
-            payload = json.dumps(data) + "\n"
-            self.sock.sendall(payload.encode())
-            return True
-        except Exception as e:
-            print(f"Send error: {e}")
-            return False
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def recv(self):
-        """Receive and parse JSON data from client"""
+        """Receive and decode the next frame from client"""
         try:
-            while "\n" not in self.buffer:
-                chunk = self.sock.recv(4096).decode()
+            while True:
+                frame = self.decoder.next_frame()
+                if frame is not None:
+                    # Lazy: the frame is only formatted when debug logging is on
+                    log.debug("Received: %r", frame)
+                    return frame
+
+                chunk = self.sock.recv(RECV_SIZE)
                 if not chunk:
-                    print(f"[DEBUG] Socket closed, no data received")
+                    log.debug("Socket closed, no data received")
                     return None
-                self.buffer += chunk
-
-            line, self.buffer = self.buffer.split("\n", 1)
-            parsed = json.loads(line.strip())
-            print(f"[DEBUG] Received: {parsed}")
-            return parsed
-        except json.JSONDecodeError as e:
-            print(f"[!] JSON decode error: {e}, data: {line if 'line' in locals() else 'N/A'}")
+                self.decoder.feed(chunk)
+        except FrameError as e:
+            log.warning("[!] Frame decode error: %s", e)
             return None
         except Exception as e:
-            print(f"[!] Receive error: {e}")
-            traceback.print_exc()
+            log.warning("[!] Receive error: %s", e, exc_info=True)
             return None
 
     def close(self):
-        """Close socket ***"""
+        """Close socket *** after flushing queued frames"""
+        self.queue.close()
+        self.writer.join(timeout=1.0)
         try:
             self.sock.close()
         except:
             pass
 
 
-def broadcast_to_room(room, data, exclude_sock=None):
-    """Broadcast message to all clients in a room"""
+def broadcast_to_room(room, data, exclude_sock=None, coalesce_key=None):
+    """
+    Broadcast message to all clients in a room, on this server process
+    and, through the bus, on every other one.
+    The frame is encoded once and queued on each member's connection;
+    `coalesce_key` marks frames a newer one may replace for slow clients.
+    """
+    deliver_to_room(room, data, exclude_sock, coalesce_key)
+    get_bus().publish("broadcast", room=room, data=data, coalesce_key=coalesce_key)
+
+
+def deliver_to_room(room, data, exclude_sock=None, coalesce_key=None):
+    """Queue a frame for the members of a room connected to this process"""
     with clients_lock:
-        for sock, info in list(clients.items()):
-            if info.get("room") == room and sock != exclude_sock:
-                ClientConnection(sock).send(data)
+        conns = [
+            clients[sock]["conn"]
+            for sock in room_members.get(room, ())
+            if sock != exclude_sock
+        ]
+    BROADCAST_RECIPIENTS.observe(len(conns))
+
+    # Encode once per wire format in use, not once per recipient
+    payloads = {}
+    for conn in conns:
+        payload = payloads.get(conn.codec.name)
+        if payload is None:
+            payload = payloads[conn.codec.name] = conn.codec.encode(data)
+        conn.send_bytes(payload, coalesce_key)
 
 
 def get_room_users(room):
-    """Get list of usernames in a room"""
+    """Get list of usernames in a room, across all server processes"""
     with clients_lock:
-        return [
-            info["username"]
-            for sock, info in clients.items()
-            if info.get("room") == room
+        local = [
+            clients[sock]["username"]
+            for sock in room_members.get(room, ())
         ]
+    return local + remote_presence.users(room)
+
 
+def _leave_room_index(sock, room):
+    """Drop a client from a room's socket index (caller holds clients_lock)"""
+    members = room_members.get(room)
+    if members is not None:
+        members.discard(sock)
+        if not members:
+            del room_members[room]
 
-def handle_authentication(conn, data):
+
+def handle_authentication(conn, data, addr=None):
     """Handle login/register requests"""
     action = data.get("action")
     username = data.get("username", "").strip()
     password = data.get("password", "")
+    client_ip = addr[0] if addr else None
 
     if action == "register":
-        ok, msg, session = register_user(username, password)
+        ok, msg, session = register_user(username, password, client_ip)
     elif action == "login":
-        ok, msg, session = login_user(username, password)
+        ok, msg, session = login_user(username, password, client_ip)
     else:
         conn.send({"ok": False, "msg": "Invalid action"})
         return None, None
 
+    AUTHENTICATIONS.inc(action, "ok" if ok else "failed")
+
+    # Frames after this reply use the best codec both sides support
+    codec = negotiate(data.get("codecs")) if ok else JSON
+
     conn.send({
         "ok": ok,
         "msg": msg,
         "session": session,
-        "username": username if ok else None
+        "username": username if ok else None,
+        "codec": codec.name
     })
+    conn.set_codec(codec)
 
     return (username, session) if ok else (None, None)
 
@@ -124,50 +274,245 @@ def handle_join_room(conn, sock, data):
         conn.send({"ok": False, "msg": "Invalid session"})
         return
 
-    # Update client info
+    # Update client info and move it between room indexes
     with clients_lock:
+        previous_room = clients[sock].get("room")
+        if previous_room:
+            _leave_room_index(sock, previous_room)
         clients[sock]["room"] = room
         clients[sock]["username"] = username
+        room_members[room].add(sock)
 
     with rooms_lock:
+        if previous_room and previous_room != room:
+            rooms[previous_room].discard(username)
         rooms[room].add(username)
 
-    # Send room history
-    history = fetch_room_history(room, limit=50)
-    for row in history:
-        sender = row["sender"]
-        encrypted_msg = row["message"]
-        msg_id = row["message_id"]
-        timestamp = row["time"]
-        reply_to = row["reply_to"]
-        edited = row["edited_at"]
-
-        # Decrypt message
-        plain_msg = decrypt_message(room, encrypted_msg)
-
-        conn.send({
-            "type": "chat",
-            "sender": sender,
-            "message": plain_msg,
-            "message_id": msg_id,
-            "timestamp": timestamp,
-            "reply_to": reply_to,
-            "edited": bool(edited)
-        })
+    bus = get_bus()
+    if previous_room:
+        bus.publish("presence", room=previous_room, username=username, joined=False)
+    bus.publish("presence", room=room, username=username, joined=True)
+    room_presence.changed(room, previous_room)
 
-    # Notify room about new user
-    broadcast_to_room(room, {
-        "type": "user_joined",
-        "username": username,
-        "users": get_room_users(room)
-    })
+    if previous_room and previous_room != room:
+        stop_typing(previous_room, username)
+        receipts.forget(previous_room, username)
 
+    # Acknowledge first so the client's join_room() gets the reply,
+    # then send the newest history page as a single frame. The member
+    # list is the announced one: presence deltas continue from its version.
+    version, users = room_presence.snapshot(room)
     conn.send({
         "ok": True,
         "room": room,
-        "users": get_room_users(room)
+        "users": users,
+        "presence_version": version
     })
 
+    conn.send(build_history_page(room, HISTORY_PAGE_SIZE))
+
+    watermarks = get_read_watermarks(room)
+    if watermarks:
+        conn.send({"type": "read_receipts", "read_up_to": watermarks})
+
+    for typist in typing_tracker.users(room):
+        if typist != username:
+            conn.send({"type": "typing", "username": typist, "typing": True})
+
+
+def handle_presence_request(conn, sock, data):
+    """Send the current room's member list, for a client that missed a delta"""
+    username = authenticate_session(data.get("session"))
+    if not username:
+        return
+
+    with clients_lock:
+        room = clients.get(sock, {}).get("room")
+
+    if room:
+        version, users = room_presence.snapshot(room)
+        conn.send({"type": "presence", "room": room, "version": version, "users": users})
+
+
+def deliver_presence(room, version, joined, left):
+    """
+    Tell this process's members of a room who joined and left it.
+    Every process announces its own deltas, computed from the members it
+    knows of on all processes, so versions are per process.
+    """
+    deliver_to_room(room, {
+        "type": "presence",
+        "room": room,
+        "version": version,
+        "joined": joined,
+        "left": left
+    })
+
+
+def deliver_presence_snapshot(room, version, users):
+    """Periodic full member list; a newer one replaces a queued one"""
+    deliver_to_room(room, {
+        "type": "presence",
+        "room": room,
+        "version": version,
+        "users": users
+    }, coalesce_key=("presence", room))
+
+
+def update_room_cache(op, room, **fields):
+    """Apply a change to the room cache here and on the other processes"""
+    _apply_cache_op(op, room, fields)
+    get_bus().publish("cache", op=op, room=room, **fields)
+
+
+def invalidate_room_cache(room):
+    """Drop a room's cached history here and on the other processes"""
+    update_room_cache("invalidate", room)
+
+
+def _apply_cache_op(op, room, fields):
+    if op == "append":
+        room_cache.append(room, fields["message"])
+    elif op == "update":
+        room_cache.update(room, fields["message_id"], **fields["fields"])
+    elif op == "invalidate":
+        room_cache.invalidate(room)
+    elif op == "hold":
+        room_cache.hold(room, fields["node"])
+    elif op == "release":
+        room_cache.release(room, fields["node"])
+
+
+def hold_room_cache(room, queued):
+    """
+    Keep every process from caching a room's history while this one has
+    message writes to it queued in front of the database
+    """
+    update_room_cache("hold" if queued else "release", room, node=get_bus().node)
+
+
+def build_history_page(room, limit, before=None):
+    """
+    Build a `history` frame with up to `limit` messages older than the
+    `before` cursor (newest messages when None), oldest first.
+    """
+    # The newest page of a hot room is served from memory
+    cached = room_cache.get_page(room, limit) if before is None else None
+
+    if cached:
+        messages, has_more = cached
+    else:
+        read = room_cache.start_read(room) if before is None else None
+        try:
+            rows, has_more = fetch_room_history(room, limit=limit, before=before)
+
+            texts = decrypt_many(room, [row["message"] for row in rows])
+            messages = [
+                {
+                    "sender": row["sender"],
+                    "message": text,
+                    "message_id": row["message_id"],
+                    "timestamp": row["time"],
+                    "reply_to": row["reply_to"],
+                    "edited": bool(row["edited_at"])
+                }
+                for row, text in zip(rows, texts)
+            ]
+
+            if read is not None:
+                room_cache.fill(room, messages, has_more, read)
+        finally:
+            if read is not None:
+                room_cache.end_read(room, read)
+
+    return {
+        "type": "history",
+        "room": room,
+        "before": before,
+        "messages": messages,
+        # Pass back as `before` to fetch the previous page
+        "cursor": messages[0]["message_id"] if messages else before,
+        "has_more": has_more
+    }
+
+
+def handle_history_request(conn, sock, data):
+    """Handle a scroll-back request for older messages"""
+    session = data.get("session")
+    username = authenticate_session(session)
+
+    if not username:
+        conn.send({"ok": False, "msg": "Authentication required"})
+        return
+
+    with clients_lock:
+        room = clients.get(sock, {}).get("room")
+
+    if not room:
+        conn.send({"ok": False, "msg": "Not in a room"})
+        return
+
+    before = data.get("before")
+    if before is not None and not isinstance(before, str):
+        # Answer anyway: the client waits for a page before asking again
+        conn.send({
+            "type": "history",
+            "room": room,
+            "before": before,
+            "messages": [],
+            "cursor": before,
+            "has_more": False
+        })
+        return
+
+    try:
+        limit = int(data.get("limit", HISTORY_PAGE_SIZE))
+    except (TypeError, ValueError):
+        limit = HISTORY_PAGE_SIZE
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+
+    conn.send(build_history_page(room, limit, before))
+
+
+def handle_search(conn, sock, data):
+    """Search the current room for messages containing every word of a query"""
+    session = data.get("session")
+    username = authenticate_session(session)
+
+    if not username:
+        conn.send({"ok": False, "msg": "Authentication required"})
+        return
+
+    with clients_lock:
+        room = clients.get(sock, {}).get("room")
+
+    if not room:
+        conn.send({"ok": False, "msg": "Not in a room"})
+        return
+
+    query = data.get("query")
+    before = data.get("before")
+    if not isinstance(query, str) or (before is not None and not isinstance(before, str)):
+        # Answer anyway: the client waits for results before searching again
+        conn.send({
+            "type": "search_results",
+            "room": room,
+            "query": query,
+            "before": before,
+            "results": [],
+            "cursor": before,
+            "has_more": False
+        })
+        return
+
+    try:
+        limit = int(data.get("limit", SEARCH_PAGE_SIZE))
+    except (TypeError, ValueError):
+        limit = SEARCH_PAGE_SIZE
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+
+    conn.send(search_room(room, query, limit, before))
+
 
 def handle_chat_message(conn, sock, data):
     """Handle incoming chat message"""
@@ -192,25 +537,50 @@ def handle_chat_message(conn, sock, data):
     if not message:
         return
 
+    # A sent message ends the sender's typing
+    stop_typing(room, username)
+
     # Encrypt and save message
     encrypted_msg = encrypt_message(room, message)
-    save_message(room, username, encrypted_msg, message_id, reply_to)
+    save_message(
+        room, username, encrypted_msg, message_id, reply_to,
+        tokens=message_tokens(room, message)
+    )
 
     # Broadcast to room (plaintext)
     timestamp = datetime.now().strftime("%H:%M")
-    broadcast_to_room(room, {
-        "type": "chat",
+    chat = {
         "sender": username,
         "message": message,
         "message_id": message_id,
         "timestamp": timestamp,
         "reply_to": reply_to,
         "edited": False
-    })
+    }
+    update_room_cache("append", room, message=chat)
+    broadcast_to_room(room, dict(chat, type="chat"))
+
+
+def broadcast_typing(room, username, is_typing, exclude_sock=None):
+    """Tell a room that one user started or stopped typing"""
+    broadcast_to_room(room, {
+        "type": "typing",
+        "username": username,
+        "typing": is_typing
+    }, exclude_sock=exclude_sock, coalesce_key=("typing", room, username))
+
+
+def broadcast_typing_expired(room, username):
+    broadcast_typing(room, username, False)
+
+
+def stop_typing(room, username):
+    if typing_tracker.stop(room, username):
+        broadcast_typing(room, username, False)
 
 
 def handle_typing_indicator(conn, sock, data):
-    """Handle typing indicator"""
+    """Handle typing indicator; only changes of state are broadcast"""
     session = data.get("session")
     username = authenticate_session(session)
 
@@ -223,45 +593,60 @@ def handle_typing_indicator(conn, sock, data):
     if not room:
         return
 
-    is_typing = data.get("typing", False)
+    is_typing = bool(data.get("typing", False))
 
     if is_typing:
-        update_typing_status(room, username)
-
-    # Broadcast typing users to room
-    typing_users = [u for u in get_typing_users(room) if u != username]
+        changed = typing_tracker.start(room, username)
+    else:
+        changed = typing_tracker.stop(room, username)
 
-    broadcast_to_room(room, {
-        "type": "typing",
-        "users": typing_users
-    }, exclude_sock=sock)
+    if changed:
+        broadcast_typing(room, username, is_typing, exclude_sock=sock)
 
 
 def handle_read_receipt(conn, sock, data):
-    """Handle message read receipt"""
+    """
+    Handle a read receipt: the user has read the room up to and
+    including `up_to`. One frame covers every earlier message, and
+    receipts are broadcast per room every RECEIPT_WINDOW_MS.
+    """
     session = data.get("session")
     username = authenticate_session(session)
 
     if not username:
         return
 
-    message_id = data.get("message_id")
+    # Older clients send one receipt per message as `message_id`
+    message_id = data.get("up_to") or data.get("message_id")
     if not message_id:
         return
 
-    mark_message_read(message_id, username)
-
     with clients_lock:
         room = clients.get(sock, {}).get("room")
 
-    if room:
-        # Notify sender about read receipt
-        receipts = get_read_receipts(message_id)
-        broadcast_to_room(room, {
-            "type": "read_receipt",
-            "message_id": message_id,
-            "readers": [r["username"] for r in receipts]
-        })
+    if not room or not isinstance(message_id, str):
+        return
+
+    # Only a message of this room, and only forwards
+    position, stored = read_position(room, username, message_id)
+    if position is None:
+        # Not committed yet (write-behind or the message log): a message
+        # just sent to the room is newer than any stored watermark
+        if not room_cache.contains(room, message_id):
+            return
+    elif stored is not None and position <= stored:
+        return
+
+    if receipts.update(room, username, message_id, position):
+        mark_read_up_to(room, username, message_id)
+
+
+def broadcast_read_receipts(room, watermarks):
+    """Send a room the last message each reader has read"""
+    broadcast_to_room(room, {
+        "type": "read_receipts",
+        "read_up_to": watermarks
+    }, coalesce_key=("read_receipts", room, get_bus().node))
 
 
 def handle_edit_message(conn, sock, data):
@@ -283,7 +668,10 @@ def handle_edit_message(conn, sock, data):
 
     # Encrypt and update
     encrypted_msg = encrypt_message(room, new_text)
-    edit_message(message_id, encrypted_msg)
+    edit_message(room, message_id, encrypted_msg, tokens=message_tokens(room, new_text))
+    update_room_cache(
+        "update", room, message_id=message_id, fields={"message": new_text, "edited": True}
+    )
 
     # Broadcast edit
     broadcast_to_room(room, {
@@ -303,12 +691,13 @@ def handle_delete_message(conn, sock, data):
         return
 
     message_id = data.get("message_id")
-    delete_message(message_id)
 
     with clients_lock:
         room = clients.get(sock, {}).get("room")
 
     if room:
+        delete_message(room, message_id)
+        invalidate_room_cache(room)
         broadcast_to_room(room, {
             "type": "message_deleted",
             "message_id": message_id
@@ -333,15 +722,23 @@ def handle_file_upload(conn, sock, data):
         conn.send({"ok": False, "msg": "Missing file data"})
         return
 
+    # The room picks the shard the attachment row goes to
+    with clients_lock:
+        room = clients.get(sock, {}).get("room")
+    if not room:
+        conn.send({"ok": False, "msg": "Join a room first"})
+        return
+
     try:
-        # Decode and encrypt file
+        # Decode and store the file in the blob store
         file_data = base64.b64decode(file_data_b64)
 
-        with clients_lock:
-            room = clients.get(sock, {}).get("room")
-
-        encrypted_data = encrypt_file(room, file_data)
-        save_attachment(message_id, filename, file_type, encrypted_data)
+        chunks = (file_data[i:i + CHUNK_SIZE] for i in range(0, len(file_data), CHUNK_SIZE))
+        blob_id, sha256 = store_chunks(chunks if file_data else [b""], len(file_data))
+        save_blob_attachment(
+            message_id, room, filename, file_type or "", blob_id,
+            len(file_data), CHUNK_SIZE, sha256
+        )
 
         conn.send({"ok": True, "message_id": message_id})
 
@@ -351,6 +748,7 @@ def handle_file_upload(conn, sock, data):
             "message_id": message_id,
             "filename": filename,
             "file_type": file_type,
+            "size": len(file_data),
             "sender": username
         })
 
@@ -358,8 +756,22 @@ def handle_file_upload(conn, sock, data):
         conn.send({"ok": False, "msg": f"Upload failed: {e}"})
 
 
+def _room_attachment(sock, message_id):
+    """
+    Look up an attachment for a download. Returns (attachment, room);
+    the attachment is None unless it belongs to the client's room.
+    """
+    with clients_lock:
+        room = clients.get(sock, {}).get("room")
+
+    attachment = get_attachment(room, message_id) if room else None
+    if attachment and attachment["room"] != room:
+        return None, room
+    return attachment, room
+
+
 def handle_file_download(conn, sock, data):
-    """Handle file download request"""
+    """Handle a single-frame file download (clients without download_range)"""
     session = data.get("session")
     username = authenticate_session(session)
 
@@ -367,17 +779,18 @@ def handle_file_download(conn, sock, data):
         return
 
     message_id = data.get("message_id")
-    attachment = get_attachment(message_id)
+    attachment, room = _room_attachment(sock, message_id)
 
     if not attachment:
         conn.send({"ok": False, "msg": "File not found"})
         return
 
-    with clients_lock:
-        room = clients.get(sock, {}).get("room")
+    if attachment["file_size"] > LEGACY_DOWNLOAD_LIMIT:
+        conn.send({"ok": False, "msg": "File too large for this client version"})
+        return
 
     # Decrypt and send file
-    decrypted_data = decrypt_file(room, attachment["file_data"])
+    decrypted_data = AttachmentReader(attachment, room).read_all()
     file_b64 = base64.b64encode(decrypted_data).decode()
 
     conn.send({
@@ -388,106 +801,373 @@ def handle_file_download(conn, sock, data):
     })
 
 
+def _upload_error(conn, data, msg, missing=None):
+    conn.send({
+        "type": "upload_error",
+        "upload_id": data.get("upload_id"),
+        "message_id": data.get("message_id"),
+        "index": data.get("index"),
+        "missing": missing,
+        "msg": msg
+    })
+
+
+def handle_upload_init(conn, sock, data):
+    """Start (or resume) a chunked upload and tell the client what to send"""
+    username = authenticate_session(data.get("session"))
+    if not username:
+        conn.send({"ok": False, "msg": "Authentication required"})
+        return
+
+    with clients_lock:
+        room = clients.get(sock, {}).get("room")
+    if not room:
+        _upload_error(conn, data, "Join a room first")
+        return
+
+    try:
+        upload = uploads.start(
+            username, room,
+            data.get("message_id"), data.get("filename"), data.get("file_type"),
+            data.get("size"), upload_id=data.get("upload_id")
+        )
+    except TransferError as e:
+        _upload_error(conn, data, str(e))
+        return
+
+    conn.send({
+        "type": "upload_ready",
+        "upload_id": upload.upload_id,
+        "message_id": upload.message_id,
+        "chunk_size": upload.chunk_size,
+        "missing": upload.missing()
+    })
+
+
+def handle_upload_chunk(conn, sock, data):
+    """
+    Store one chunk of an upload. Chunks are not acknowledged one by
+    one: TCP flow control paces the sender, and upload_commit reports
+    any chunk that has to be sent again.
+    """
+    username = authenticate_session(data.get("session"))
+    if not username:
+        return
+
+    try:
+        chunk = conn.codec.unpack_bytes(data.get("data"))
+        uploads.write_chunk(
+            username, data.get("upload_id"), data.get("index"), chunk, data.get("sha256")
+        )
+    except TransferError as e:
+        _upload_error(conn, data, str(e))
+    except (TypeError, ValueError):
+        _upload_error(conn, data, "Malformed chunk")
+
+
+def handle_upload_commit(conn, sock, data):
+    """Finish a chunked upload and announce the file to the room"""
+    username = authenticate_session(data.get("session"))
+    if not username:
+        conn.send({"ok": False, "msg": "Authentication required"})
+        return
+
+    try:
+        upload = uploads.commit(username, data.get("upload_id"), data.get("sha256"))
+    except TransferError as e:
+        _upload_error(conn, data, str(e), missing=e.missing)
+        return
+
+    save_blob_attachment(
+        upload.message_id, upload.room, upload.filename, upload.file_type,
+        upload.blob_id, upload.size, upload.chunk_size, upload.sha256
+    )
+
+    conn.send({
+        "type": "upload_complete",
+        "upload_id": upload.upload_id,
+        "message_id": upload.message_id
+    })
+
+    broadcast_to_room(upload.room, {
+        "type": "file_attached",
+        "message_id": upload.message_id,
+        "filename": upload.filename,
+        "file_type": upload.file_type,
+        "size": upload.size,
+        "sender": username
+    })
+
+
+def handle_download_range(conn, sock, data):
+    """
+    Send up to DOWNLOAD_WINDOW chunks of an attachment from `offset`.
+    The client asks for the next range when this one has arrived, so a
+    download never has more than one window queued on the connection.
+    """
+    username = authenticate_session(data.get("session"))
+    if not username:
+        return
+
+    message_id = data.get("message_id")
+    offset = data.get("offset") or 0
+    attachment, room = _room_attachment(sock, message_id)
+
+    if not attachment or not isinstance(offset, int) or offset < 0:
+        conn.send({"type": "download_error", "message_id": message_id,
+                   "msg": "File not found"})
+        return
+
+    try:
+        reader = AttachmentReader(attachment, room)
+        first = offset // reader.chunk_size
+        count = max(0, min(DOWNLOAD_WINDOW, reader.count - first))
+
+        conn.send({
+            "type": "download_range",
+            "message_id": message_id,
+            "filename": reader.filename,
+            "file_type": reader.file_type,
+            "size": reader.size,
+            "chunk_size": reader.chunk_size,
+            "chunks": reader.count,
+            "sha256": reader.sha256,
+            "first": first,
+            "count": count
+        })
+
+        for index, chunk in reader.chunks(first, count):
+            conn.send({
+                "type": "download_chunk",
+                "message_id": message_id,
+                "index": index,
+                "data": conn.codec.pack_bytes(chunk),
+                "sha256": chunk_hash(chunk)
+            })
+    except Exception as e:
+        log.warning("[!] Download of %s failed: %s", message_id, e)
+        conn.send({"type": "download_error", "message_id": message_id,
+                   "msg": "Download failed"})
+
+
+# Message type -> handler(conn, sock, data)
+MESSAGE_HANDLERS = {
+    "join": handle_join_room,
+    "presence": handle_presence_request,
+    "history": handle_history_request,
+    "search": handle_search,
+    "chat": handle_chat_message,
+    "typing": handle_typing_indicator,
+    "read": handle_read_receipt,
+    "edit": handle_edit_message,
+    "delete": handle_delete_message,
+    "upload": handle_file_upload,
+    "download": handle_file_download,
+    "upload_init": handle_upload_init,
+    "upload_chunk": handle_upload_chunk,
+    "upload_commit": handle_upload_commit,
+    "download_range": handle_download_range,
+}
+
+
+def dispatch_message(conn, sock, data, username=None):
+    """
+    Route a decoded frame to its handler.
+    `sock` is the key of the client in `clients`: the raw socket in
+    threaded mode, the connection object in asyncio mode.
+    """
+    msg_type = data.get("type")
+    log.debug("Received message type '%s' from %s", msg_type, username)
+
+    handler = MESSAGE_HANDLERS.get(msg_type)
+    if handler is None:
+        MESSAGES.inc("unknown")  # not labelled by type: clients choose it
+        log.warning("[!] Unknown message type: %s", msg_type)
+        return
+
+    MESSAGES.inc(msg_type)
+    start = time.perf_counter()
+    try:
+        handler(conn, sock, data)
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - start, msg_type)
+
+
+def register_client(conn, sock, username, session, addr):
+    """Add an authenticated client to the connected clients table"""
+    with clients_lock:
+        clients[sock] = {
+            "username": username,
+            "session": session,
+            "room": None,
+            "addr": addr,
+            "conn": conn
+        }
+
+
+def unregister_client(sock, username):
+    """Remove a client and notify the room it was in"""
+    with clients_lock:
+        client_info = clients.pop(sock, {})
+        room = client_info.get("room")
+        if room:
+            _leave_room_index(sock, room)
+
+    if room and username:
+        with rooms_lock:
+            rooms[room].discard(username)
+
+        stop_typing(room, username)
+        receipts.forget(room, username)
+        get_bus().publish("presence", room=room, username=username, joined=False)
+        room_presence.changed(room)
+
+
 def handle_client(sock, addr):
     """Main client handler with detailed error logging"""
     conn = ClientConnection(sock)
     username = None
 
-    print(f"[+] New connection from {addr}")
+    CONNECTIONS.inc()
+    log.info("[+] New connection from %s", addr)
 
     try:
         # Authentication phase
-        print(f"[DEBUG] Waiting for auth data from {addr}...")
+        log.debug("Waiting for auth data from %s...", addr)
         auth_data = conn.recv()
         
         if not auth_data:
-            print(f"[!] No auth data received from {addr}")
+            log.info("[!] No auth data received from %s", addr)
             return
 
-        print(f"[DEBUG] Received auth data: {auth_data.get('action', 'NO ACTION')} from {addr}")
+        log.debug("Received auth data: %s from %s", auth_data.get("action", "NO ACTION"), addr)
         
-        username, session = handle_authentication(conn, auth_data)
+        username, session = handle_authentication(conn, auth_data, addr)
         if not username:
-            print(f"[!] Authentication failed for {addr}")
+            log.info("[!] Authentication failed for %s", addr)
             return
 
-        # Register client
-        with clients_lock:
-            clients[sock] = {
-                "username": username,
-                "session": session,
-                "room": None,
-                "addr": addr
-            }
+        register_client(conn, sock, username, session, addr)
 
-        print(f"[✓] {username} authenticated successfully")
+        log.info("[✓] %s authenticated successfully", username)
 
         # Message handling loop
         while True:
             data = conn.recv()
             if not data:
-                print(f"[DEBUG] No data received from {username}, closing connection")
+                log.debug("No data received from %s, closing connection", username)
                 break
 
-            msg_type = data.get("type")
-            print(f"[DEBUG] Received message type '{msg_type}' from {username}")
-
-            if msg_type == "join":
-                handle_join_room(conn, sock, data)
-            elif msg_type == "chat":
-                handle_chat_message(conn, sock, data)
-            elif msg_type == "typing":
-                handle_typing_indicator(conn, sock, data)
-            elif msg_type == "read":
-                handle_read_receipt(conn, sock, data)
-            elif msg_type == "edit":
-                handle_edit_message(conn, sock, data)
-            elif msg_type == "delete":
-                handle_delete_message(conn, sock, data)
-            elif msg_type == "upload":
-                handle_file_upload(conn, sock, data)
-            elif msg_type == "download":
-                handle_file_download(conn, sock, data)
-            else:
-                print(f"[!] Unknown message type: {msg_type}")
+            dispatch_message(conn, sock, data, username)
 
     except json.JSONDecodeError as e:
-        print(f"[!] JSON decode error from {username or addr}: {e}")
+        log.warning("[!] JSON decode error from %s: %s", username or addr, e)
     except Exception as e:
-        print(f"[!] Error handling {username or addr}: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("[!] Error handling %s: %s", username or addr, e)
 
     finally:
-        # Cleanup
-        with clients_lock:
-            client_info = clients.pop(sock, {})
-            room = client_info.get("room")
-
-        if room and username:
-            with rooms_lock:
-                rooms[room].discard(username)
-
-            # Notify room about user leaving
-            broadcast_to_room(room, {
-                "type": "user_left",
-                "username": username,
-                "users": get_room_users(room)
-            })
-
+        unregister_client(sock, username)
         conn.close()
-        print(f"[-] {username or addr} disconnected")
+        log.info("[-] %s disconnected", username or addr)
+
+# ----- Bus: state shared with the other server processes -----
+
+def local_presence():
+    """{room: [usernames]} of the clients connected to this process"""
+    with clients_lock:
+        return {
+            room: [clients[sock]["username"] for sock in members]
+            for room, members in room_members.items()
+        }
+
+
+def publish_presence_snapshot():
+    get_bus().publish("snapshot", rooms=local_presence())
+
+
+def _on_bus_broadcast(message):
+    coalesce_key = message.get("coalesce_key")
+    deliver_to_room(
+        message["room"], message["data"],
+        coalesce_key=tuple(coalesce_key) if coalesce_key else None
+    )
+
+
+def _on_bus_presence(message):
+    if message["joined"]:
+        remote_presence.joined(message["node"], message["room"], message["username"])
+    else:
+        remote_presence.left(message["node"], message["room"], message["username"])
+    room_presence.changed(message["room"])
+
+
+def _on_bus_snapshot(message):
+    room_presence.changed(*remote_presence.replace(message["node"], message["rooms"]))
+
+
+def _on_bus_node_down(message):
+    """A process went away: its users left their rooms"""
+    room_presence.changed(*remote_presence.drop(message["node"]))
+    room_cache.release_node(message["node"])
+
+
+def _on_bus_cache(message):
+    _apply_cache_op(message["op"], message["room"], message)
+
+
+BUS_HANDLERS = {
+    "broadcast": _on_bus_broadcast,
+    "presence": _on_bus_presence,
+    # A new process asks for everyone's presence by saying hello
+    "hello": lambda message: publish_presence_snapshot(),
+    "snapshot": _on_bus_snapshot,
+    "node_down": _on_bus_node_down,
+    "cache": _on_bus_cache,
+    "sessions_ended": lambda message: forget_sessions(message["sessions"]),
+}
+
+
+def handle_bus_message(message):
+    handler = BUS_HANDLERS.get(message.get("kind"))
+    if handler:
+        handler(message)
+
+
+def connect_bus():
+    """Start sharing rooms with the other processes on the bus"""
+    bus = get_bus()
+    bus.subscribe(handle_bus_message)
+    bus.on_connect(publish_presence_snapshot)
+    bus.start()
+
 
-def start_server():
-    """Start the chat server"""
+def start_server(host=None, port=None, reuse_port=False):
+    """
+    Start the chat server. With reuse_port, several processes can
+    listen on the same port (SO_REUSEPORT) and share rooms over the bus.
+    """
     init_db()
+    watch_queued_writes(hold_room_cache)
+    open_message_log()
+    connect_bus()
+    start_metrics_server()
+    start_rekey_worker()
+    start_maintenance_worker(on_archived=invalidate_room_cache)
+    typing_tracker.start_expiry(broadcast_typing_expired)
+    receipts.start(broadcast_read_receipts)
+    room_presence.start(get_room_users, deliver_presence, deliver_presence_snapshot)
+
+    host = host or HOST
+    port = port or PORT
 
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((HOST, PORT))
-    server.listen(5)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((host, port))
+    server.listen(LISTEN_BACKLOG)
 
-    print(f"✅ Server running on {HOST}:{PORT}")
+    print(f"✅ Server running on {host}:{port}")
     print("Waiting for ***s...")
 
     try:
@@ -502,7 +1182,18 @@ def start_server():
         print("\n[!] Server shutting down...")
     finally:
         server.close()
+        stop_rekey_worker()
+        stop_maintenance_worker()
+        typing_tracker.stop_expiry()
+        receipts.stop()
+        room_presence.stop()
+        get_bus().close()
+        stop_metrics_server()
+        flush_last_seen()
+        disable_write_behind()
+        close_message_log()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     start_server()
\ No newline at end of file
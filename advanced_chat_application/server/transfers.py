@@ -0,0 +1,238 @@
+# server/transfers.py
+import os
+import struct
+import threading
+import time
+from server.crypto import (
+    decrypt_chunk, encrypted_chunk_size, decrypt_file, unwrap_blob_key
+)
+from server.blob_store import (
+    MEDIA_DIR, CHUNK_SIZE, BlobFile, blob_path, new_partial, commit_partial
+)
+from protocol.chunks import chunk_count, chunk_hash, tree_hash
+
+# Per-room chunk files written before the blob store existed
+LEGACY_FILES_DIR = os.path.join(MEDIA_DIR, "files")
+
+MAX_FILE_SIZE = 100 * 1024 * 1024   # largest attachment accepted
+DOWNLOAD_WINDOW = 8                 # chunks sent per download_range request
+UPLOAD_IDLE_TIMEOUT = 30 * 60       # seconds before an unfinished upload is dropped
+
+_LENGTH = struct.Struct(">I")
+
+
+class TransferError(Exception):
+    """Invalid transfer request; the message is sent back to the client"""
+
+    def __init__(self, msg, missing=None):
+        super().__init__(msg)
+        self.missing = missing
+
+
+class ChunkFile:
+    """
+    Read side of the older per-room chunk files: Fernet tokens in
+    fixed-size slots of a 4-byte token length, the raw token, padding.
+    """
+
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.slot_size = _LENGTH.size + encrypted_chunk_size(chunk_size)
+
+    def read(self, first, count):
+        """Yield (index, token) for `count` chunks starting at `first`"""
+        with open(self.path, "rb") as f:
+            for index in range(first, first + count):
+                f.seek(index * self.slot_size)
+                (length,) = _LENGTH.unpack(f.read(_LENGTH.size))
+                yield index, f.read(length)
+
+
+class Upload:
+    """An upload in progress: chunks may arrive in any order, and again"""
+
+    def __init__(self, username, room, message_id, filename, file_type, size):
+        self.file = new_partial(CHUNK_SIZE)
+        self.upload_id = os.path.basename(self.file.path)
+        self.username = username
+        self.room = room
+        self.message_id = message_id
+        self.filename = filename
+        self.file_type = file_type
+        self.size = size
+        self.chunk_size = CHUNK_SIZE
+        self.count = chunk_count(size, CHUNK_SIZE)
+        self.hashes = {}  # index -> sha256 of the plaintext chunk
+        self.touched = time.monotonic()
+        self.sha256 = None
+        self.blob_id = None
+
+    def chunk_length(self, index):
+        if index == self.count - 1:
+            return self.size - index * self.chunk_size
+        return self.chunk_size
+
+    def missing(self):
+        return [i for i in range(self.count) if i not in self.hashes]
+
+
+class UploadManager:
+    """
+    Uploads in progress, by upload id.
+    State lives in memory and the partial file on disk, so a client that
+    reconnects can resume by sending upload_init with its upload_id.
+    """
+
+    def __init__(self):
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def start(self, username, room, message_id, filename, file_type, size,
+              upload_id=None):
+        """Begin an upload, or resume the caller's upload `upload_id`"""
+        self._expire()
+
+        if upload_id:
+            with self._lock:
+                upload = self._uploads.get(upload_id)
+            if upload and upload.username == username and upload.message_id == message_id:
+                upload.touched = time.monotonic()
+                return upload
+
+        if not message_id or not filename:
+            raise TransferError("Missing file data")
+        if not isinstance(size, int) or size < 0:
+            raise TransferError("Invalid file size")
+        if size > MAX_FILE_SIZE:
+            raise TransferError(f"File too large (max {MAX_FILE_SIZE // (1024 * 1024)}MB)")
+
+        upload = Upload(username, room, message_id, filename, file_type or "", size)
+        with self._lock:
+            self._uploads[upload.upload_id] = upload
+        return upload
+
+    def write_chunk(self, username, upload_id, index, data, digest):
+        """Verify one chunk against its hash, encrypt it and store it"""
+        upload = self._get(username, upload_id)
+
+        if not isinstance(index, int) or not 0 <= index < upload.count:
+            raise TransferError(f"Invalid chunk index {index}")
+        if len(data) != upload.chunk_length(index) or chunk_hash(data) != digest:
+            raise TransferError(f"Chunk {index} failed its integrity check")
+
+        upload.file.write(index, data)
+        upload.hashes[index] = digest
+        upload.touched = time.monotonic()
+
+    def commit(self, username, upload_id, digest):
+        """
+        Finish an upload once every chunk is in and the whole-file hash
+        matches. Returns the Upload with the id of its blob.
+        """
+        upload = self._get(username, upload_id)
+
+        missing = upload.missing()
+        if missing:
+            raise TransferError("Upload incomplete", missing=missing)
+
+        upload.sha256 = tree_hash(upload.hashes[i] for i in range(upload.count))
+        if upload.sha256 != digest:
+            self.abort(upload_id)
+            raise TransferError("File checksum mismatch")
+
+        upload.blob_id = commit_partial(upload.file, upload.sha256, upload.size)
+
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+        return upload
+
+    def abort(self, upload_id):
+        with self._lock:
+            upload = self._uploads.pop(upload_id, None)
+        if upload:
+            try:
+                os.remove(upload.file.path)
+            except OSError:
+                pass
+
+    def _get(self, username, upload_id):
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+        if upload is None or upload.username != username:
+            raise TransferError("Unknown upload")
+        return upload
+
+    def _expire(self):
+        """Drop uploads nobody has touched for UPLOAD_IDLE_TIMEOUT"""
+        cutoff = time.monotonic() - UPLOAD_IDLE_TIMEOUT
+        with self._lock:
+            stale = [u.upload_id for u in self._uploads.values() if u.touched < cutoff]
+        for upload_id in stale:
+            self.abort(upload_id)
+
+
+class AttachmentReader:
+    """Reads a stored attachment back in plaintext chunks"""
+
+    def __init__(self, attachment, room):
+        self.room = room
+        self.filename = attachment["filename"]
+        self.file_type = attachment["file_type"]
+        self.size = attachment["file_size"]
+        self.data = None
+        self.legacy = False
+
+        if attachment["blob_id"]:
+            self.chunk_size = attachment["chunk_size"]
+            self.sha256 = attachment["sha256"]
+            self.file = BlobFile(
+                blob_path(attachment["blob_id"]), self.chunk_size,
+                unwrap_blob_key(attachment["wrapped_key"])
+            )
+        elif attachment["storage_path"]:
+            # Per-room chunk file from before the blob store
+            self.chunk_size = attachment["chunk_size"]
+            self.sha256 = attachment["sha256"]
+            self.file = ChunkFile(
+                os.path.join(LEGACY_FILES_DIR, attachment["storage_path"]), self.chunk_size
+            )
+            self.legacy = True
+        else:
+            # Uploaded in a single frame: one encrypted BLOB in the row
+            self.chunk_size = CHUNK_SIZE
+            self.file = None
+            self.data = decrypt_file(room, attachment["file_data"])
+            self.size = len(self.data)
+            self.sha256 = tree_hash(chunk_hash(data) for _, data in self._slices(0, None))
+
+        self.count = chunk_count(self.size, self.chunk_size)
+
+    def chunks(self, first, count):
+        """Yield (index, plaintext) for up to `count` chunks from `first`"""
+        count = max(0, min(count, self.count - first))
+        if self.file is None:
+            yield from self._slices(first, count)
+            return
+        if not self.legacy:
+            yield from self.file.read(first, count)
+            return
+        for index, token in self.file.read(first, count):
+            yield index, decrypt_chunk(self.room, token)
+
+    def read_all(self):
+        """The whole file in memory, for clients without chunked downloads"""
+        if self.data is not None:
+            return self.data
+        return b"".join(data for _, data in self.chunks(0, self.count))
+
+    def _slices(self, first, count):
+        last = chunk_count(len(self.data), self.chunk_size)
+        if count is not None:
+            last = min(last, first + count)
+        for index in range(first, last):
+            start = index * self.chunk_size
+            yield index, self.data[start:start + self.chunk_size]
+
+
+uploads = UploadManager()
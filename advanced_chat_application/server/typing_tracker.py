@@ -0,0 +1,117 @@
+# server/typing_tracker.py
+import threading
+import time
+from collections import defaultdict
+
+TYPING_TIMEOUT = 3.0   # seconds without a typing frame before a user stops typing
+TYPING_TICK = 0.25     # expiry resolution of the timer wheel
+
+
+class TypingTracker:
+    """
+    Who is typing in each room, held in memory only.
+    start() and stop() return True when they change a user's state, so
+    callers broadcast only changes: repeated typing frames within the
+    timeout just push the deadline back. Deadlines sit in a timer wheel
+    of TYPING_TICK slots; advance() expires them without scanning every
+    typing user.
+    """
+
+    def __init__(self, timeout=None, tick=None):
+        self.timeout = timeout or TYPING_TIMEOUT
+        self.tick = tick or TYPING_TICK
+        self._ticks = max(1, round(self.timeout / self.tick))
+        self._slots = [set() for _ in range(self._ticks + 1)]
+        self._deadlines = {}               # (room, username) -> deadline tick
+        self._rooms = defaultdict(set)     # room -> usernames typing
+        self._cursor = self._now()         # last tick advance() processed
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _now(self):
+        return int(time.monotonic() / self.tick)
+
+    def start(self, room, username):
+        """Mark a user as typing; True if they were not already"""
+        key = (room, username)
+        deadline = self._now() + self._ticks
+        with self._lock:
+            started = key not in self._deadlines
+            self._deadlines[key] = deadline
+            # A refreshed key stays in its old slot too; advance() skips it there
+            self._slots[deadline % len(self._slots)].add(key)
+            if started:
+                self._rooms[room].add(username)
+        return started
+
+    def stop(self, room, username):
+        """Mark a user as no longer typing; True if they were"""
+        with self._lock:
+            return self._remove((room, username))
+
+    def users(self, room):
+        with self._lock:
+            return sorted(self._rooms.get(room, ()))
+
+    def advance(self):
+        """Expire users whose deadline has passed; returns [(room, username)]"""
+        expired = []
+        now = self._now()
+        size = len(self._slots)
+        with self._lock:
+            # One lap of the wheel covers every slot, however late we are
+            for tick in range(max(self._cursor + 1, now - size + 1), now + 1):
+                slot = self._slots[tick % size]
+                keep = set()
+                for key in slot:
+                    deadline = self._deadlines.get(key)
+                    if deadline is None:
+                        continue
+                    if deadline <= tick:
+                        self._remove(key)
+                        expired.append(key)
+                    elif deadline % size == tick % size:
+                        keep.add(key)  # due on a later lap
+                self._slots[tick % size] = keep
+            self._cursor = max(self._cursor, now)
+        return expired
+
+    def _remove(self, key):
+        if self._deadlines.pop(key, None) is None:
+            return False
+        room, username = key
+        users = self._rooms[room]
+        users.discard(username)
+        if not users:
+            del self._rooms[room]
+        return True
+
+    # ----- Expiry thread -----
+
+    def start_expiry(self, on_expired):
+        """Call on_expired(room, username) from a background thread as users time out"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(on_expired,), name="typing-expiry", daemon=True
+        )
+        self._thread.start()
+
+    def stop_expiry(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, on_expired):
+        while not self._stop.wait(self.tick):
+            for room, username in self.advance():
+                try:
+                    on_expired(room, username)
+                except Exception as e:
+                    print(f"Typing expiry error: {e}")
+
+
+typing_tracker = TypingTracker()
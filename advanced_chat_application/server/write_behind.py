@@ -0,0 +1,173 @@
+# server/write_behind.py
+import queue
+import threading
+import time
+import traceback
+
+# Durability modes
+#   async        - writers return as soon as the row is queued
+#   flush_on_ack - writers wait until the batch holding their row commits
+DURABILITY_ASYNC = "async"
+DURABILITY_FLUSH_ON_ACK = "flush_on_ack"
+DURABILITY_MODES = (DURABILITY_ASYNC, DURABILITY_FLUSH_ON_ACK)
+
+BATCH_INTERVAL_MS = 20     # longest a queued row waits for its batch
+BATCH_MAX_ROWS = 500       # rows committed per transaction at most
+QUEUE_LIMIT = 10_000       # queued rows before writers block (backpressure)
+
+_STOP = object()
+
+
+class WriteBehindError(Exception):
+    pass
+
+
+class _Ack:
+    """What a waiting writer learns about its write"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class WriteBehindQueue:
+    """
+    Group-commit stage in front of the database.
+    Writers submit (op, args) pairs; one background thread applies them
+    in order and commits every BATCH_INTERVAL_MS or BATCH_MAX_ROWS.
+    When a batch fails, its writes are applied one at a time so only the
+    failing ones are lost; their errors reach waiting writers and flush().
+    """
+
+    def __init__(self, run_batch, interval_ms=None, max_rows=None,
+                 limit=None, durability=DURABILITY_ASYNC, on_done=None):
+        self.run_batch = run_batch          # run_batch(list of (op, args))
+        self.on_done = on_done              # on_done(list of (op, args)), committed or lost
+        self.interval = (interval_ms or BATCH_INTERVAL_MS) / 1000
+        self.max_rows = max_rows or BATCH_MAX_ROWS
+        self.durability = durability
+        self._queue = queue.Queue(maxsize=limit or QUEUE_LIMIT)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._failures = []        # errors since the last flush()
+        self.stats = {
+            "submitted": 0,
+            "committed": 0,
+            "batches": 0,
+            "largest_batch": 0,
+            "errors": 0,
+            "failed": 0
+        }
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="write-behind", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, op, args=()):
+        """
+        Queue a write. Blocks while the queue is full, and in flush_on_ack
+        mode until the write has been committed, raising its error if the
+        write could not be.
+        """
+        ack = _Ack() if self.durability == DURABILITY_FLUSH_ON_ACK else None
+        self._queue.put((op, args, ack))
+        with self._lock:
+            self.stats["submitted"] += 1
+        if ack:
+            ack.done.wait()
+            if ack.error is not None:
+                raise ack.error
+
+    def flush(self):
+        """
+        Wait until everything submitted so far has been applied.
+        Raises WriteBehindError if any write failed since the last flush.
+        """
+        ack = _Ack()
+        self._queue.put((None, (), ack))
+        ack.done.wait()
+        with self._lock:
+            failures, self._failures = self._failures, []
+        if failures:
+            raise WriteBehindError(f"{len(failures)} write(s) failed") from failures[0]
+
+    def stop(self):
+        """Commit everything still queued, then stop the worker"""
+        if self._thread and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            stopping = False
+
+            while len(batch) < self.max_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._commit(batch)
+            if stopping:
+                return
+
+    def _commit(self, batch):
+        writes = [item for item in batch if item[0] is not None]
+        try:
+            if writes:
+                self.run_batch([(op, args) for op, args, _ in writes])
+            errors = [None] * len(writes)
+        except Exception as e:
+            # Part of the batch may have committed (one transaction per
+            # shard), so apply every write again on its own; ops are
+            # idempotent and a row already there is skipped
+            self.stats["errors"] += 1
+            print(f"[!] Write-behind batch of {len(writes)} failed, retrying one by one: {e}")
+            traceback.print_exc()
+            errors = [self._apply_one(op, args) for op, args, _ in writes]
+
+        failed = [e for e in errors if e is not None]
+        self.stats["batches"] += 1
+        self.stats["committed"] += len(writes) - len(failed)
+        self.stats["failed"] += len(failed)
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], len(writes))
+        if failed:
+            with self._lock:
+                self._failures.extend(failed)
+        if self.on_done and writes:
+            self.on_done([(op, args) for op, args, _ in writes])
+
+        for (_, _, ack), error in zip(writes, errors):
+            if ack:
+                ack.error = error
+        for _, _, ack in batch:
+            if ack:
+                ack.done.set()
+
+    def _apply_one(self, op, args):
+        """Run a single write in its own batch; returns its error or None"""
+        try:
+            self.run_batch([(op, args)])
+        except Exception as e:
+            print(f"[!] Write-behind: {op.__name__}{tuple(args)[:1]} lost: {e}")
+            return e
+        return None